@@ -0,0 +1,188 @@
+# this is just test code, it is not part of the web app
+# it times the code that reads the sensor data from DynamoDB, using a pretend
+# DynamoDB table held in memory so that it can be run on a laptop without AWS.
+# run it from the dash folder with: python3 benchmark-test.py
+
+import time
+import datetime
+import random
+from sensorCache import scanTable
+
+##################################################
+# a local stand-in for a DynamoDB table
+##################################################
+
+class FakeDynamoClient(object):
+    """
+        Behaves like the parts of the boto3 DynamoDB client used by the web app.
+        Each page of results waits for pageLatency seconds to act like the
+        round trip to AWS, and holds at most pageSize items (DynamoDB pages are 1MB)
+    """
+    def __init__(self, items, pageSize=2500, pageLatency=0.05):
+        self.items = items
+        self.pageSize = pageSize
+        self.pageLatency = pageLatency
+
+    def scan(self, TableName, Segment=0, TotalSegments=1, ExclusiveStartKey=None):
+        # every segment gets its own share of the items, like DynamoDB does
+        # by hashing the partition key
+        segmentItems = self.items[Segment::TotalSegments]
+        start = 0 if ExclusiveStartKey is None else ExclusiveStartKey['position']
+        return(self.page(segmentItems, start))
+
+    def query(self, TableName, KeyConditionExpression, ExpressionAttributeNames,
+              ExpressionAttributeValues, ExclusiveStartKey=None):
+        # only the "sensorID = :sid AND #ts > :ts" query used by the web app is supported
+        sensorID = ExpressionAttributeValues[':sid']['S']
+        timestamp = ExpressionAttributeValues[':ts']['S']
+        found = [i for i in self.items if i['sensorID']['S'] == sensorID and i['timestamp']['S'] > timestamp]
+        start = 0 if ExclusiveStartKey is None else ExclusiveStartKey['position']
+        return(self.page(found, start))
+
+    def page(self, items, start):
+        time.sleep(self.pageLatency)
+        response = {'Items': items[start:start + self.pageSize]}
+        if start + self.pageSize < len(items):
+            response['LastEvaluatedKey'] = {'position': start + self.pageSize}
+        return(response)
+
+class FakeMeta(object):
+    def __init__(self, client):
+        self.client = client
+
+class FakeTable(object):
+    """
+        Behaves like a boto3 DynamoDB Table handle
+    """
+    def __init__(self, name, client):
+        self.name = name
+        self.meta = FakeMeta(client)
+
+def makeSensorItems(numberOfItems, numberOfSensors=4):
+    # makes items that look like the ones in SDD-Sensors-Data, one every
+    # four minutes for each sensor
+    random.seed(1)
+    start = datetime.datetime(2019, 7, 1)
+    items = []
+    for i in range(numberOfItems):
+        sensorID = str(i % numberOfSensors + 1)
+        timestamp = '{:%Y-%m-%d %H:%M:%S}'.format(start + datetime.timedelta(minutes=4 * (i // numberOfSensors)))
+        items.append({
+            'sensorID': {'S': sensorID},
+            'timestamp': {'S': timestamp},
+            'data': {'M': {
+                'sensor': {'S': sensorID},
+                'timestamp': {'S': timestamp},
+                'temperature': {'N': '{:f}'.format(random.uniform(5, 35))},
+                'humidity': {'N': '{:f}'.format(random.uniform(20, 90))},
+                'pm25': {'N': '{:f}'.format(random.uniform(0, 60))},
+                'pm10': {'N': '{:f}'.format(random.uniform(0, 90))},
+                'bmp180_temperature': {'N': '{:f}'.format(random.uniform(5, 35))},
+                'bmp180_airpressure': {'N': '{:f}'.format(random.uniform(99000, 103000))},
+            }}})
+    return(items)
+
+##################################################
+# parallel segmented scan
+##################################################
+
+print("Making pretend sensor data...")
+items = makeSensorItems(100000)
+table = FakeTable('SDD-Sensors-Data', FakeDynamoClient(items))
+
+print("Parallel scan of {:d} items ({:d} per page, {:.0f} ms per page):".format(
+    len(items), table.meta.client.pageSize, table.meta.client.pageLatency * 1000))
+for segments in [1, 2, 4, 8, 16]:
+    start = time.perf_counter()
+    scanned = scanTable(table, totalSegments=segments, threads=segments)
+    elapsed = time.perf_counter() - start
+    assert len(scanned) == len(items)
+    print("  {:2d} segments: {:6.2f} s".format(segments, elapsed))
+
+##################################################
+# decoding the items into a dataframe
+##################################################
+# compares the old way (dynamodb_json + json_normalize) with decodeItems() in dynamoDecoder.py
+# the old way needs the dynamodb-json library: pip3 install dynamodb-json
+
+import pandas as pd
+from dynamodb_json import json_util
+from dynamoDecoder import decodeItems, SENSOR_DATA_COLUMNS
+try:
+    from pandas import json_normalize
+except ImportError:
+    # older versions of pandas
+    from pandas.io.json import json_normalize
+
+def oldDecode(items):
+    sensorData = pd.DataFrame(json_normalize(json_util.loads(items)))
+    sensorData = sensorData.drop(columns="data.sensor")
+    sensorData['data.timestamp'] = pd.to_datetime(sensorData['data.timestamp'])
+    sensorData['timestamp'] = pd.to_datetime(sensorData['timestamp'])
+    sensorData['sensorID'] = sensorData['sensorID'].astype('int64')
+    return(sensorData)
+
+def newDecode(items):
+    return(decodeItems(items, SENSOR_DATA_COLUMNS))
+
+print("Decoding {:d} items:".format(len(items)))
+for name, decode in [('dynamodb_json + json_normalize', oldDecode), ('decodeItems', newDecode)]:
+    start = time.perf_counter()
+    sensorData = decode(items)
+    elapsed = time.perf_counter() - start
+    assert len(sensorData) == len(items)
+    print("  {:32s} {:6.2f} s {:10,.0f} rows/s".format(name, elapsed, len(items) / elapsed))
+
+##################################################
+# decoding packed (binary) messages
+##################################################
+# the same readings sent in the compact binary layout (see rpi-sensor-node/packing.py),
+# one window per message and 20 windows per message
+
+import base64
+import numpy as np
+from dynamoDecoder import PACKED_VERSION, PACKED_HEADER, PACKED_RECORD
+
+def packItems(items, windowsPerMessage):
+    # pack the readings in the JSON items into packed items, per sensor
+    packed = []
+    bySensor = {}
+    for item in items:
+        bySensor.setdefault(item['sensorID']['S'], []).append(item)
+    for sensorID, sensorItems in bySensor.items():
+        for first in range(0, len(sensorItems), windowsPerMessage):
+            group = sensorItems[first:first + windowsPerMessage]
+            records = np.zeros(len(group), dtype=PACKED_RECORD)
+            for i, item in enumerate(group):
+                data = item['data']['M']
+                records[i]['timestamp'] = np.datetime64(item['timestamp']['S']).astype('datetime64[s]').astype(np.int64)
+                for name in PACKED_RECORD.names[1:]:
+                    records[i][name] = float(data[name.split('.', 1)[1]]['N'])
+            header = np.array([(PACKED_VERSION, len(group))], dtype=PACKED_HEADER)
+            packed.append({'sensorID': {'S': sensorID},
+                           'timestamp': group[-1]['timestamp'],
+                           'data': {'M': {'packed': {'S': base64.b64encode(header.tobytes() + records.tobytes()).decode()}}}})
+    return(packed)
+
+def itemSize(item):
+    # roughly how DynamoDB counts an item's size: the lengths of the names and values
+    size = 0
+    for name, value in item.items():
+        size += len(name)
+        if 'M' in value:
+            size += itemSize(value['M'])
+        else:
+            size += len(list(value.values())[0])
+    return(size)
+
+print("Packed messages:")
+print("  {:32s} {:6.0f} bytes per reading".format('JSON items', sum(itemSize(i) for i in items) / len(items)))
+for windowsPerMessage in [1, 20]:
+    packedItems = packItems(items, windowsPerMessage)
+    start = time.perf_counter()
+    sensorData = decodeItems(packedItems, SENSOR_DATA_COLUMNS)
+    elapsed = time.perf_counter() - start
+    assert len(sensorData) == len(items)
+    print("  {:32s} {:6.0f} bytes per reading, {:6.2f} s {:10,.0f} rows/s".format(
+        'packed, {:d} per message'.format(windowsPerMessage),
+        sum(itemSize(i) for i in packedItems) / len(items), elapsed, len(items) / elapsed))
@@ -0,0 +1,340 @@
+"""
+name: diskCache.py
+author: Emilio Guevarra Churches
+date: October 2026
+license: see LICENSE file
+description: this saves the cached sensor data to disk as numpy column files, so when the web
+app is restarted it can load the history from disk in a moment and only fetch the readings
+that arrived since, instead of scanning the whole DynamoDB table again. It is used by
+sensorCache.py.
+"""
+
+##################################################
+# set-up section
+##################################################
+
+import os
+import json
+import time
+import shutil
+import logging
+import tempfile
+from contextlib import contextmanager
+try:
+    # file locking is only available on Linux and Mac, which is what the web server runs on
+    import fcntl
+except ImportError:
+    fcntl = None
+try:
+    # on Windows a file can only be locked so no other process can use it
+    import msvcrt
+except ImportError:
+    msvcrt = None
+import numpy as np # each column is saved as a numpy .npy file
+import pandas as pd # pandas library for manipulating data
+
+# change this whenever the way the cache is saved changes, any cache saved by a different
+# version is ignored and the history is read from DynamoDB again.
+# Version 2 added the data.hold column, with the held readings filled in (see stepHold.py)
+CACHE_FORMAT_VERSION = 2
+
+# where the cache is kept, this can be changed with the SDD_CACHE_DIR environment variable
+DEFAULT_CACHE_DIR = os.environ.get('SDD_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'sdd-sensor-cache'))
+
+# New readings are saved as a small extra segment after each refresh rather than re-saving the
+# whole history. Once there are more than this many segments they are combined into one again.
+# When the cache is shared this only happens in the worker holding the exclusive lock, so no
+# other worker is reading the segments while they are being combined and tidied up.
+MAX_SEGMENTS = 20
+
+MANIFEST = 'manifest.json'
+LOCK_FILE = 'refresh.lock'
+OWNER_FILE = 'owner.lock'
+
+# On the web server the app runs in several worker processes at once. When SHARED_CACHE is on
+# they all share the one disk cache: only one worker at a time fetches from DynamoDB (the others
+# wait for it and then use what it saved), and once the segments have been combined into one
+# the workers memory-map it rather than each keeping their own copy of the history. New rows
+# are still saved as extra segments, so a refresh only writes what is new.
+# It is turned off where file locking isn't available (Windows) or by setting the
+# SDD_SHARED_CACHE environment variable to 0. Then only the first process to start owns the
+# cache and saves to it. The others can still load it when they start, but keep what they
+# fetch after that to themselves.
+SHARED_CACHE = fcntl is not None and os.environ.get('SDD_SHARED_CACHE', '1') != '0'
+
+# when sharing, a refresh within this many seconds of another worker's refresh just uses
+# the data that worker fetched instead of asking DynamoDB again
+SHARED_REFRESH_SECONDS = float(os.environ.get('SDD_SHARED_REFRESH_SECONDS', '10'))
+
+logger = logging.getLogger(__name__)
+
+##################################################
+# the disk cache
+##################################################
+# The cache directory holds a manifest.json file that lists the columns, the newest timestamp
+# for each sensor (the high-water mark) and the segments, plus one folder per segment with
+# one .npy file per column. A save writes the new segment folder first and then replaces the
+# manifest in one go, so if the app is stopped halfway through a save the old manifest is
+# still there and still points at complete files.
+# When the cache is shared between worker processes, a lock file makes sure only one worker
+# writes at a time (and that no worker reads while old segment files are being tidied up).
+# When it isn't shared, the process holding the lock on the owner file is the only one that
+# writes to it.
+
+class DiskCache(object):
+    """
+        Saves and loads a sensor data dataframe and its high-water marks. Number and
+        date/time columns are saved as they are. Text columns are saved as fixed width
+        unicode arrays (so they can be saved without pickling), with missing text saved
+        as an empty string.
+    """
+    def __init__(self, directory=DEFAULT_CACHE_DIR, shared=SHARED_CACHE):
+        self.directory = directory
+        self.shared = shared
+        self.maxSegments = MAX_SEGMENTS
+        self.manifest = None
+        self.seenManifest = (None, None) # (file signature, generation) of the manifest last looked at
+        self.owner = None # whether this process may save to a cache that isn't shared, once known
+        self.ownerFile = None # kept open while this process owns the cache, to hold the lock on it
+
+    @contextmanager
+    def lock(self, exclusive=True):
+        """
+            Holds the cache lock while the with block runs. Many workers can hold the
+            non-exclusive (reading) lock at once, but the exclusive (refreshing) lock
+            is only held by one worker while no others hold either lock.
+        """
+        if not self.shared:
+            yield
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        with open(os.path.join(self.directory, LOCK_FILE), 'a') as lockFile:
+            fcntl.flock(lockFile.fileno(), fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            try:
+                yield
+            finally:
+                fcntl.flock(lockFile.fileno(), fcntl.LOCK_UN)
+
+    def owns(self):
+        """
+            True if this process may save to the cache. When the cache is shared any worker
+            may, while holding the exclusive lock. Otherwise the first process to ask owns
+            the cache for as long as it runs, so two processes never save over each other.
+        """
+        if self.shared:
+            return(True)
+        if self.owner is None:
+            self.owner = self.takeOwnership()
+        return(self.owner)
+
+    def takeOwnership(self):
+        # lock the owner file without waiting, if another process already has it that one owns the cache
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            ownerFile = open(os.path.join(self.directory, OWNER_FILE), 'a')
+        except OSError as exp:
+            logger.warning("could not use sensor data cache in %s: %s", self.directory, exp)
+            return(False)
+        try:
+            if fcntl is not None:
+                fcntl.flock(ownerFile.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            elif msvcrt is not None:
+                ownerFile.seek(0)
+                msvcrt.locking(ownerFile.fileno(), msvcrt.LK_NBLCK, 1)
+        except OSError:
+            ownerFile.close()
+            logger.info("another process saves to the sensor data cache in %s, this one won't", self.directory)
+            return(False)
+        self.ownerFile = ownerFile
+        return(True)
+
+    def generation(self):
+        """
+            Returns a number that goes up every time the cache on disk is saved (by any
+            worker), or None if there is no usable cache. This doesn't need the lock, as the
+            manifest is always replaced in one go, and it is only read again when the file
+            has changed, so it can be called on every callback.
+        """
+        try:
+            stat = os.stat(self.manifestPath())
+            signature = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+            if signature != self.seenManifest[0]:
+                self.seenManifest = (signature, self.readManifest()['nextSegment'])
+            return(self.seenManifest[1])
+        except (OSError, ValueError, KeyError):
+            return(None)
+
+    def epoch(self):
+        """
+            Returns a number that goes up every time the whole history is read again
+            (a full resync). Combining the segments doesn't change it, as the rows are the same.
+        """
+        return(self.manifest.get('epoch', 0) if self.manifest else None)
+
+    def checkedRecently(self):
+        """
+            True if some worker checked DynamoDB for new data in the last SHARED_REFRESH_SECONDS
+        """
+        try:
+            return(time.time() - self.readManifest()['checkedAt'] < SHARED_REFRESH_SECONDS)
+        except (OSError, ValueError, KeyError):
+            return(False)
+
+    def markChecked(self):
+        """
+            Records that DynamoDB was just checked, even though nothing new was found
+        """
+        if self.manifest is None or not self.owns():
+            return
+        try:
+            manifest = dict(self.manifest)
+            manifest['checkedAt'] = time.time()
+            self.writeManifest(manifest)
+        except OSError as exp:
+            logger.warning("could not update sensor data cache in %s: %s", self.directory, exp)
+
+    def manifestPath(self):
+        return(os.path.join(self.directory, MANIFEST))
+
+    def readManifest(self):
+        with open(self.manifestPath()) as f:
+            manifest = json.load(f)
+        if manifest.get('version') != CACHE_FORMAT_VERSION:
+            raise ValueError("cache format version {} is not {}".format(manifest.get('version'), CACHE_FORMAT_VERSION))
+        return(manifest)
+
+    def writeManifest(self, manifest):
+        # write to a temporary file first then swap it in, so the manifest is never half written
+        tmpPath = self.manifestPath() + '.tmp'
+        with open(tmpPath, 'w') as f:
+            json.dump(manifest, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmpPath, self.manifestPath())
+        self.manifest = manifest
+
+    def writeSegment(self, name, sensorData, columns):
+        # save each column of the dataframe into its own .npy file
+        segmentDir = os.path.join(self.directory, name)
+        os.makedirs(segmentDir, exist_ok=True)
+        for i, column in enumerate(columns):
+            series = sensorData[column]
+            if pd.api.types.is_object_dtype(series) or pd.api.types.is_string_dtype(series):
+                values = np.array(['' if pd.isna(value) else str(value) for value in series], dtype=str)
+            else:
+                values = series.values
+            with open(os.path.join(segmentDir, 'col{:d}.npy'.format(i)), 'wb') as f:
+                np.save(f, values, allow_pickle=False)
+                f.flush()
+                os.fsync(f.fileno())
+
+    def removeUnusedSegments(self):
+        # tidy up segment folders that the manifest doesn't mention any more
+        used = set(segment['name'] for segment in self.manifest['segments'])
+        for name in os.listdir(self.directory):
+            if name.startswith('seg-') and name not in used:
+                shutil.rmtree(os.path.join(self.directory, name), ignore_errors=True)
+
+    def load(self):
+        """
+            Returns the saved dataframe (sorted newest first) and high-water marks, or
+            (None, None) if there is no usable cache. A cache that can't be read properly
+            (missing or damaged files, wrong version) is ignored rather than used.
+        """
+        try:
+            manifest = self.readManifest()
+            columns = manifest['columns']
+            # a single sorted segment can be used as it is, without copying it
+            asSaved = len(manifest['segments']) == 1 and manifest.get('sorted', False)
+            segments = []
+            for segment in manifest['segments']:
+                segmentDir = os.path.join(self.directory, segment['name'])
+                arrays = {}
+                for i, (column, dtype) in enumerate(columns):
+                    # memory-map the file rather than reading it. When the history is saved as one
+                    # sorted segment the dataframe uses these arrays directly, so the operating
+                    # system shares the same memory between all the worker processes
+                    array = np.load(os.path.join(segmentDir, 'col{:d}.npy'.format(i)), mmap_mode='r', allow_pickle=False)
+                    text = array.dtype.kind == 'U'
+                    if array.shape != (segment['rows'],) or (str(array.dtype) != dtype and not text):
+                        raise ValueError("{} in {} is damaged".format(column, segment['name']))
+                    # text is copied out into python strings, like the dataframe had it
+                    arrays[column] = array.astype(object) if text else array
+                segments.append(pd.DataFrame(arrays, columns=[column for column, dtype in columns], copy=not asSaved))
+        except FileNotFoundError:
+            return(None, None)
+        except (OSError, ValueError, KeyError, TypeError) as exp:
+            logger.warning("ignoring sensor data cache in %s: %s", self.directory, exp)
+            return(None, None)
+        if not segments:
+            return(None, None)
+        self.manifest = manifest
+        if asSaved:
+            return(segments[0], manifest['highWater'])
+        sensorData = pd.concat(segments, ignore_index=True)
+        sensorData.sort_values(["timestamp", "sensorID"], axis=0, ascending=[False,True], inplace=True, kind='mergesort')
+        return(sensorData, manifest['highWater'])
+
+    def save(self, sensorData, highWater, resync=True):
+        """
+            Saves the whole dataframe (which must be sorted newest first) as a single
+            segment, replacing anything saved before. resync is False when the segments
+            are just being combined, rather than the whole history having been read again.
+            When the cache is shared the exclusive lock must be held.
+        """
+        if not self.owns():
+            return
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            # another worker may have saved since this one last looked, so don't reuse its segment name
+            nextSegment = max(self.manifest['nextSegment'] if self.manifest else 1, self.generation() or 1)
+            epoch = self.epoch() or 0
+            if resync:
+                try:
+                    epoch = max(epoch, self.readManifest().get('epoch', 0)) + 1
+                except (OSError, ValueError):
+                    epoch += 1
+            name = 'seg-{:06d}'.format(nextSegment)
+            columns = list(sensorData.columns)
+            self.writeSegment(name, sensorData, columns)
+            self.writeManifest({'version': CACHE_FORMAT_VERSION,
+                                'columns': [[column, str(sensorData[column].dtype)] for column in columns],
+                                'highWater': highWater,
+                                'segments': [{'name': name, 'rows': len(sensorData)}],
+                                'sorted': True,
+                                'checkedAt': time.time(),
+                                'epoch': epoch,
+                                'nextSegment': nextSegment + 1})
+            self.removeUnusedSegments()
+        except (OSError, ValueError) as exp:
+            # the dashboard still works without the disk cache, it just starts up slower
+            logger.warning("could not save sensor data cache to %s: %s", self.directory, exp)
+
+    def append(self, newData, highWater, sensorData):
+        """
+            Saves just the new rows as an extra segment. sensorData is the whole dataframe,
+            which is saved instead if there are already too many segments. When the cache is
+            shared the exclusive lock must be held.
+        """
+        if not self.owns():
+            return
+        if self.manifest is None:
+            self.save(sensorData, highWater)
+            return
+        if len(self.manifest['segments']) >= self.maxSegments:
+            self.save(sensorData, highWater, resync=False)
+            return
+        try:
+            columns = [column for column, dtype in self.manifest['columns']]
+            nextSegment = self.manifest['nextSegment']
+            name = 'seg-{:06d}'.format(nextSegment)
+            self.writeSegment(name, newData, columns)
+            manifest = dict(self.manifest)
+            manifest['highWater'] = highWater
+            manifest['segments'] = self.manifest['segments'] + [{'name': name, 'rows': len(newData)}]
+            manifest['sorted'] = False
+            manifest['checkedAt'] = time.time()
+            manifest['nextSegment'] = nextSegment + 1
+            self.writeManifest(manifest)
+        except (OSError, ValueError, KeyError) as exp:
+            logger.warning("could not save new sensor data to cache in %s: %s", self.directory, exp)
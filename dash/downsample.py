@@ -0,0 +1,64 @@
+"""
+name: downsample.py
+author: Emilio Guevarra Churches
+date: October 2026
+license: see LICENSE file
+description: this cuts a long time series down to a set number of points for the graphs
+while keeping its shape (peaks and dips stay in), so the browser isn't sent every single
+reading. It is imported by the main program.
+"""
+
+##################################################
+# set-up section
+##################################################
+
+import numpy as np # numpy arrays used for the calculations
+
+##################################################
+# Largest-Triangle-Three-Buckets downsampling
+##################################################
+# This is the method from Sveinn Steinarsson's thesis "Downsampling Time Series for
+# Visual Representation" (https://skemman.is/handle/1946/15343). The points (apart from the
+# first and last) are split into equal sized buckets, and one point is picked from each bucket:
+# the one that makes the biggest triangle with the point picked from the bucket before and the
+# average of the bucket after. Big triangles are the points where the line changes direction,
+# so spikes in the PM2.5 readings during a smoke event still show up on the graph.
+
+def lttbIndex(x, y, threshold):
+    # returns the positions of the points to keep, x and y must be numpy arrays of numbers
+    # with x in ascending order and no missing values in y
+    n = len(x)
+    if threshold >= n or threshold < 3:
+        return(np.arange(n))
+    x = x.astype(np.float64)
+    y = y.astype(np.float64)
+    keep = np.zeros(threshold, dtype=np.int64)
+    # the first and last points are always kept
+    keep[-1] = n - 1
+    # size of each bucket, not counting the first and last points
+    every = (n - 2) / (threshold - 2)
+    a = 0 # the point picked from the previous bucket
+    for i in range(threshold - 2):
+        # the average of the next bucket
+        nextStart = int(np.floor((i + 1) * every)) + 1
+        nextEnd = min(int(np.floor((i + 2) * every)) + 1, n)
+        avgX = x[nextStart:nextEnd].mean()
+        avgY = y[nextStart:nextEnd].mean()
+        # the points in this bucket
+        start = int(np.floor(i * every)) + 1
+        end = int(np.floor((i + 1) * every)) + 1
+        # twice the area of the triangle for each point (no need to halve it just to compare)
+        area = np.abs((x[a] - avgX) * (y[start:end] - y[a]) - (x[a] - x[start:end]) * (avgY - y[a]))
+        a = start + int(np.argmax(area))
+        keep[i + 1] = a
+    return(keep)
+
+def downsampleFrame(df, xColumn, yColumn, threshold):
+    # returns at most threshold rows of the dataframe, picked with LTTB on the two columns given.
+    # The rows must already be in ascending order of xColumn and yColumn must not contain NaNs.
+    # Timestamps are turned into numbers (nanoseconds) for the calculation.
+    if len(df) <= threshold:
+        return(df)
+    x = df[xColumn].values.astype('datetime64[ns]').astype(np.int64)
+    y = df[yColumn].values
+    return(df.iloc[lttbIndex(x, y, threshold)])
@@ -0,0 +1,186 @@
+"""
+name: dynamoDecoder.py
+author: Emilio Guevarra Churches
+date: October 2026
+license: see LICENSE file
+description: this turns the items read from DynamoDB straight into a pandas dataframe.
+It replaces the dynamodb_json json.loads() -> json_normalize() -> DataFrame() -> to_datetime()
+chain, which was slower than actually fetching the data. It is imported by the main program.
+"""
+
+##################################################
+# set-up section
+##################################################
+
+import base64
+import numpy as np # numpy arrays hold each column of the data
+import pandas as pd # pandas library for manipulating data
+
+# The columns we want out of each table, as (column name, type) pairs. The column names
+# are the same as the ones json_normalize() used to make, i.e. a name like 'data.pm25'
+# means the pm25 value inside the nested "data" map of each item.
+# The types are 'int', 'float', 'datetime' (a 'YYYY-MM-DD HH:MM:SS' string) or 'text'
+SENSOR_DATA_COLUMNS = [
+    ('sensorID', 'int'),
+    ('timestamp', 'datetime'),
+    ('data.timestamp', 'datetime'),
+    ('data.temperature', 'float'),
+    ('data.humidity', 'float'),
+    ('data.pm25', 'float'),
+    ('data.pm10', 'float'),
+    ('data.bmp180_temperature', 'float'),
+    ('data.bmp180_airpressure', 'float'),
+    ('data.hold', 'float'),
+]
+
+SENSOR_INFO_COLUMNS = [
+    ('sensorID', 'int'),
+    ('timestamp', 'text'),
+    ('info.info', 'text'),
+]
+
+# A sensor node can send its readings in a compact binary layout instead of JSON (see
+# rpi-sensor-node/packing.py, which must match this). These arrive as items with the
+# message base64 encoded in data.packed. Each message is a 3 byte header (version, number
+# of records) and then one fixed size record per window. The record is described as a
+# numpy dtype so a whole list of records can be read in one go with np.frombuffer().
+# Version 2 records come from nodes using the deadband filter (rpi-sensor-node/deadband.py)
+# and have the hold time on the end, 0 meaning the record doesn't have one.
+PACKED_VERSION = 1
+HELD_VERSION = 2
+PACKED_HEADER = np.dtype([('version', '<u1'), ('count', '<u2')])
+PACKED_RECORD = np.dtype([('timestamp', '<u4'),
+                          ('data.temperature', '<f4'),
+                          ('data.humidity', '<f4'),
+                          ('data.pm25', '<f4'),
+                          ('data.pm10', '<f4'),
+                          ('data.bmp180_temperature', '<f4'),
+                          ('data.bmp180_airpressure', '<f4')])
+HELD_RECORD = np.dtype(PACKED_RECORD.descr + [('data.hold', '<u4')])
+PACKED_RECORDS = {PACKED_VERSION: PACKED_RECORD, HELD_VERSION: HELD_RECORD}
+
+##################################################
+# functions to decode the items
+##################################################
+# Each item from the DynamoDB client looks like this:
+# {"sensorID": {"S": "1"}, "timestamp": {"S": "2019-07-01 10:00:00"},
+#  "data": {"M": {"pm25": {"N": "3.2"}, ...}}}
+# i.e. every value is wrapped in a little dictionary saying what type it is
+# (S for string, N for number, M for map). Numbers are sent as strings.
+
+EMPTY = {} # used when an item is missing a nested map
+
+def rawValue(attribute):
+    # unwrap a single DynamoDB value, numbers are left as strings for numpy to convert
+    if 'N' in attribute:
+        return(attribute['N'])
+    return(attribute.get('S'))
+
+def rawColumn(items, name):
+    # pull the raw values for one column out of every item, using None if it is missing.
+    # Nested columns like 'data.pm25' look inside the "data" map of each item
+    if '.' not in name:
+        return([rawValue(item[name]) if name in item else None for item in items])
+    outer, inner = name.split('.', 1)
+    maps = [item[outer].get('M', EMPTY) if outer in item else EMPTY for item in items]
+    return([rawValue(m[inner]) if inner in m else None for m in maps])
+
+def toArray(values, columnType):
+    # convert a list of raw values into a typed numpy array in one go
+    if columnType == 'float':
+        # numpy converts the number strings itself, None becomes NaN
+        return(np.array(values, dtype=np.float64))
+    if columnType == 'int':
+        return(np.array(values).astype(np.int64))
+    if columnType == 'datetime':
+        # numpy understands 'YYYY-MM-DD HH:MM:SS' directly, None becomes NaT
+        return(np.array(values, dtype='datetime64[s]').astype('datetime64[ns]'))
+    return(np.array(values, dtype=object))
+
+def expandBatches(items):
+    # A sensor node can pack several windows of readings into one message (see
+    # rpi-sensor-node/publisher.py), which arrives as one item with a list of readings:
+    # {"sensorID": {"S": "1"}, "timestamp": {"S": "<newest>"},
+    #  "data": {"M": {"batch": {"L": [{"M": {"timestamp": ..., "pm25": ...}}, ...]}}}}
+    # Turn each of these into one item per window, like the ones sent without batching,
+    # so the rest of the web app can't tell the difference.
+    if not any('batch' in item.get('data', EMPTY).get('M', EMPTY) for item in items):
+        return(items)
+    expanded = []
+    for item in items:
+        batch = item.get('data', EMPTY).get('M', EMPTY).get('batch')
+        if batch is None:
+            expanded.append(item)
+            continue
+        for reading in batch.get('L', []):
+            readingMap = reading.get('M', EMPTY)
+            window = dict(item)
+            window['timestamp'] = readingMap.get('timestamp', item['timestamp'])
+            window['data'] = reading
+            expanded.append(window)
+    return(expanded)
+
+def isPacked(item):
+    return('packed' in item.get('data', EMPTY).get('M', EMPTY))
+
+def decodePackedRecords(records, sensorIDs, counts, columns):
+    # turn a numpy array of records (all with the same layout) into a dictionary of
+    # numpy arrays, one per column
+    timestamps = records['timestamp'].astype('datetime64[s]').astype('datetime64[ns]')
+    decoded = {}
+    for name, columnType in columns:
+        if name == 'sensorID':
+            decoded[name] = np.repeat(np.array(sensorIDs, dtype=np.int64), counts)
+        elif name in ('timestamp', 'data.timestamp'):
+            decoded[name] = timestamps
+        elif name == 'data.hold' and name in records.dtype.names:
+            # 0 means no hold time
+            decoded[name] = np.where(records[name] > 0, records[name], np.nan)
+        elif name in records.dtype.names:
+            decoded[name] = records[name].astype(np.float64)
+        else:
+            decoded[name] = toArray([None] * len(records), columnType)
+    return(decoded)
+
+def decodePacked(items, columns):
+    # turn a list of items holding packed messages into a dictionary of numpy arrays,
+    # one per column, with a row for every record in every message
+    # the messages are grouped by layout version, each group is read in one go
+    groups = {} # version -> (sensor IDs, record counts, record bytes)
+    for item in items:
+        blob = base64.b64decode(item['data']['M']['packed']['S'])
+        header = np.frombuffer(blob, dtype=PACKED_HEADER, count=1)
+        version = int(header['version'][0])
+        count = int(header['count'][0])
+        if version not in PACKED_RECORDS or len(blob) != PACKED_HEADER.itemsize + count * PACKED_RECORDS[version].itemsize:
+            # a message from a newer (or broken) sensor node, leave it out rather than guess
+            continue
+        sensorIDs, counts, blobs = groups.setdefault(version, ([], [], []))
+        sensorIDs.append(item['sensorID']['S'])
+        counts.append(count)
+        blobs.append(blob[PACKED_HEADER.itemsize:])
+    if not groups:
+        return(decodePackedRecords(np.zeros(0, dtype=PACKED_RECORD), [], [], columns))
+    # all the records from all the messages of each version, as one numpy array of records
+    decoded = [decodePackedRecords(np.frombuffer(b''.join(blobs), dtype=PACKED_RECORDS[version]),
+                                   sensorIDs, counts, columns)
+               for version, (sensorIDs, counts, blobs) in sorted(groups.items())]
+    if len(decoded) == 1:
+        return(decoded[0])
+    return({name: np.concatenate([d[name] for d in decoded]) for name, columnType in columns})
+
+def decodeColumns(items, columns):
+    # turn a list of DynamoDB items into a dictionary of numpy arrays, one per column
+    return({name: toArray(rawColumn(items, name), columnType) for name, columnType in columns})
+
+def decodeItems(items, columns):
+    # turn a list of DynamoDB items into a pandas dataframe with the columns given
+    items = expandBatches(items)
+    names = [name for name, columnType in columns]
+    packed = [item for item in items if isPacked(item)]
+    if not packed:
+        return(pd.DataFrame(decodeColumns(items, columns), columns=names))
+    plain = [item for item in items if not isPacked(item)]
+    return(pd.concat([pd.DataFrame(decodeColumns(plain, columns), columns=names),
+                      pd.DataFrame(decodePacked(packed, columns), columns=names)],
+                     ignore_index=True))
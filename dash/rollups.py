@@ -0,0 +1,110 @@
+"""
+name: rollups.py
+author: Emilio Guevarra Churches
+date: October 2026
+license: see LICENSE file
+description: this keeps per-minute, per-hour and per-day summaries (mean, min, max and count)
+of each sensor's readings, so the graphs over long time ranges can use a few hundred summary
+points instead of every reading. It is imported by the main program.
+"""
+
+##################################################
+# set-up section
+##################################################
+
+import numpy as np # numpy functions used to combine the summaries
+import pandas as pd # pandas library for manipulating data
+
+# the readings that get summarised
+ROLLUP_FIELDS = ['data.temperature', 'data.humidity', 'data.pm25', 'data.pm10',
+                 'data.bmp180_temperature', 'data.bmp180_airpressure']
+
+# the summary resolutions as (name, length of each time bucket), finest first
+RESOLUTIONS = [('1min', pd.Timedelta(minutes=1)),
+               ('1hour', pd.Timedelta(hours=1)),
+               ('1day', pd.Timedelta(days=1))]
+
+##################################################
+# functions to make and combine summaries
+##################################################
+# Each summary table has one row for each sensor and time bucket (the index is sensorID, bucket)
+# and a pair of column labels: the statistic (sum, min, max, count) and the reading, e.g.
+# ('max', 'data.pm25'). The mean is worked out from the sum and count when it is needed,
+# because sums and counts can simply be added together when new readings arrive.
+
+def summarise(sensorData, bucketLength):
+    # make a summary table for the readings given
+    buckets = sensorData['timestamp'].dt.floor(bucketLength)
+    grouped = sensorData.groupby([sensorData['sensorID'], buckets.rename('bucket')])[ROLLUP_FIELDS]
+    return(pd.concat({'sum': grouped.sum(), 'min': grouped.min(),
+                      'max': grouped.max(), 'count': grouped.count()}, axis=1))
+
+def combine(old, new):
+    # combine two summary tables for the same sensors and buckets into one
+    return(pd.concat({'sum': old['sum'] + new['sum'],
+                      'min': np.fmin(old['min'], new['min']),
+                      'max': np.fmax(old['max'], new['max']),
+                      'count': old['count'] + new['count']}, axis=1))
+
+##################################################
+# the summary tables for every resolution
+##################################################
+
+class SensorRollups(object):
+    """
+        Holds a summary table for each of the RESOLUTIONS. It is kept up to date by the
+        SensorDataCache in sensorCache.py, which calls rebuild() after a full resync and
+        add() with just the new rows after each refresh.
+    """
+    def __init__(self):
+        self.tables = {}
+
+    def rebuild(self, sensorData):
+        """
+            Makes all the summary tables again from the whole history
+        """
+        self.tables = {name: summarise(sensorData, length) for name, length in RESOLUTIONS}
+
+    def add(self, newData):
+        """
+            Adds new readings to the summary tables. Only the buckets the new readings fall
+            in are changed, the rest of each table is left as it is. The new tables replace
+            the old ones in one go so the graphs never see a half-updated table.
+        """
+        tables = {}
+        for name, length in RESOLUTIONS:
+            table = self.tables[name]
+            partial = summarise(newData, length)
+            overlap = partial.index.intersection(table.index)
+            if len(overlap):
+                merged = combine(table.loc[overlap], partial.loc[overlap])
+                table = table.drop(overlap)
+                partial = pd.concat([partial.drop(overlap), merged])
+            tables[name] = pd.concat([table, partial]).sort_index()
+        self.tables = tables
+
+    def chooseResolution(self, start, end, points):
+        """
+            Returns the name of the coarsest resolution that still gives at least points
+            buckets between start and end, or None if even the finest one doesn't
+            (in which case the raw readings should be used)
+        """
+        if not self.tables:
+            return(None)
+        span = pd.Timestamp(end) - pd.Timestamp(start)
+        for name, length in reversed(RESOLUTIONS):
+            if span / length >= points:
+                return(name)
+        return(None)
+
+    def series(self, resolution, sensorID, column):
+        """
+            Returns the mean of the reading in each bucket for one sensor as a dataframe with
+            a timestamp column (the start of the bucket) and the reading column, in time order
+        """
+        table = self.tables[resolution]
+        if sensorID not in table.index.get_level_values('sensorID'):
+            return(pd.DataFrame({'timestamp': pd.Series([], dtype='datetime64[ns]'), column: []}))
+        rows = table.xs(sensorID, level='sensorID')
+        mean = rows[('sum', column)] / rows[('count', column)]
+        return(pd.DataFrame({'timestamp': rows.index, column: mean.values}).dropna())
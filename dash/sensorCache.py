@@ -0,0 +1,385 @@
+"""
+name: sensorCache.py
+author: Emilio Guevarra Churches
+date: October 2026
+license: see LICENSE file
+description: this keeps an in-memory copy of the sensor data so that the Refresh button
+only has to fetch the new readings from DynamoDB instead of scanning the whole table
+every time. It is imported by the main program.
+"""
+
+##################################################
+# set-up section
+##################################################
+
+import os # needed to read settings from environment variables
+import threading # needed so two browser refreshes at once don't both update the cache
+from concurrent.futures import ThreadPoolExecutor # runs the parallel scan segments
+import pandas as pd # pandas library for manipulating data
+
+# A full scan of the table is split into this many segments which are read at the same
+# time by a pool of threads (see https://docs.aws.amazon.com/amazondynamodb/latest/developerguide/Scan.html#Scan.ParallelScan ).
+# Set SCAN_SEGMENTS to 1 to go back to reading the pages one after another.
+# These can be changed without editing the code by setting the SDD_SCAN_SEGMENTS and
+# SDD_SCAN_THREADS environment variables, e.g. in the Elastic Beanstalk configuration.
+SCAN_SEGMENTS = int(os.environ.get('SDD_SCAN_SEGMENTS', '4'))
+SCAN_THREADS = int(os.environ.get('SDD_SCAN_THREADS', str(SCAN_SEGMENTS)))
+
+##################################################
+# functions to read items from a DynamoDB table
+##################################################
+# These use the low-level DynamoDB client that sits underneath the Table handle
+# (table.meta.client). The client returns items in DynamoDB JSON format, e.g.
+# {"sensorID": {"S": "1"}, "timestamp": {"S": "2019-07-01 10:00:00"}, "data": {"M": {...}}}
+# which the decodeItems() function in dynamoDecoder.py turns into a dataframe.
+
+def scanSegment(table, segment=0, totalSegments=1):
+    # read every item in one segment of the table, one page at a time
+    # dynamoDb sends the data as pages so we need to loop until no more pages
+    # (the client is safe to share between threads, unlike the Table handle itself)
+    client = table.meta.client
+    scanArgs = dict(TableName=table.name)
+    if totalSegments > 1:
+        scanArgs.update(Segment=segment, TotalSegments=totalSegments)
+    response = client.scan(**scanArgs)
+    items = response['Items']
+    while response.get('LastEvaluatedKey'):
+        response = client.scan(ExclusiveStartKey=response['LastEvaluatedKey'], **scanArgs)
+        items.extend(response['Items'])
+    return(items)
+
+def scanTable(table, totalSegments=None, threads=None):
+    # read every item in the table. DynamoDB splits the table into totalSegments
+    # segments and each segment is scanned by its own thread, then all the
+    # items are put back together into one list
+    if totalSegments is None:
+        totalSegments = SCAN_SEGMENTS
+    if threads is None:
+        threads = SCAN_THREADS
+    if totalSegments <= 1 or threads <= 1:
+        return(scanSegment(table))
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        segments = pool.map(lambda segment: scanSegment(table, segment, totalSegments), range(totalSegments))
+        items = []
+        for segmentItems in segments:
+            items.extend(segmentItems)
+    return(items)
+
+def queryNewer(table, sensorID, timestamp):
+    # read only the items for one sensor that are newer than the timestamp given.
+    # This works because the SDD-Sensors-Data table has sensorID as its partition key
+    # and timestamp as its sort key (see the Installation Guide), so DynamoDB can jump
+    # straight to the new items without reading the old ones.
+    # "timestamp" is a reserved word in DynamoDB so it has to be referred to as #ts
+    client = table.meta.client
+    queryArgs = dict(TableName=table.name,
+                     KeyConditionExpression='sensorID = :sid AND #ts > :ts',
+                     ExpressionAttributeNames={'#ts': 'timestamp'},
+                     ExpressionAttributeValues={':sid': {'S': sensorID}, ':ts': {'S': timestamp}})
+    response = client.query(**queryArgs)
+    items = response['Items']
+    while response.get('LastEvaluatedKey'):
+        response = client.query(ExclusiveStartKey=response['LastEvaluatedKey'], **queryArgs)
+        items.extend(response['Items'])
+    return(items)
+
+def queryLatest(table, sensorID):
+    # read just the newest item for one sensor. Setting ScanIndexForward to False makes
+    # DynamoDB go through the sensor's items newest first, and Limit=1 stops after the first
+    client = table.meta.client
+    response = client.query(TableName=table.name,
+                            KeyConditionExpression='sensorID = :sid',
+                            ExpressionAttributeValues={':sid': {'S': sensorID}},
+                            ScanIndexForward=False, Limit=1)
+    return(response['Items'])
+
+##################################################
+# the cache itself
+##################################################
+
+class SensorDataCache(object):
+    """
+        Holds the sensor data dataframe between refreshes, together with the newest
+        timestamp seen for each sensor (the "high-water mark"). On a normal refresh
+        only items newer than the high-water mark are fetched and added to the dataframe.
+    """
+    def __init__(self, table, itemsToDataFrame, summaries=(), diskCache=None, fillHeld=None):
+        """
+            table is the DynamoDB Table handle, itemsToDataFrame is the function that
+            turns a list of DynamoDB items into a tidy, sorted pandas dataframe.
+            summaries is a list of things worked out from the data (like the SensorRollups
+            in rollups.py) that need to be kept up to date. Each one needs a rebuild() method
+            which is given the whole dataframe after a full resync, and an add() method
+            which is given just the new rows after a refresh.
+            diskCache is an optional DiskCache (see diskCache.py) that the data is saved to,
+            so that when the app restarts it only has to fetch what's new since the last save.
+            fillHeld is an optional function that fills in the readings a sensor node left out
+            because they hadn't changed (see stepHold.py). It is given the new rows and the rows
+            already cached, and the rows it returns are what is cached and summarised.
+        """
+        self.table = table
+        self.itemsToDataFrame = itemsToDataFrame
+        self.summaries = summaries
+        self.diskCache = diskCache
+        self.fillHeld = fillHeld
+        self.sensorData = None
+        self.highWater = {} # sensorID string -> newest timestamp string seen
+        self.generation = None # which save of the disk cache the data came from
+        self.epoch = None # which full resync of the disk cache the data came from
+        self.lock = threading.Lock()
+
+    def updateHighWater(self, items):
+        """
+            Remembers the newest timestamp for each sensor in the items given. The
+            timestamps are stored as 'YYYY-MM-DD HH:MM:SS' strings so the newest is
+            also the biggest string.
+        """
+        for item in items:
+            sensorID = item['sensorID']['S']
+            timestamp = item['timestamp']['S']
+            if timestamp > self.highWater.get(sensorID, ''):
+                self.highWater[sensorID] = timestamp
+
+    def fullResync(self):
+        """
+            Throws away the cached data and reads the whole table again
+        """
+        items = scanTable(self.table)
+        self.highWater = {}
+        self.updateHighWater(items)
+        self.sensorData = self.itemsToDataFrame(items)
+        if self.fillHeld is not None:
+            self.sensorData = self.fillHeld(self.sensorData)
+        for summary in self.summaries:
+            summary.rebuild(self.sensorData)
+        if self.diskCache is not None:
+            self.diskCache.save(self.sensorData, self.highWater)
+            self.epoch = self.diskCache.epoch()
+
+    def loadFromDisk(self):
+        """
+            Replaces the cached data with the copy saved on disk, returns False if there
+            isn't a usable one
+        """
+        sensorData, highWater = self.diskCache.load()
+        if sensorData is None:
+            return(False)
+        if self.sensorData is not None and self.diskCache.epoch() == self.epoch:
+            # the disk only has new rows added since this was last loaded, so just add those
+            # to the summaries rather than making them all again. As with fetchNew() they are
+            # the rows newer than the high-water mark this worker already had.
+            oldHighWater = pd.to_datetime(sensorData['sensorID'].astype(str).map(self.highWater))
+            newData = sensorData[oldHighWater.isna() | (sensorData['timestamp'] > oldHighWater)]
+            if len(newData):
+                for summary in self.summaries:
+                    summary.add(newData)
+        else:
+            for summary in self.summaries:
+                summary.rebuild(sensorData)
+        self.sensorData = sensorData
+        self.highWater = highWater
+        self.generation = self.diskCache.manifest['nextSegment']
+        self.epoch = self.diskCache.epoch()
+        return(True)
+
+    def loadHistory(self):
+        """
+            Fills the empty cache. If there is a copy saved on disk it is loaded and only the
+            items newer than it are fetched, otherwise the whole table is read.
+        """
+        if self.diskCache is not None and self.loadFromDisk():
+            self.fetchNew()
+        else:
+            self.fullResync()
+
+    def diskIsNewer(self):
+        """
+            True if another worker process has saved newer data to the shared disk cache
+        """
+        generation = self.diskCache.generation()
+        return(generation is not None and generation != self.generation)
+
+    def refreshShared(self, fullResync):
+        """
+            Refreshes the data when the disk cache is shared between several worker processes.
+            This runs while holding the exclusive disk cache lock, so only one worker at a time
+            gets here. If another worker has just refreshed, its data is loaded from disk
+            instead of asking DynamoDB again.
+        """
+        if self.diskIsNewer():
+            self.loadFromDisk()
+        if fullResync or self.sensorData is None:
+            self.fullResync()
+        elif not self.diskCache.checkedRecently():
+            self.fetchNew()
+            self.diskCache.markChecked()
+        self.generation = self.diskCache.generation()
+        self.epoch = self.diskCache.epoch()
+
+    def fetchNew(self):
+        """
+            Fetches only the items newer than the high-water mark for each known sensor
+            and adds them to the front of the cached dataframe
+        """
+        items = []
+        for sensorID, timestamp in self.highWater.items():
+            items.extend(queryNewer(self.table, sensorID, timestamp))
+        if not items:
+            return
+        self.updateHighWater(items)
+        newData = self.itemsToDataFrame(items)
+        if self.fillHeld is not None:
+            newData = self.fillHeld(newData, self.sensorData)
+        for summary in self.summaries:
+            summary.add(newData)
+        # the dataframe is sorted newest first, so the new rows go in front. If every new
+        # row is newer than everything already in the cache then it is still in order,
+        # otherwise (e.g. one sensor was offline and caught up late) sort it again
+        needsSort = newData['timestamp'].min() <= self.sensorData['timestamp'].max()
+        self.sensorData = pd.concat([newData, self.sensorData], sort=False)
+        if needsSort:
+            self.sensorData.sort_values(["timestamp", "sensorID"], axis=0, ascending=[False,True],
+                                        inplace=True, kind='mergesort')
+        if self.diskCache is not None:
+            self.diskCache.append(newData, self.highWater, self.sensorData)
+
+    def getData(self, fullResync=False):
+        """
+            Returns the up-to-date sensor data dataframe. The first call loads the history
+            (see loadHistory()), any call with fullResync=True reads the whole table again,
+            and other calls only fetch the new items.
+            Note that a sensor node that has never sent any data will only show up after
+            a full resync.
+        """
+        with self.lock:
+            self.refresh(fullResync)
+            return(self.sensorData)
+
+    def refresh(self, fullResync):
+        """
+            Does the work for getData(), the caller must already hold the lock
+        """
+        if self.diskCache is not None and self.diskCache.shared:
+            with self.diskCache.lock():
+                self.refreshShared(fullResync)
+        elif fullResync:
+            self.fullResync()
+        elif self.sensorData is None:
+            self.loadHistory()
+        else:
+            self.fetchNew()
+
+    def isLoaded(self):
+        """
+            True once the whole history has been read into the cache
+        """
+        return(self.sensorData is not None)
+
+    def getCachedData(self):
+        """
+            Returns the cached sensor data without asking DynamoDB for anything new
+            (unless nothing has been loaded yet). When the disk cache is shared, newer
+            data saved by another worker process is picked up.
+        """
+        with self.lock:
+            # the generation is checked without the disk cache lock first, so the lock is
+            # only taken when there is something new to load
+            if self.diskCache is not None and self.diskCache.shared and self.diskIsNewer():
+                with self.diskCache.lock(exclusive=False):
+                    if self.diskIsNewer():
+                        self.loadFromDisk()
+            if self.sensorData is None:
+                self.refresh(False)
+            return(self.sensorData)
+
+##################################################
+# the latest reading for each sensor
+##################################################
+
+class LatestReadings(object):
+    """
+        Holds just the newest row for each sensor, which is all the Homepage needs.
+        Once the whole history is in the SensorDataCache this is kept up to date by it
+        (the same way as the rollups), otherwise fetchLatest() asks DynamoDB for the newest
+        item of each sensor directly so the Homepage doesn't have to wait for the whole
+        history to be read.
+    """
+    def __init__(self, table, itemsToDataFrame, sensorIDs, fillHeld=None, diskCache=None):
+        """
+            table, itemsToDataFrame and fillHeld are the same as for the SensorDataCache,
+            sensorIDs is the list of sensor node numbers to fetch when the history isn't loaded.
+            diskCache is an optional shared DiskCache (see diskCache.py): with one, only one
+            worker process at a time asks DynamoDB for the latest readings, and the others
+            use what it saved if it did so in the last SHARED_REFRESH_SECONDS.
+        """
+        self.table = table
+        self.itemsToDataFrame = itemsToDataFrame
+        self.sensorIDs = sensorIDs
+        self.fillHeld = fillHeld
+        self.diskCache = diskCache
+        self.latest = None
+
+    def setLatest(self, sensorData):
+        # keep the first (i.e. newest, as the data is sorted newest first) row for each
+        # sensor, indexed by sensorID so each sensor's row can be looked up directly
+        latest = sensorData.drop_duplicates('sensorID')
+        self.latest = latest.set_index('sensorID', drop=False)
+
+    def rebuild(self, sensorData):
+        self.setLatest(sensorData)
+
+    def add(self, newData):
+        if self.latest is None:
+            self.setLatest(newData)
+        else:
+            combined = pd.concat([newData, self.latest.reset_index(drop=True)], sort=False)
+            self.setLatest(combined.sort_values("timestamp", ascending=False, kind='mergesort'))
+
+    def fetchLatest(self):
+        """
+            Reads the newest item for each sensor from DynamoDB, or when the disk cache is
+            shared from another worker's recent read of them
+        """
+        if self.diskCache is None or not self.diskCache.shared:
+            self.queryLatest()
+            return
+        with self.diskCache.lock():
+            if self.diskCache.checkedRecently():
+                latest, unused = self.diskCache.load()
+                if latest is not None:
+                    self.setLatest(latest)
+                    return
+            self.queryLatest()
+            if self.latest is not None:
+                self.diskCache.save(self.latest.reset_index(drop=True), {})
+
+    def queryLatest(self):
+        """
+            Reads the newest item for each sensor straight from DynamoDB
+        """
+        items = []
+        for sensorID in self.sensorIDs:
+            newest = queryLatest(self.table, str(sensorID))
+            if newest and self.fillHeld is not None:
+                # the newest item may have left out readings that hadn't changed, so also
+                # fetch the items sent during its hold time to fill them in from
+                latest = self.itemsToDataFrame(newest)
+                hold = latest['data.hold'].max()
+                if hold > 0:
+                    since = latest['timestamp'].max() - pd.Timedelta(seconds=hold)
+                    held = queryNewer(self.table, str(sensorID), '{:%Y-%m-%d %H:%M:%S}'.format(since))
+                    newest = held or newest
+            items.extend(newest)
+        if items:
+            latest = self.itemsToDataFrame(items)
+            if self.fillHeld is not None:
+                latest = self.fillHeld(latest)
+            self.setLatest(latest)
+
+    def getLatest(self):
+        """
+            Returns a dataframe with the newest row for each sensor, indexed by sensorID
+        """
+        if self.latest is None:
+            self.fetchLatest()
+        return(self.latest)
@@ -11,18 +11,19 @@ description: this is the main web app file. it can be run on your laptop or on a
 ##################################################
 
 import boto3 # Amazon AWS SDK library for access DynamoDB database
-from boto3.dynamodb.conditions import Key, Attr # used in filtering queries
-import json # library to deal with JSON data
-import time
 from datetime import datetime
-from decimal import Decimal # used to deal with DynamoDB representations of decimals
-from dynamodb_json import json_util as json # used to convert DynamoDB JSON to normal JSON
 import pandas as pd # pandas library for manipulating data
-from pandas.io.json import json_normalize # un-nests (flattens) nested JSON data as required by pandas
 import dash # main dash framework for dashboard web app
 import dash_auth # dash authentication library
 from aboutApp import aboutApp # function to build About tab content
 from helpApp import helpApp # function to build help tab content
+from sensorCache import SensorDataCache, LatestReadings # keeps the sensor data in memory between refreshes
+from tablePaging import tablePage # filters, sorts and pages the tables on the server
+from diskCache import DiskCache, DEFAULT_CACHE_DIR, SHARED_CACHE # saves the cached sensor data to disk between restarts
+from rollups import SensorRollups # per-minute, per-hour and per-day summaries of the readings
+from downsample import downsampleFrame # cuts the graph lines down to a set number of points
+from dynamoDecoder import decodeItems, SENSOR_DATA_COLUMNS, SENSOR_INFO_COLUMNS # turns DynamoDB items into dataframes
+from stepHold import fillHeld, isHeld # fills in the readings a sensor node left out because they hadn't changed
 from app_passwords import VALID_USERNAME_PASSWORD_PAIRS # usernames and passwords
 # note: the app_passwords.py file imported in the line above
 # just contains something like this:
@@ -40,11 +41,11 @@ import dash_daq as daq # library of extra dash widgets like thermometer and guag
 import dash_core_components as dcc # core dash components
 import dash_bootstrap_components as dbc # Bootstrap libraries as extensions to dash
 import dash_html_components as html # dash HTML components
-from dash.dependencies import Input, Output # needed for callback from Refresh button
-from dash_table.Format import Format, Scheme, Sign, Symbol # used to format the tables
-import plotly.plotly as py # main graph library used in dash
+from dash.dependencies import Input, Output, State # needed for the callbacks
+from dash.exceptions import PreventUpdate # used to tell dash not to change anything in a callback
+from dash_table.Format import Format, Scheme # used to format the tables
 import plotly.graph_objs as go
-import sys
+import os # needed to read settings from environment variables
 import platform # needed to work out which operating system
 
 ##################################################
@@ -66,41 +67,15 @@ dynamodb = session.resource('dynamodb', region_name='ap-southeast-2',)
 dataTable = dynamodb.Table('SDD-Sensors-Data')
 infoTable = dynamodb.Table('SDD-Sensors-Info')
 
-# make a function to extract all the data into an in-memory Pandas dataframe
-# dataTable.scan() scans and returns JSON containing every record in the database 
-# in a JSON filed called "Items". We extract that field and process it with the 
-# json.loads() method from the dynamodb_json library. This converts the DynamoDB format
-# JSON into normal-looking JSON. Then we pass that through json_normalize() which
-# flattens or un-nests the JSON (our actual sensor data is contained in a field called 
-# "data", whereas we want it as a single flat row of data items. Finally, we
-# process the flattened JSON data with the Pandas DataFrame() methods which
-# returns a Pandas dataframe object.
-
-def getSensorData(): 
-    response = dataTable.scan()
-    data = response['Items']
-    # dynamoDb sends the data as pages so we need to loop until no more pages
-    # this was just copied from the DynamoDb tutorial on AWS
-    while response.get('LastEvaluatedKey'):
-        response = dataTable.scan(ExclusiveStartKey=response['LastEvaluatedKey'])
-        data.extend(response['Items'])
-    
-    # load data into a pandas DataFrame via the json.loads() function
-    # that converts DynamoDB JSON into standard JSON (see https://github.com/Alonreznik/dynamodb-json )
-    # and via the json_normalize() function in pandas that converts nested JSON data into a flat table form
-    # required by pandas
-    sensorData = pd.DataFrame(json_normalize(json.loads(data)))
-
-    # first bit of tidying up is to delete the additional sensor ID column
-    sensorData = sensorData.drop(columns="data.sensor")
-
-    # now we need to convert the timestamp columns from strings into python datetime format
-    # using the built-in Pandas to_datetime() method on those columns. In Pandas, columns
-    # can be referenced just by using square brackets.
-    sensorData['data.timestamp'] = pd.to_datetime(sensorData['data.timestamp'])
-    sensorData['timestamp'] = pd.to_datetime(sensorData['timestamp'])
-    # also convert the SensorID column from string into integer
-    sensorData['sensorID'] = sensorData['sensorID'].astype('int64')
+# make a function to turn the items read from the data table into an in-memory Pandas dataframe.
+# The items come back from DynamoDB as a list of records in DynamoDB JSON format, with our
+# actual sensor data nested inside a field called "data". The decodeItems() function in
+# dynamoDecoder.py pulls out each of the columns listed in SENSOR_DATA_COLUMNS straight into
+# numpy arrays (un-nesting the "data" field and converting the timestamps and sensor IDs
+# as it goes) and returns a Pandas dataframe object.
+
+def sensorItemsToDataFrame(data):
+    sensorData = decodeItems(data, SENSOR_DATA_COLUMNS)
     # sort data set according to this https://www.geeksforgeeks.org/python-pandas-dataframe-sort_values-set-2/
     sensorData.sort_values(["timestamp", "sensorID"], axis=0, ascending=[False,True], inplace=True)
     # converts the air pressure into hPa
@@ -108,21 +83,47 @@ def getSensorData():
     # return the pandas dataframe
     return(sensorData)
 
+# the data table has months of readings in it, so rather than scanning the whole table
+# on every refresh we keep the data in memory between refreshes and only ask DynamoDB
+# for readings newer than the latest one we already have for each sensor
+# (see the sensorCache.py file for how this works)
+# the sensor node numbers, if more sensor nodes are installed add them here
+SENSOR_IDS = range(1, 5)
+
+# The cache also keeps the per-minute, per-hour and per-day summaries used by the graphs
+# (see rollups.py) and the latest reading from each sensor used by the Homepage up to date
+sensorRollups = SensorRollups()
+# Sensor nodes using the deadband filter only send readings that have changed, the cache
+# fills in the rest with the last reading sent (see stepHold.py) as the new rows arrive
+# When the web server runs several worker processes, they share what one of them read (see diskCache.py)
+# so DynamoDB is asked for the latest readings once, not once by every worker
+latestReadings = LatestReadings(dataTable, sensorItemsToDataFrame, SENSOR_IDS, fillHeld=fillHeld,
+                                diskCache=DiskCache(os.path.join(DEFAULT_CACHE_DIR, 'latest')) if SHARED_CACHE else None)
+# The data is also saved to disk (see diskCache.py) so a restarted app doesn't have to scan the whole table
+sensorDataCache = SensorDataCache(dataTable, sensorItemsToDataFrame, summaries=[sensorRollups, latestReadings],
+                                  diskCache=DiskCache(), fillHeld=fillHeld)
+
+# returns the sensor data as a pandas dataframe. Set fullResync to True to throw away
+# the cached data and scan the whole table again.
+def getSensorData(fullResync=False):
+    return(sensorDataCache.getData(fullResync))
+
 # this functions the same as getSensorData, but reads from the SDD-Sensors-Info table in DynamoDB to
-# supply the sensorInfo dataframe table in dash
-def getSensorInfo():
-    response = infoTable.scan()
-    data = response['Items']
-    while response.get('LastEvaluatedKey'):
-        response = infoTable.scan(ExclusiveStartKey=response['LastEvaluatedKey'])
-        data.extend(response['Items'])
-    sensorInfo = pd.DataFrame(json_normalize(json.loads(data)))
+# supply the sensorInfo dataframe table in dash. The info table has the same sensorID and timestamp
+# keys as the data table, so it is cached in the same way, with its own disk cache that the
+# worker processes share.
+def sensorInfoItemsToDataFrame(data):
+    sensorInfo = decodeItems(data, SENSOR_INFO_COLUMNS)
     # sort data set according to this https://www.geeksforgeeks.org/python-pandas-dataframe-sort_values-set-2/
     sensorInfo.sort_values(["timestamp", "sensorID"], axis=0, ascending=[False,True], inplace=True)
-    # also convert the SensorID column from string into integer
-    sensorInfo['sensorID'] = sensorInfo['sensorID'].astype('int64')    
     return(sensorInfo)
 
+sensorInfoCache = SensorDataCache(infoTable, sensorInfoItemsToDataFrame,
+                                  diskCache=DiskCache(os.path.join(DEFAULT_CACHE_DIR, 'info')))
+
+def getSensorInfo(fullResync=False):
+    return(sensorInfoCache.getData(fullResync))
+
 
 ##################################################
 # set up the dash app
@@ -135,6 +136,10 @@ app = dash.Dash(__name__, external_stylesheets=[dbc.themes.BOOTSTRAP])
 # this is needed to run properly on AWS ElasticBeanstalk
 application = app.server
 
+# the graphs are only added to the page when the data is loaded, so tell dash not to
+# complain about callbacks (like the graph zoom one) for things that aren't on the page yet
+app.config.suppress_callback_exceptions = True
+
 #set up basic authentication as per https://dash.plot.ly/authentication
 # doesn't work on Windows so skip it if running Windows
 if platform.system() != 'Windows':
@@ -150,36 +155,60 @@ if platform.system() != 'Windows':
 # https://community.plot.ly/t/ploting-time-series-data/5265
 # If you needing to change the graphs, change them here.
 ##################################################
-def make_graph(sensorData, column, gtitle, y_label):
-	sensor1 = dict(
-		x=sensorData[sensorData.sensorID == 1].timestamp,
-		y=sensorData[sensorData.sensorID == 1][column],
-		name = "Sensor 1",
-		line = dict(color = '#1f77b4'),
-		opacity = 0.4)
-
-	sensor2 = dict(
-		x=sensorData[sensorData.sensorID == 2].timestamp,
-		y=sensorData[sensorData.sensorID == 2][column],
-		name = "Sensor 2",
-		line = dict(color = '#d62728'),
-		opacity = 0.4)
-
-	sensor3 = dict(
-		x=sensorData[sensorData.sensorID == 3].timestamp,
-		y=sensorData[sensorData.sensorID == 3][column],
-		name = "Sensor 3",
-		line = dict(color = '#bcbd22'),
-		opacity = 0.4)
-
-	sensor4 = dict(
-		x=sensorData[sensorData.sensorID == 4].timestamp,
-		y=sensorData[sensorData.sensorID == 4][column],
-		name = "Sensor 4",
-		line = dict(color = '#fcbd22'),
-		opacity = 0.4)
-
-	data = [sensor1, sensor2, sensor3, sensor4]
+# each trace on a graph is cut down to at most GRAPH_POINTS points using the LTTB method
+# in downsample.py, so the browser isn't sent every reading in the whole history.
+# When the user zooms in, the readings inside the zoomed window are sent at full resolution
+# (up to ZOOM_POINTS of them), see the zoomGraph() callback further down.
+# These can also be set with the SDD_GRAPH_POINTS and SDD_ZOOM_POINTS environment variables.
+GRAPH_POINTS = int(os.environ.get('SDD_GRAPH_POINTS', '1000'))
+ZOOM_POINTS = int(os.environ.get('SDD_ZOOM_POINTS', '5000'))
+
+# colours for the line for each sensor node, add another colour if you add a sensor node
+SENSOR_COLOURS = ['#1f77b4', '#d62728', '#bcbd22', '#fcbd22']
+
+# Over long time ranges there are far more readings than there are pixels across the graph,
+# so the readings for one sensor are taken from the coarsest summary in rollups.py (per-day,
+# per-hour or per-minute averages) that still has at least the given number of points between
+# start and end. For short time ranges the raw readings are used.
+def sensorSeries(sensorData, sID, column, start, end, points):
+	resolution = sensorRollups.chooseResolution(start, end, points)
+	if resolution is not None:
+		return(sensorRollups.series(resolution, sID, column))
+	# get the readings for one sensor in time order, without any missing values
+	sd = sensorData.loc[sensorData.sensorID == sID, ['timestamp', column]].dropna()
+	return(sd.sort_values('timestamp', kind='mergesort'))
+
+def sensorTrace(sensorData, sID, column, xRange=None):
+	if sensorData.empty:
+		# nothing has been read yet, so an empty line
+		return(sensorData[['timestamp', column]])
+	# the data is sorted newest first, so the whole history goes from the last row to the first
+	start, end = sensorData.timestamp.iloc[-1], sensorData.timestamp.iloc[0]
+	sd = sensorSeries(sensorData, sID, column, start, end, GRAPH_POINTS)
+	overview = downsampleFrame(sd, 'timestamp', column, GRAPH_POINTS)
+	if xRange is None:
+		return(overview)
+	# zoomed in, so use the most detailed readings needed inside the window and the cut-down
+	# ones outside it (the outside ones are still needed for the range slider under the graph)
+	sd = sensorSeries(sensorData, sID, column, xRange[0], xRange[1], ZOOM_POINTS)
+	inside = (sd.timestamp >= xRange[0]) & (sd.timestamp <= xRange[1])
+	window = downsampleFrame(sd[inside], 'timestamp', column, ZOOM_POINTS)
+	outside = overview[(overview.timestamp < xRange[0]) | (overview.timestamp > xRange[1])]
+	return(pd.concat([outside, window]).sort_values('timestamp', kind='mergesort'))
+
+def make_graph(sensorData, column, gtitle, y_label, xRange=None):
+	data = []
+	# a sensor node using the deadband filter only sends a reading when it changes, so its
+	# readings are drawn as steps (each one held until the next) rather than sloping lines
+	heldSensors = set(sensorData.loc[sensorData['data.hold'].notna(), 'sensorID']) if isHeld(sensorData) else set()
+	for sID, colour in enumerate(SENSOR_COLOURS, start=1):
+		sd = sensorTrace(sensorData, sID, column, xRange)
+		data.append(dict(
+			x=sd.timestamp,
+			y=sd[column],
+			name = "Sensor {:d}".format(sID),
+			line = dict(color = colour, shape = 'hv' if sID in heldSensors else 'linear'),
+			opacity = 0.4))
 
 	layout = go.Layout(
 		title=gtitle,
@@ -215,6 +244,8 @@ def make_graph(sensorData, column, gtitle, y_label):
 				visible = True
 			),
 			type='date',
+			# keep showing the zoomed window when the figure is redrawn with the full resolution data
+			range = None if xRange is None else [str(xRange[0]), str(xRange[1])],
 			)
 		)
 
@@ -226,6 +257,13 @@ def make_graph(sensorData, column, gtitle, y_label):
 # creates graphs using the data from the DynamoDB Table. 
 # Uses the graph specifications created by the make_graph() function above.
 ##################################################
+# the id, data column, title and y axis label of each graph
+GRAPHS = [('bmp180-temp-graph', 'data.bmp180_temperature', 'Temperature (BMP180 sensor)', 'degrees Celcius'),
+          ('humidity-graph', 'data.humidity', 'Humidity', '% relative humidity'),
+          ('bmp180-airpress-graph', 'data.bmp180_airpressure', 'Air pressure', 'hectoPascals'),
+          ('pm25-graph', 'data.pm25', 'PM 2.5', 'micrograms per cubic metre'),
+          ('pm10-graph', 'data.pm10', 'PM 10', 'micrograms per cubic metre')]
+
 def SensorGraph(sensorData):
     # style dictionary for each graph
     graphstyle = {'width': '70vw', 'display': 'block', 'margin-left': 'auto', 'margin-right': 'auto'}
@@ -233,20 +271,9 @@ def SensorGraph(sensorData):
     # Inside each card the graph is created by the dash Graph() function that makes a Plotly graph
     graphdiv = dbc.Card(body=True, children=[
             dbc.Card(body = True, color='primary', outline=True, className='mt-2', 
-            		children=[dcc.Graph(id='bmp180-temp-graph', style=graphstyle, 
-            		figure=make_graph(sensorData, 'data.bmp180_temperature', 'Temperature (BMP180 sensor)', 'degrees Celcius'))]),
-            dbc.Card(body = True, color='primary', outline=True, className='mt-2', 
-            		children=[dcc.Graph(id='humidity-graph', style=graphstyle, 
-            		figure=make_graph(sensorData, 'data.humidity', 'Humidity', '% relative humidity'))]),
-            dbc.Card(body = True, color='primary', outline=True, className='mt-2', 
-            		children=[dcc.Graph(id='bmp180-airpress-graph', style=graphstyle, 
-            		figure=make_graph(sensorData, 'data.bmp180_airpressure', 'Air pressure', 'hectoPascals'))]),
-            dbc.Card(body = True, color='primary', outline=True, className='mt-2', 
-            		children=[dcc.Graph(id='pm25-graph', style=graphstyle, 
-            		figure=make_graph(sensorData, 'data.pm25', 'PM 2.5', 'micrograms per cubic metre'))]),
-            dbc.Card(body = True, color='primary', outline=True, className='mt-2', 
-            		children=[dcc.Graph(id='pm10-graph', style=graphstyle, 
-            		figure=make_graph(sensorData, 'data.pm10', 'PM 10', 'micrograms per cubic metre'))]),
+            		children=[dcc.Graph(id=graphId, style=graphstyle, 
+            		figure=make_graph(sensorData, column, gtitle, y_label))])
+            for graphId, column, gtitle, y_label in GRAPHS
             ])
     return graphdiv
 
@@ -255,7 +282,10 @@ def SensorGraph(sensorData):
 # (i.e. status of the sensors) which was loaded from the DynamoDB table. 
 # Uses Dash DataTable library to create the table.
 ##################################################
-def infoTableDisplay(sensorInfo):
+# The filtering, sorting and paging is done on the server by the updateInfoTablePage()
+# callback further down, so only the rows on the page being looked at are sent to the browser.
+##################################################
+def infoTableDisplay():
     # mx-auto class supposed to centre the table on the page, but doesn't
     # seem to work when deployed to web server no idea why
     x = dbc.Card(body=True, className='mx-auto', children=[	
@@ -273,9 +303,8 @@ def infoTableDisplay(sensorInfo):
                 'textAlign': 'left'
             } for c in ['info.info', 'timestamp', 'sensorID']
         ],
-        # needed to convert pandas data frame into format needed by Dash Datatable
-	# as per the docs
-        data=sensorInfo.to_dict('records'),
+        # the rows for the current page are filled in by the updateInfoTablePage() callback
+        data=[],
         # the rest of these are settings for the table as per the docs
         style_as_list_view=True,
         style_cell={'padding': '5px'},
@@ -284,12 +313,16 @@ def infoTableDisplay(sensorInfo):
             'fontWeight': 'bold'
         },
         editable=False,
-        filter_action='native',		     
-        sort_action='native',
+        filter_action='custom',
+        filter_query='',
+        sort_action='custom',
         sort_mode="multi",
+        sort_by=[],
         row_selectable=False,
         row_deletable=False,
         selected_rows=[],
+        page_action='custom',
+        page_current=0,
         page_size = 50         
         ),
         ])
@@ -298,9 +331,10 @@ def infoTableDisplay(sensorInfo):
 ##################################################
 # Same as the code above, but presents the data frame which 
 # contains the actual data directly from the sensors.
+# The filtering, sorting and paging is done by the updateDataTablePage() callback.
 ##################################################
     
-def dataTableDisplay(sensorData):
+def dataTableDisplay():
     x = dbc.Card(body=True, className='mx-auto', children=[	
         dash_table.DataTable(id='sensor-data-table', 
         #Change the name value if you want to change the name of the table column
@@ -327,7 +361,7 @@ def dataTableDisplay(sensorData):
                       'type': 'numeric',
                      'format': Format(precision=2, scheme=Scheme.fixed)},
                 ],
-        data=sensorData.to_dict('records'),
+        data=[],
         style_as_list_view=True,
         style_data_conditional=[
             {
@@ -340,12 +374,16 @@ def dataTableDisplay(sensorData):
             'fontWeight': 'bold'
         },
 	editable=False,
-	filter_action='native',
-        sort_action='native',
+	filter_action='custom',
+	filter_query='',
+        sort_action='custom',
 	sort_mode="multi",
+	sort_by=[],
 	row_selectable=False,
 	row_deletable=False,
 	selected_rows=[],
+	page_action='custom',
+	page_current=0,
 	page_size = 50,
         )
     ])
@@ -355,14 +393,13 @@ def dataTableDisplay(sensorData):
 # function to set up the homepage content
 ##################################################
 
+# latestSensorData has the latest row for each sensor, indexed by sensorID
 def homepageDisplay(latestSensorData):
-    # need to do this to get data for each sensor in the loop below
-    df2 = latestSensorData.set_index('sensorID', drop = False)
+    df2 = latestSensorData
     j = [] # this list holds section for each sensor
     # now loop for each sensor node
-    # if more sensor nodes are available, change the range to sensorID + 1 
-    # (i.e. if you have installed sensor 5, change the last number to 6
-    for sID in range(1,5):
+    # if more sensor nodes are available, add them to SENSOR_IDS at the top of this file
+    for sID in SENSOR_IDS:
         #card creates a border around the sensors gauges
         k = [dbc.Card(body = True, color='primary', outline=True, className='mt-2', children=[    
                 dbc.Row([
@@ -454,59 +491,147 @@ app.layout = html.Div(className='container', children=[
 			# overall app heading
                         dbc.Col(html.H1('SDD Sensor App Dashboard'),width=7, align='center'),
 			# this is the pulsating data loading indicator
-                        dbc.Col(dcc.Loading(id="loading-1", children=[html.Div(id="loading-output-1")], type="dot"), width=3, align='center'),
+                        dbc.Col(dcc.Loading(id="loading-1", children=[html.Div(id="loading-output-1")], type="dot"), width=2, align='center'),
                         # Refresh button that is located on the header. Must be put in the header as the header 
-                        dbc.Col(dbc.Button('Refresh', id='refresh-button', className = 'mr-1', color = "success", size='sm'), width=2, align='center'),
+                        # The Full reload button throws away the cached data and reads the whole database again
+                        dbc.Col([dbc.Button('Refresh', id='refresh-button', className = 'mr-1', color = "success", size='sm'),
+                                 dbc.Button('Full reload', id='full-reload-button', className = 'mr-1', color = "warning", size='sm')],
+                                width=3, align='center'),
                     ])
                 ]),
             ]),
+    # this holds the time the data was last refreshed, when it changes the tab being looked at is rebuilt
+    dcc.Store(id='data-version'),
+    # these hold the data-version each tab was last built for, so a tab that is opened again
+    # isn't rebuilt (which would lose its table page, sorting, filters and graph zoom)
+    # unless the data has been refreshed since
+    dcc.Store(id='Homepage-version'),
+    dcc.Store(id='time-series-tab-version'),
+    dcc.Store(id='data-table-tab-version'),
+    dcc.Store(id='log-messages-tab-version'),
     # now under the header place all the tabs
-    dbc.Tabs(id="htmltabs", children=[
-        dbc.Tab(id='Homepage', label='Homepage'),
-        dbc.Tab(id = 'time-series-tab', label='Graph View'),
-        dbc.Tab(id = 'data-table-tab', label='Data Table View'),
-        dbc.Tab(id = 'log-messages-tab', label='Log View'),
+    # the tab_id of each tab is what the active_tab value of the tabs is set to when it is opened
+    dbc.Tabs(id="htmltabs", active_tab='Homepage', children=[
+        dbc.Tab(id='Homepage', tab_id='Homepage', label='Homepage'),
+        dbc.Tab(id = 'time-series-tab', tab_id='time-series-tab', label='Graph View'),
+        dbc.Tab(id = 'data-table-tab', tab_id='data-table-tab', label='Data Table View'),
+        dbc.Tab(id = 'log-messages-tab', tab_id='log-messages-tab', label='Log View'),
         # These tabs rely on functions defined in external .py files 
 	# which refer to photoes etc found in the assets directory in 
 	# this folder, If you want to change the text, look in the helpApp.py and aboutApp.py file.
-        dbc.Tab(id = 'help-tab', label='Help', children=helpApp()), 
-        dbc.Tab(id = 'about-tab', label='About', children=aboutApp())
+        dbc.Tab(id = 'help-tab', tab_id='help-tab', label='Help', children=helpApp()), 
+        dbc.Tab(id = 'about-tab', tab_id='about-tab', label='About', children=aboutApp())
     ])])
 
-# This callback sets the refresh button up for refreshing the tabs specifically.
+# This callback sets the refresh button up for refreshing the data.
 # callbacks fire when you click the button 
 # this is explained in https://dash.plot.ly/getting-started-part-2
-# the output sections below tell each tab that involves data to reload the new data
+# It only fetches the new data into the caches (see sensorCache.py) and then changes the
+# data-version store, which makes the callback for the tab being looked at rebuild that tab.
+# The other tabs aren't built until they are opened.
 # The callback specification has to be immediately above the definition of the function that 
 # updates the data from the DynamoDb database
-@app.callback([Output('Homepage', 'children'),
-               Output('time-series-tab', 'children'),
-               Output('log-messages-tab', 'children'),
-               Output('data-table-tab', 'children'),
+@app.callback([Output('data-version', 'data'),
                Output('loading-output-1', 'children')
                ],
-              [Input('refresh-button', 'n_clicks')]
+              [Input('refresh-button', 'n_clicks'),
+               Input('full-reload-button', 'n_clicks')]
               )
-def updateData(n_clicks):
-        sensorData = getSensorData()
+def updateData(n_clicks, n_full_clicks):
+        # work out which button was clicked, only the Full reload button re-reads the whole table
+        fullResync = any(t['prop_id'] == 'full-reload-button.n_clicks' for t in dash.callback_context.triggered)
+        if fullResync or sensorDataCache.isLoaded():
+            # the new readings also update the latest reading for each sensor
+            getSensorData(fullResync)
+        else:
+            # the history is only read when a tab that needs it is opened, so until
+            # then just get the latest reading for each sensor for the Homepage
+            latestReadings.fetchLatest()
+        # fetch any new log messages, the log table picks them up from the cache
+        getSensorInfo(fullResync)
         #Triggers when the refresh button is hit
-        timeLastRefreshed = "Data was last refreshed at {:%H:%M:%S on %d %B, %Y}".format(datetime.now())
-        sensorInfo = getSensorInfo()
-        # updating last obtained data
-        # This also refreshes the children of each tab instead of calling them in the header function
-	# either way works, but this is faster
-	# first we get the latest timestamp for each sensorID
-        maxTimestamps = sensorData.groupby('sensorID')['timestamp'].max().reset_index() 
-	# and we use that to get the row containing the latest data for each sensorID
-        latestSensorData = pd.merge(sensorData, maxTimestamps, how='inner') 
-	# now we rebuild the content for each tab using the updated data
-        hp = homepageDisplay(latestSensorData)
-        tsg = SensorGraph(sensorData)
-        itd = infoTableDisplay(sensorInfo)
-        dlt = dataTableDisplay(sensorData)
-	# return all the chunks of content which are sent to each tab as per the Output specs
-	# in the callback bit above
-        return(hp, tsg, itd, dlt, timeLastRefreshed)
+        refreshedAt = datetime.now()
+        timeLastRefreshed = "Data was last refreshed at {:%H:%M:%S on %d %B, %Y}".format(refreshedAt)
+        return(refreshedAt.isoformat(), timeLastRefreshed)
+
+# these functions build the content of each tab from the cached data
+def buildHomepage():
+        return(homepageDisplay(latestReadings.getLatest()))
+
+def buildGraphs():
+        return(SensorGraph(sensorDataCache.getCachedData()))
+
+# This makes the callback for one tab. It fires when the data is refreshed or a different tab
+# is opened, but only rebuilds the tab if it is the one being looked at and it hasn't already
+# been built for this version of the data. The version it was built for is kept in the
+# tab's own store (see the layout above).
+def makeTabCallback(tabId, buildTab):
+    @app.callback([Output(tabId, 'children'),
+                   Output(tabId + '-version', 'data')],
+                  [Input('data-version', 'data'),
+                   Input('htmltabs', 'active_tab')],
+                  [State(tabId + '-version', 'data')])
+    def updateTab(version, active_tab, builtVersion):
+        if version is None or active_tab != tabId or version == builtVersion:
+            raise PreventUpdate
+        return(buildTab(), version)
+    return(updateTab)
+
+makeTabCallback('Homepage', buildHomepage)
+makeTabCallback('time-series-tab', buildGraphs)
+makeTabCallback('log-messages-tab', infoTableDisplay)
+makeTabCallback('data-table-tab', dataTableDisplay)
+
+# These callbacks fill in the rows of the data and log tables. They fire when the table is
+# first shown and whenever the user changes page, clicks a column to sort it or types in
+# a filter box. The filtering and sorting is done here on the server using the cached data
+# (see tablePaging.py) and only the rows for the current page are sent back.
+@app.callback([Output('sensor-data-table', 'data'),
+               Output('sensor-data-table', 'page_count')],
+              [Input('sensor-data-table', 'page_current'),
+               Input('sensor-data-table', 'page_size'),
+               Input('sensor-data-table', 'sort_by'),
+               Input('sensor-data-table', 'filter_query')])
+def updateDataTablePage(page_current, page_size, sort_by, filter_query):
+    return(tablePage(sensorDataCache.getCachedData(), page_current, page_size, sort_by, filter_query))
+
+@app.callback([Output('sensor-info-table', 'data'),
+               Output('sensor-info-table', 'page_count')],
+              [Input('sensor-info-table', 'page_current'),
+               Input('sensor-info-table', 'page_size'),
+               Input('sensor-info-table', 'sort_by'),
+               Input('sensor-info-table', 'filter_query')])
+def updateInfoTablePage(page_current, page_size, sort_by, filter_query):
+    return(tablePage(sensorInfoCache.getCachedData(), page_current, page_size, sort_by, filter_query))
+
+# This works out the date/time range the user has zoomed a graph to from the relayoutData
+# that the graph sends when it is zoomed, panned or the range slider or buttons are used.
+# Returns None when the user has zoomed back out to show everything.
+def zoomRange(relayoutData):
+    if relayoutData is None:
+        raise PreventUpdate
+    if relayoutData.get('xaxis.autorange'):
+        return(None)
+    if 'xaxis.range[0]' in relayoutData and 'xaxis.range[1]' in relayoutData:
+        return(pd.Timestamp(relayoutData['xaxis.range[0]']), pd.Timestamp(relayoutData['xaxis.range[1]']))
+    if 'xaxis.range' in relayoutData:
+        return(pd.Timestamp(relayoutData['xaxis.range'][0]), pd.Timestamp(relayoutData['xaxis.range'][1]))
+    # something else changed (e.g. the y axis), nothing to do
+    raise PreventUpdate
+
+# This makes a callback for one graph which redraws it when the user zooms in, using the
+# full resolution readings for the zoomed window. It uses the data already in the cache
+# rather than fetching anything new from the database.
+def makeZoomCallback(graphId, column, gtitle, y_label):
+    @app.callback(Output(graphId, 'figure'),
+                  [Input(graphId, 'relayoutData')])
+    def zoomGraph(relayoutData):
+        xRange = zoomRange(relayoutData)
+        return(make_graph(sensorDataCache.getCachedData(), column, gtitle, y_label, xRange))
+    return(zoomGraph)
+
+for graphId, column, gtitle, y_label in GRAPHS:
+    makeZoomCallback(graphId, column, gtitle, y_label)
 
 # finally, run the actual Dash web app
 if __name__ == '__main__':
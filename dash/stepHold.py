@@ -0,0 +1,69 @@
+"""
+name: stepHold.py
+author: Emilio Guevarra Churches
+date: October 2026
+license: see LICENSE file
+description: a sensor node using the deadband filter (rpi-sensor-node/deadband.py) only sends a
+reading when it has changed, so its rows have gaps where the reading was the same as before.
+This fills them back in with the last reading sent, so the rest of the web app sees every
+reading in every row. It is imported by the main program.
+"""
+
+##################################################
+# set-up section
+##################################################
+
+import pandas as pd # pandas library for manipulating data
+
+# the readings a node can leave out
+HELD_FIELDS = ['data.temperature', 'data.humidity', 'data.pm25', 'data.pm10',
+               'data.bmp180_temperature', 'data.bmp180_airpressure']
+
+# each row sent through the deadband filter says for how many seconds a reading left out of
+# it can be held, i.e. how long after a reading was sent it is still right. Rows without
+# a hold time (from nodes not using the filter) are never filled in.
+HOLD_COLUMN = 'data.hold'
+
+##################################################
+# filling in the held readings
+##################################################
+# For example, a node sends pm25 5.0 at 10:00 and then rows at 10:10 and 10:20 without a pm25,
+# because it hadn't moved. Both of them get pm25 5.0. If the 10:20 row had a hold time of less
+# than 20 minutes it wouldn't, as the node should have sent the pm25 again by then
+# (e.g. it stopped working properly), and the gap is left as it is.
+
+def isHeld(sensorData):
+    # True if any of the rows came through the deadband filter
+    return(HOLD_COLUMN in sensorData.columns and bool(sensorData[HOLD_COLUMN].notna().any()))
+
+def fillHeld(sensorData, previous=None):
+    """
+        Returns the dataframe (sorted newest first) with the readings left out by the deadband
+        filter filled in. previous is the data already filled in (e.g. the cached history), for
+        filling in new rows from readings sent before them.
+    """
+    if not isHeld(sensorData):
+        return(sensorData)
+    rows = sensorData.reset_index(drop=True)
+    if previous is not None and len(previous) and HOLD_COLUMN in previous.columns:
+        # the newest earlier row from each sensor is all that's needed, as it is already filled in
+        earliest = rows.groupby('sensorID')['timestamp'].min()
+        before = previous[previous['timestamp'] < previous['sensorID'].map(earliest)]
+        rows = pd.concat([rows, before.drop_duplicates('sensorID')], ignore_index=True, sort=False)
+    # put each sensor's rows in time order, keeping the row numbers so the order can be put back
+    ordered = rows.sort_values(['sensorID', 'timestamp'], kind='mergesort')
+    sensors = ordered['sensorID'].values
+    timestamps = ordered['timestamp']
+    hold = pd.to_timedelta(ordered[HOLD_COLUMN], unit='s')
+    for column in HELD_FIELDS:
+        values = ordered[column]
+        sent = values.notna()
+        # the last reading sent by the sensor, and when it was sent
+        lastValue = values.groupby(sensors).ffill()
+        lastSent = timestamps.where(sent).groupby(sensors).ffill()
+        fill = ~sent & (timestamps - lastSent <= hold)
+        if fill.any():
+            ordered.loc[fill, column] = lastValue[fill]
+    filled = ordered.sort_index().iloc[:len(sensorData)]
+    filled.index = sensorData.index
+    return(filled)
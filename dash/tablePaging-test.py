@@ -0,0 +1,51 @@
+# this is just test code, it is not part of the web app
+# it checks the filtering, sorting and paging done for the data and log tables
+# (tablePaging.py): the filter queries from the column filter boxes are split up properly,
+# numbers typed into text columns and text typed into date columns don't cause errors,
+# and the right rows end up on each page.
+# run it from the dash folder with: python3 tablePaging-test.py
+
+import pandas as pd
+from tablePaging import splitFilterPart, filterFrame, tablePage
+
+def check(name, ok):
+    print("{:60s} {}".format(name, "ok" if ok else "FAILED"))
+    if not ok:
+        raise SystemExit(1)
+
+##################################################
+# splitting the filter query
+##################################################
+
+check("column, operator and number", splitFilterPart('{data.pm25} > 20') == ('data.pm25', '>', 20.0))
+check("operators that are words", splitFilterPart('{sensorID} eq 2') == ('sensorID', '=', 2.0))
+check("quoted values are text", splitFilterPart('{message} = "20"') == ('message', '=', '20'))
+check("operators inside the value are part of it",
+      splitFilterPart('{message} contains a<=b') == ('message', 'contains', 'a<=b')
+      and splitFilterPart('{message} contains x eq y') == ('message', 'contains', 'x eq y'))
+check("not a filter part", splitFilterPart('junk') == (None, None, None)
+      and splitFilterPart('{message} containsfoo') == (None, None, None))
+
+##################################################
+# filtering
+##################################################
+
+log = pd.DataFrame({'timestamp': pd.to_datetime(['2019-07-01 10:00:00', '2019-08-01 10:00:00', '2020-01-01 10:00:00']),
+                    'message': ['a<=b', '5', 'started']})
+check("a number typed into a text column compared as text", list(filterFrame(log, '{message} = 5')['message']) == ['5']
+      and list(filterFrame(log, '{message} > 3')['message']) == ['a<=b', '5', 'started'])
+check("contains with an operator in it", list(filterFrame(log, '{message} contains <=')['message']) == ['a<=b'])
+check("dates compared as dates", list(filterFrame(log, '{timestamp} > 2019-07-15')['message']) == ['5', 'started'])
+check("datestartswith a month", list(filterFrame(log, '{timestamp} datestartswith 2019-08')['message']) == ['5'])
+check("a number typed into a date column matches nothing", len(filterFrame(log, '{timestamp} > 2019.0')) == 0)
+check("unknown columns are ignored", len(filterFrame(log, '{nothing} > 3')) == 3)
+
+##################################################
+# sorting and paging
+##################################################
+
+data = pd.DataFrame({'sensorID': [1, 2, 3, 4, 5] * 3, 'data.pm25': [float(n) for n in range(15)]})
+rows, pageCount = tablePage(data, 1, 4, [{'column_id': 'data.pm25', 'direction': 'desc'}], '{sensorID} != 5')
+check("page count after filtering", pageCount == 3)
+check("the rows for the page, sorted", [row['data.pm25'] for row in rows] == [8.0, 7.0, 6.0, 5.0])
+print("all table paging tests passed")
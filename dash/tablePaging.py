@@ -0,0 +1,131 @@
+"""
+name: tablePaging.py
+author: Emilio Guevarra Churches
+date: October 2026
+license: see LICENSE file
+description: this does the filtering, sorting and paging for the data and log tables on the
+web server, so only the 50 rows on the current page are sent to the browser instead of the
+whole history. It is imported by the main program.
+"""
+
+##################################################
+# set-up section
+##################################################
+
+import re
+import math
+import pandas as pd # pandas library for manipulating data
+
+# The filter boxes at the top of each table column send a filter query to the server like
+# {data.pm25} > 20 && {sensorID} = 2
+# Each of these operators can appear in a filter query. The first name in each list is the
+# one we use, the others mean the same thing.
+# This is based on the custom filtering example in the Dash docs https://dash.plot.ly/datatable/callbacks
+FILTER_OPERATORS = [['>=', 'ge '],
+                    ['<=', 'le '],
+                    ['<', 'lt '],
+                    ['>', 'gt '],
+                    ['!=', 'ne '],
+                    ['=', 'eq '],
+                    ['contains', 'contains '],
+                    ['datestartswith', 'datestartswith ']]
+
+# a filter part is the column name in curly brackets, then an operator, then the value.
+# Only the first operator after the column name counts, so the value can have anything in
+# it (e.g. {message} contains <=). The operators that are words need a space (or nothing) after them.
+OPERATOR_NAMES = dict((operator.strip(), operatorType[0]) for operatorType in FILTER_OPERATORS for operator in operatorType)
+FILTER_PART = re.compile(r'^\s*\{(?P<name>[^}]*)\}\s*(?P<operator>' +
+                         '|'.join(re.escape(operator) + (r'(?=\s|$)' if operator.isalpha() else '')
+                                  for operator in OPERATOR_NAMES) +
+                         r')(?P<value>.*)$')
+
+##################################################
+# functions for filtering, sorting and paging
+##################################################
+
+def splitFilterPart(filterPart):
+    # split one part of a filter query, e.g. "{data.pm25} > 20", into the column name,
+    # the operator and the value
+    match = FILTER_PART.match(filterPart)
+    if match is None:
+        return(None, None, None)
+    valuePart = match.group('value').strip()
+    v0 = valuePart[0:1]
+    if len(valuePart) > 1 and v0 == valuePart[-1] and v0 in ("'", '"', '`'):
+        # a quoted value is always text
+        value = valuePart[1: -1].replace('\\' + v0, v0)
+    else:
+        try:
+            value = float(valuePart)
+        except ValueError:
+            value = valuePart
+    return(match.group('name'), OPERATOR_NAMES[match.group('operator')], value)
+
+def dateStartsWith(column, value):
+    # true for the timestamps that start with the text typed in, e.g. "2019-07" means
+    # any time in July 2019. Rather than turning every timestamp into text, work out
+    # the period of time the text means and check which timestamps are inside it
+    try:
+        period = pd.Period(str(value).strip())
+        return((column >= period.start_time) & (column <= period.end_time))
+    except ValueError:
+        return(column.astype(str).str.startswith(str(value)))
+
+def filterFrame(df, filterQuery):
+    # apply every part of the filter query to the dataframe
+    if not filterQuery:
+        return(df)
+    for filterPart in filterQuery.split(' && '):
+        name, operator, value = splitFilterPart(filterPart)
+        if name not in df.columns:
+            continue
+        column = df[name]
+        isDate = pd.api.types.is_datetime64_any_dtype(column)
+        if operator == 'datestartswith':
+            keep = dateStartsWith(column, value) if isDate else column.astype(str).str.startswith(str(value))
+        elif operator == 'contains':
+            keep = column.astype(str).str.contains(str(value), regex=False)
+        else:
+            if isDate:
+                try:
+                    value = pd.Timestamp(str(value))
+                except ValueError:
+                    # not a date and time (e.g. just a number), so nothing can match it
+                    df = df.iloc[0:0]
+                    continue
+            elif isinstance(value, float) and (pd.api.types.is_string_dtype(column) or pd.api.types.is_object_dtype(column)):
+                # a number typed into a text column, e.g. the log messages
+                value = '{:g}'.format(value)
+            if operator == '=':
+                keep = column == value
+            elif operator == '!=':
+                keep = column != value
+            elif operator == '<':
+                keep = column < value
+            elif operator == '<=':
+                keep = column <= value
+            elif operator == '>':
+                keep = column > value
+            else:
+                keep = column >= value
+        df = df.loc[keep]
+    return(df)
+
+def sortFrame(df, sortBy):
+    # sort the dataframe by the columns the user clicked on, e.g.
+    # [{'column_id': 'data.pm25', 'direction': 'desc'}, {'column_id': 'sensorID', 'direction': 'asc'}]
+    sortBy = [s for s in (sortBy or []) if s['column_id'] in df.columns]
+    if not sortBy:
+        return(df)
+    return(df.sort_values([s['column_id'] for s in sortBy],
+                          ascending=[s['direction'] == 'asc' for s in sortBy],
+                          kind='mergesort'))
+
+def tablePage(df, pageCurrent, pageSize, sortBy, filterQuery):
+    # returns the rows for the current page of the table ready to send to the browser,
+    # and the total number of pages after filtering
+    df = sortFrame(filterFrame(df, filterQuery), sortBy)
+    pageCurrent = pageCurrent or 0
+    pageCount = max(1, int(math.ceil(len(df) / float(pageSize))))
+    page = df.iloc[pageCurrent * pageSize:(pageCurrent + 1) * pageSize]
+    return(page.to_dict('records'), pageCount)
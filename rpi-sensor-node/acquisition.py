@@ -0,0 +1,221 @@
+"""
+    Acquisition scheduler for the sensor node.
+    Each sensor device is read in its own thread at fixed times worked out from
+    time.monotonic(), so a slow read on one device (e.g. the DHT22 retrying) doesn't
+    delay the others, and the aggregation windows stay a fixed length instead of
+    drifting by the time every read takes.
+"""
+
+import logging
+import threading
+import time
+
+DEFAULT_LOGGING_LEVEL = logging.WARN
+
+
+class DeviceSample(object):
+    """
+        One reading from one device
+    """
+    __slots__ = ('device', 'number', 'deadline', 'values', 'latency')
+
+    def __init__(self, device, number, deadline, values, latency):
+        self.device = device # name of the device
+        self.number = number # count of sample intervals since the scheduler started
+        self.deadline = deadline # monotonic time the reading was due
+        self.values = values # whatever the read function returned, None if it failed
+        self.latency = latency # seconds the read took
+
+
+class AcquisitionWindow(object):
+    """
+        All the samples taken during one aggregation window
+    """
+    def __init__(self, number, start, end, devices):
+        self.number = number
+        self.start = start # monotonic time the window started
+        self.end = end # monotonic time the window ended
+        self.samples = dict((device, []) for device in devices)
+        self.missed = dict((device, 0) for device in devices) # deadlines skipped by slow reads
+
+    def values(self, device):
+        """
+            Returns the values of the successful reads from one device
+        """
+        return [s.values for s in self.samples[device] if s.values is not None]
+
+    def latencies(self, device):
+        """
+            Returns the time taken by every read from one device
+        """
+        return [s.latency for s in self.samples[device]]
+
+    def latency_report(self):
+        """
+            Returns a one line summary of the read latency of each device
+        """
+        parts = []
+        for device, samples in self.samples.items():
+            latencies = self.latencies(device)
+            if latencies:
+                parts.append("%s: %d reads (%d failed, %d missed) mean %.3fs max %.3fs" % (
+                    device, len(samples), len(samples) - len(self.values(device)),
+                    self.missed[device], sum(latencies) / len(latencies), max(latencies)))
+            else:
+                parts.append("%s: no reads (%d missed)" % (device, self.missed[device]))
+        return "; ".join(parts)
+
+
+class DeviceWorker(threading.Thread):
+    """
+        Reads one device every interval seconds, on the deadlines
+        start, start + interval, start + 2 * interval, ...
+    """
+    def __init__(self, scheduler, name, read_function, interval):
+        threading.Thread.__init__(self, name="%s reader" % name)
+        self.daemon = True
+        self.scheduler = scheduler
+        self.device = name
+        self.read_function = read_function
+        self.interval = interval
+
+    def run(self):
+        # deadlines are worked out by multiplying rather than adding the interval each time,
+        # so rounding errors can't build up
+        number = 0
+        deadline = self.scheduler.start_time
+        while not self.scheduler.stopping.is_set():
+            # wait for the next deadline (returns straight away if already past it)
+            if self.scheduler.stopping.wait(max(0.0, deadline - time.monotonic())):
+                break
+            started = time.monotonic()
+            try:
+                values = self.read_function()
+            except Exception as exp: # pylint: disable=broad-except
+                self.scheduler.logger.error("%s read failed: %s", self.device, exp)
+                values = None
+            finished = time.monotonic()
+            self.scheduler.add_sample(DeviceSample(self.device, number, deadline, values, finished - started))
+            # move on to the next deadline. If the read took longer than the interval, skip
+            # the deadlines that have already gone by rather than trying to catch up, so the
+            # readings stay on the same fixed times
+            number += 1
+            deadline = self.scheduler.start_time + number * self.interval
+            if deadline < finished:
+                missed = int((finished - deadline) // self.interval) + 1
+                self.scheduler.add_missed(self.device, number, missed)
+                number += missed
+                deadline = self.scheduler.start_time + number * self.interval
+
+
+class AcquisitionScheduler(object):
+    """
+        Runs a DeviceWorker for every device and collects their samples
+        into windows of window_samples * sample_interval seconds.
+        A sample goes in the window its deadline falls in, unless that window has
+        already been handed out by next_window() (because the read finished late),
+        in which case it goes in the oldest window still open.
+        The number of samples in each window can be changed between windows with
+        set_window_samples() (see adaptive.py).
+    """
+    def __init__(self, sample_interval=10, window_samples=20, log_level=DEFAULT_LOGGING_LEVEL):
+        self.logger = logging.getLogger("Acquisition")
+        self.logger.setLevel(log_level)
+        self.sample_interval = sample_interval
+        self.window_samples = window_samples # samples in the oldest open window
+        self.next_window_samples = window_samples # samples in the windows after it
+        self.devices = []
+        self.workers = []
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.start_time = None
+        self.windows = {} # window number -> AcquisitionWindow, for the windows still open
+        self.current = 0 # number of the oldest window still open
+        self.first_sample = 0 # sample number the oldest open window starts at
+
+    @property
+    def window_length(self):
+        # seconds in the oldest open window
+        return self.sample_interval * self.window_samples
+
+    def add_device(self, name, read_function):
+        """
+            Adds a device to be read, read_function is called with no arguments
+            and returns the reading(s), or None if the read failed
+        """
+        self.devices.append(name)
+        self.workers.append(DeviceWorker(self, name, read_function, self.sample_interval))
+
+    def set_window_samples(self, window_samples):
+        """
+            Sets the number of samples in the windows from now on. The window being
+            collected is changed too, unless it would already have ended
+        """
+        with self.lock:
+            self.next_window_samples = window_samples
+            end = self.start_time + (self.first_sample + window_samples) * self.sample_interval
+            if self.current + 1 not in self.windows and end > time.monotonic():
+                self.window_samples = window_samples
+                if self.current in self.windows:
+                    self.windows[self.current].end = end
+            elif self.current + 1 in self.windows:
+                following = self.windows[self.current + 1]
+                following.end = following.start + window_samples * self.sample_interval
+
+    def start(self):
+        """
+            Starts reading all the devices, the first window starts now
+        """
+        self.start_time = time.monotonic()
+        for worker in self.workers:
+            worker.start()
+
+    def stop(self):
+        """
+            Stops the device threads (after any read in progress finishes)
+        """
+        self.stopping.set()
+
+    def window_end(self):
+        # monotonic time the oldest open window ends
+        return self.start_time + (self.first_sample + self.window_samples) * self.sample_interval
+
+    def get_window(self, sample_number):
+        # returns the open window for a sample number, the lock must already be held.
+        # A sample due after the oldest open window goes in the one after it, as the
+        # oldest is handed out as soon as it ends
+        if sample_number < self.first_sample + self.window_samples:
+            number, start, samples = self.current, self.window_end() - self.window_length, self.window_samples
+        else:
+            number, start, samples = self.current + 1, self.window_end(), self.next_window_samples
+        if number not in self.windows:
+            self.windows[number] = AcquisitionWindow(number, start, start + samples * self.sample_interval,
+                                                     self.devices)
+        return self.windows[number]
+
+    def add_sample(self, sample):
+        with self.lock:
+            self.get_window(sample.number).samples[sample.device].append(sample)
+
+    def add_missed(self, device, sample_number, missed):
+        with self.lock:
+            self.get_window(sample_number).missed[device] += missed
+
+    def advance(self):
+        # hands out the oldest open window and moves on to the next one
+        with self.lock:
+            finished = self.get_window(self.first_sample)
+            del self.windows[self.current]
+            self.current += 1
+            self.first_sample += self.window_samples
+            self.window_samples = self.next_window_samples
+        return finished
+
+    def next_window(self):
+        """
+            Waits until the end of the oldest open window and returns it. Windows always end
+            on a whole number of sample intervals from the start, however long the caller
+            took to deal with the last one
+        """
+        self.stopping.wait(max(0.0, self.window_end() - time.monotonic()))
+        return self.advance()
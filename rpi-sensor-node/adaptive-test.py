@@ -0,0 +1,109 @@
+# this is just test code, it is not part of the Sensor node
+# it checks that the acquisition scheduler (acquisition.py) handles windows changing length,
+# and then runs the adaptive window (adaptive.py) over a week of simulated particulate
+# readings with smoke events (drivers.py), to compare the number of messages sent and
+# how finely the smoke events are seen with the fixed 20 sample windows.
+# run it from the rpi-sensor-node folder with: python3 adaptive-test.py
+
+import time
+import aggregator
+import acquisition
+import adaptive
+from drivers import SimulatedSDS011
+
+def check(name, ok):
+    print("{:60s} {}".format(name, "ok" if ok else "FAILED"))
+    if not ok:
+        raise SystemExit(1)
+
+##################################################
+# windows changing length
+##################################################
+
+SAMPLE_INTERVAL = 0.02
+scheduler = acquisition.AcquisitionScheduler(SAMPLE_INTERVAL, 10)
+scheduler.add_device("counter", lambda: (1.0,))
+scheduler.start()
+windows = []
+for length in (10, 4, 4, 15, 6, 6):
+    window = scheduler.next_window()
+    windows.append(window)
+    scheduler.set_window_samples(length)
+scheduler.stop()
+lengths = [int(round((w.end - w.start) / SAMPLE_INTERVAL)) for w in windows]
+print("    (window lengths {})".format(lengths))
+check("first window has the starting length", lengths[0] == 10)
+check("each change applies to the window being collected", lengths[1:] == [10, 4, 4, 15, 6])
+check("windows follow on from each other", all(abs(a.end - b.start) < 1e-9 for a, b in zip(windows, windows[1:])))
+check("every sample in the right window",
+      all(abs(len(w.samples["counter"]) + w.missed["counter"] - n) <= 1 for w, n in zip(windows, lengths)))
+
+##################################################
+# a simulated week
+##################################################
+
+WINDOW_SAMPLES = 20
+WEEK = 7 * 24 * 360 # samples at 10 seconds
+
+class Clock(object):
+    def __init__(self):
+        self.now = 0.0
+    def __call__(self):
+        return self.now
+
+def simulate(controller, smokeRate, seed=1):
+    # returns the number of windows, and the window lengths (in samples) while PM2.5 was high
+    clock = Clock()
+    device = SimulatedSDS011(seed=seed, clock=clock, smoke_rate=smokeRate)
+    stats = aggregator.WindowAggregator(("pm10", "pm25"), window=adaptive.DEFAULT_MAX_SAMPLES)
+    sample = windows = 0
+    length = WINDOW_SAMPLES
+    eventLengths = []
+    while sample < WEEK:
+        stats.reset()
+        for n in range(length):
+            clock.now = (sample + n) * 10
+            stats.add_values(("pm10", "pm25"), device.read())
+        sample += length
+        windows += 1
+        windowStats = stats.stats()
+        if windowStats["pm25"].median > adaptive.DEFAULT_PM25_THRESHOLD:
+            eventLengths.append(length)
+        if controller is not None:
+            length = controller.update(windowStats)
+    return windows, eventLengths
+
+started = time.perf_counter()
+# a smoky week, with a smoke event every 6 hours or so
+fixedWindows, fixedEvents = simulate(None, 0.0005)
+adaptiveWindows, adaptiveEvents = simulate(adaptive.AdaptiveWindow(WINDOW_SAMPLES), 0.0005)
+print("smoky week, fixed windows:    {:5d} messages, {:.1f} minute windows during smoke".format(
+    fixedWindows, sum(fixedEvents) / max(1, len(fixedEvents)) / 6))
+print("smoky week, adaptive windows: {:5d} messages, {:.1f} minute windows during smoke".format(
+    adaptiveWindows, sum(adaptiveEvents) / max(1, len(adaptiveEvents)) / 6))
+check("fewer messages", adaptiveWindows < fixedWindows)
+check("shorter windows during smoke", sum(adaptiveEvents) / len(adaptiveEvents) < WINDOW_SAMPLES)
+# and a week with no smoke
+quietWindows, quietEvents = simulate(adaptive.AdaptiveWindow(WINDOW_SAMPLES), 0)
+print("clean week, adaptive windows: {:5d} messages".format(quietWindows))
+print("    ({:.1f}s to simulate)".format(time.perf_counter() - started))
+check("far fewer messages when it's calm", quietWindows < fixedWindows / 2)
+
+# flat readings stretch the window up to the limit, and no further
+controller = adaptive.AdaptiveWindow(WINDOW_SAMPLES, quiet_windows=2)
+calm = {"pm25": aggregator.ChannelStats(count=20, median=5.0, mad=0.5),
+        "pm10": aggregator.ChannelStats(count=20, median=8.0, mad=0.5)}
+lengths = [controller.update(calm) for n in range(20)]
+check("calm readings stretch the window to the longest", lengths[-1] == adaptive.DEFAULT_MAX_SAMPLES)
+check("stretched only every quiet_windows windows", lengths[0] == WINDOW_SAMPLES and lengths[1] == 30)
+# one high window makes it as short as allowed straight away
+smoke = {"pm25": aggregator.ChannelStats(count=20, median=40.0, mad=0.5),
+         "pm10": aggregator.ChannelStats(count=20, median=60.0, mad=0.5)}
+check("high readings shorten the window at once", controller.update(smoke) == adaptive.DEFAULT_MIN_SAMPLES)
+# readings just under the threshold aren't calm enough to stretch it again (hysteresis)
+justUnder = {"pm25": aggregator.ChannelStats(count=6, median=20.0, mad=0.5),
+             "pm10": aggregator.ChannelStats(count=6, median=30.0, mad=0.5)}
+controller.update(justUnder) # changing fast from the smoke window
+lengths = [controller.update(justUnder) for n in range(10)]
+check("no stretching just under the threshold", lengths == [adaptive.DEFAULT_MIN_SAMPLES] * 10)
+print("all adaptive window tests passed")
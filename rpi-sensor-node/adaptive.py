@@ -0,0 +1,115 @@
+"""
+    Adaptive window length for the sensor node (sensor_run.py --adaptive).
+    With a fixed window the node sends a reading every 3 minutes 20 seconds whether the
+    air is still or there is smoke about. AdaptiveWindow looks at the particulate
+    readings at the end of each window and picks the length of the next one:
+        when PM2.5 or PM10 is above its threshold, has changed a lot since the last
+        window, or is jumping around within the window, the next window is made as
+        short as allowed straight away, so events are seen in detail
+        once the readings have been calm for a few windows in a row, the window is
+        stretched out bit by bit up to the longest allowed, so quiet periods use
+        fewer messages (and DynamoDB writes)
+    To stop it flapping between the two, the readings have to drop well below the
+    level that made the window short (by the hysteresis fraction) before they count
+    as calm again.
+"""
+
+import logging
+import math
+
+DEFAULT_LOGGING_LEVEL = logging.WARN
+
+DEFAULT_MIN_SAMPLES = 6 # Shortest window, in samples (1 minute at 10 second samples)
+DEFAULT_MAX_SAMPLES = 60 # Longest window, in samples (10 minutes)
+DEFAULT_PM25_THRESHOLD = 25.0 # micrograms per cubic metre, the Australian 24 hour PM2.5 standard
+DEFAULT_PM10_THRESHOLD = 50.0 # micrograms per cubic metre, the Australian 24 hour PM10 standard
+DEFAULT_CHANGE = 5.0 # Difference between one window's median and the next counted as changing fast
+DEFAULT_SPREAD = 5.0 # median absolute deviation within a window counted as jumping around
+DEFAULT_HYSTERESIS = 0.5 # Readings must fall this fraction below the limits above to count as calm
+DEFAULT_QUIET_WINDOWS = 3 # Calm windows in a row before the window is stretched
+DEFAULT_STRETCH = 1.5 # Each stretch makes the window this many times longer
+
+
+class AdaptiveWindow(object):
+    """
+        Picks the number of samples in the next window from the statistics
+        (aggregator.ChannelStats for "pm25" and "pm10") of the last one.
+        active is True while there is something going on, and reason says why
+        the window length last changed.
+    """
+    def __init__(self, window_samples, min_samples=DEFAULT_MIN_SAMPLES,
+                 max_samples=DEFAULT_MAX_SAMPLES, pm25_threshold=DEFAULT_PM25_THRESHOLD,
+                 pm10_threshold=DEFAULT_PM10_THRESHOLD, change=DEFAULT_CHANGE,
+                 spread=DEFAULT_SPREAD, hysteresis=DEFAULT_HYSTERESIS,
+                 quiet_windows=DEFAULT_QUIET_WINDOWS, stretch=DEFAULT_STRETCH,
+                 log_level=DEFAULT_LOGGING_LEVEL):
+        self.logger = logging.getLogger("Adaptive window")
+        self.logger.setLevel(log_level)
+        if not 0 < min_samples <= max_samples:
+            raise ValueError("the shortest window must be between 1 and the longest window")
+        self.min_samples = min_samples
+        self.max_samples = max_samples
+        self.window_samples = max(min_samples, min(window_samples, max_samples))
+        self.thresholds = {"pm25": pm25_threshold, "pm10": pm10_threshold}
+        self.change = change
+        self.spread = spread
+        self.hysteresis = hysteresis
+        self.quiet_windows = quiet_windows
+        self.stretch = stretch
+        self.active = False
+        self.quiet = 0 # calm windows in a row
+        self.previous = None # the medians from the last window
+        self.reason = "starting"
+
+    def measure(self, stats):
+        # returns the highest level compared to its threshold, the biggest change since the
+        # last window, and the most spread within the window, for PM2.5 and PM10.
+        # The median is used as a short window's mean can be thrown by a single glitch.
+        # The change isn't divided by the window length, as the medians of short windows
+        # are noisier, which would make them look like they're changing faster
+        level = change = spread = 0.0
+        means = {}
+        for channel, threshold in self.thresholds.items():
+            mean = stats[channel].median
+            if mean is None or math.isnan(mean):
+                continue
+            means[channel] = mean
+            level = max(level, mean / threshold)
+            if self.previous is not None and channel in self.previous:
+                change = max(change, abs(mean - self.previous[channel]))
+            if stats[channel].mad is not None and not math.isnan(stats[channel].mad):
+                spread = max(spread, stats[channel].mad)
+        self.previous = means
+        return level, change, spread
+
+    def update(self, stats):
+        """
+            Takes the statistics of the window that has just finished and returns
+            the number of samples for the next window
+        """
+        level, change, spread = self.measure(stats)
+        busy = level > 1 or change > self.change or spread > self.spread
+        calm_limit = 1 - self.hysteresis
+        calm = (level < calm_limit and change < self.change * calm_limit
+                and spread < self.spread * calm_limit)
+        samples = self.window_samples
+        if busy:
+            self.quiet = 0
+            if not self.active or samples != self.min_samples:
+                self.reason = "PM {:.0%} of threshold, changed {:.1f}, spread {:.1f}".format(level, change, spread)
+            self.active = True
+            samples = self.min_samples
+        elif calm:
+            self.quiet += 1
+            if self.quiet >= self.quiet_windows and samples < self.max_samples:
+                self.quiet = 0
+                self.active = False
+                samples = min(self.max_samples, int(math.ceil(samples * self.stretch)))
+                self.reason = "calm for {:d} windows".format(self.quiet_windows)
+        else:
+            # in between: keep the window as it is
+            self.quiet = 0
+        if samples != self.window_samples:
+            self.logger.info("window changed from %d to %d samples: %s", self.window_samples, samples, self.reason)
+        self.window_samples = samples
+        return samples
@@ -0,0 +1,65 @@
+# this is just test code, it is not part of the Sensor node
+# it checks the robust statistics worked out for each window (aggregator.py): the trimmed
+# mean, median and MAD, missing readings, the oldest readings being dropped when the window
+# is full, and the outliers left out of the robust mean, including when most of the readings
+# are the same (so the MAD is 0).
+# run it from the rpi-sensor-node folder with: python3 aggregator-test.py
+
+import math
+import random
+import aggregator
+
+def check(name, ok):
+    print("{:60s} {}".format(name, "ok" if ok else "FAILED"))
+    if not ok:
+        raise SystemExit(1)
+
+def channel(values, window=20):
+    readings = aggregator.ChannelAggregator(window=window)
+    for value in values:
+        readings.add(value)
+    return readings
+
+##################################################
+# the basic statistics
+##################################################
+
+readings = channel([5.0, 1.0, 4.0, None, 2.0, 3.0, float("nan")])
+check("missing readings counted, not kept", len(readings) == 5 and readings.missing == 2)
+check("median", readings.median() == 3.0)
+check("MAD", readings.mad() == 1.0)
+check("short windows lose their highest and lowest", readings.trimmed_mean() == 3.0)
+stats = readings.stats()
+check("stats", stats.count == 5 and stats.minimum == 1.0 and stats.maximum == 5.0
+      and abs(stats.mean - 3.0) < 1e-9 and abs(stats.stddev - math.sqrt(2.0)) < 1e-9)
+
+readings = channel(range(30), window=20)
+check("the oldest readings are dropped", len(readings) == 20 and readings.median() == 19.5
+      and readings.stats().minimum == 10.0)
+# the MAD is found without sorting the deviations, check it against doing just that
+random.seed(1)
+def sortedMad(values):
+    median = aggregator.median_of_sorted(sorted(values))
+    return aggregator.median_of_sorted(sorted(abs(value - median) for value in values))
+windows = [[random.choice([random.randint(0, 5), random.random() * 100]) for n in range(random.randint(1, 40))]
+           for trial in range(2000)]
+check("MAD the same as sorting the deviations", all(abs(channel(values, window=50).mad() - sortedMad(values)) < 1e-9
+                                                 for values in windows))
+check("nothing in the window", channel([]).robust_mean() == (None, 0) and channel([]).stats().count == 0)
+
+##################################################
+# outliers
+##################################################
+
+mean, outliers = channel([10.0, 11.0, 9.0, 10.5, 9.5, 10.0, 200.0]).robust_mean()
+check("a spike is an outlier", outliers == 1 and abs(mean - 10.0) < 1e-9)
+check("identical readings have no outliers", channel([10.0] * 10).robust_mean() == (10.0, 0))
+
+# more than half the readings are the same so the MAD is 0, the others are still used
+readings = channel([10] * 10 + [11, 12])
+mean, outliers = readings.robust_mean()
+check("MAD of 0", readings.mad() == 0)
+check("readings close to the rest aren't outliers when the MAD is 0", outliers < 2 and mean > 10.0)
+mean, outliers = channel([10] * 10 + [11, 50]).robust_mean()
+check("a spike is still an outlier when the MAD is 0", outliers == 1 and abs(mean - 111 / 11.0) < 1e-9)
+print("all aggregator tests passed")
@@ -0,0 +1,235 @@
+"""
+    Robust statistics for the readings taken during each window on the sensor node.
+    Each channel (e.g. humidity) keeps its readings in an array in sorted order as they
+    arrive, along with a running sum, so the trimmed mean, median, MAD, min, max and
+    standard deviation can all be had at the end of the window without sorting lists of
+    Python objects. Missing readings (None or NaN) are counted rather than stored.
+"""
+
+import bisect
+import math
+from array import array
+from collections import deque
+
+# the readings taken on every sensor node, in the order they are sent
+CHANNELS = ('humidity', 'temperature', 'bmp180_temperature', 'bmp180_airpressure', 'pm10', 'pm25')
+
+DEFAULT_WINDOW = 20 # Most readings kept for each channel, older ones are dropped
+DEFAULT_TRIM = 0.15 # Fraction of readings trimmed off each end for the trimmed mean (3 of 20)
+DEFAULT_OUTLIER_LIMIT = 3.5 # Readings further than this many (scaled) MADs from the median are outliers
+MAD_SCALE = 1.4826 # Makes the MAD comparable to a standard deviation for normally distributed readings
+MEAN_AD_SCALE = 1.2533 # The same for the mean absolute deviation, used when the MAD is 0
+
+
+def median_of_sorted(values, start=0, end=None):
+    """
+        Returns the median of values[start:end], which must already be sorted
+    """
+    if end is None:
+        end = len(values)
+    count = end - start
+    middle = start + count // 2
+    if count % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+def deviation_of_sorted(values, median, split, k):
+    """
+        Returns the k-th smallest (counting from 0) distance of the sorted values from
+        the median. The values before split are below the median, and their distances
+        get bigger going down from split, the rest get bigger going up from split.
+        Taking the k + 1 smallest distances means taking some number from below and the
+        rest from above, and that number is found with a binary search.
+    """
+    below = split # how many distances there are on each side
+    above = len(values) - split
+    low, high = max(0, k + 1 - above), min(k + 1, below)
+    while low < high:
+        taken = (low + high) // 2 # taken from below, k + 1 - taken from above
+        if median - values[split - 1 - taken] < values[split + k - taken] - median:
+            low = taken + 1 # the next one below is smaller than the last one taken above
+        else:
+            high = taken
+    largest = []
+    if low > 0:
+        largest.append(median - values[split - low])
+    if low < k + 1:
+        largest.append(values[split + k - low] - median)
+    return max(largest)
+
+class ChannelStats(object):
+    """
+        The summary of one channel's readings for a window
+    """
+    __slots__ = ('count', 'missing', 'outliers', 'mean', 'trimmed_mean', 'median',
+                 'mad', 'robust_mean', 'minimum', 'maximum', 'stddev')
+
+    def __init__(self, **values):
+        for name in self.__slots__:
+            setattr(self, name, values.get(name))
+
+    def as_dict(self):
+        return dict((name, getattr(self, name)) for name in self.__slots__)
+
+    def __str__(self):
+        if not self.count:
+            return "no readings (%d missing)" % self.missing
+        return "%d readings (%d missing, %d outliers) trimmed mean %.2f median %.2f min %.2f max %.2f sd %.2f" % (
+            self.count, self.missing, self.outliers, self.trimmed_mean, self.median,
+            self.minimum, self.maximum, self.stddev)
+
+
+class ChannelAggregator(object):
+    """
+        Keeps the last window readings of one channel. Adding a reading costs a binary
+        search and an array insert, so the window can be made much bigger (to sample
+        faster) without the cost of each reading going up much.
+    """
+    def __init__(self, window=DEFAULT_WINDOW, trim=DEFAULT_TRIM, outlier_limit=DEFAULT_OUTLIER_LIMIT):
+        self.window = window
+        self.trim = trim
+        self.outlier_limit = outlier_limit
+        self.reset()
+
+    def reset(self):
+        """
+            Forgets all the readings
+        """
+        self.sorted = array('d') # the readings in the window in ascending order
+        self.arrived = deque() # the readings in the window in the order they arrived
+        self.total = 0.0
+        self.total_squares = 0.0
+        self.missing = 0
+
+    def add(self, value):
+        """
+            Adds a reading, None or NaN counts as a missing reading
+        """
+        if value is None or value != value:
+            self.missing += 1
+            return
+        value = float(value)
+        if len(self.arrived) >= self.window:
+            # drop the oldest reading to make room
+            oldest = self.arrived.popleft()
+            del self.sorted[bisect.bisect_left(self.sorted, oldest)]
+            self.total -= oldest
+            self.total_squares -= oldest * oldest
+        self.arrived.append(value)
+        bisect.insort(self.sorted, value)
+        self.total += value
+        self.total_squares += value * value
+
+    def __len__(self):
+        return len(self.sorted)
+
+    def trimmed_mean(self):
+        """
+            Returns the mean after dropping the trim fraction of readings from each end
+        """
+        values = self.sorted
+        cut = int(len(values) * self.trim)
+        if self.trim > 0 and cut == 0 and len(values) >= 3:
+            cut = 1 # short windows still lose their highest and lowest readings
+        if len(values) - 2 * cut <= 0:
+            return None
+        return math.fsum(values[cut:len(values) - cut]) / (len(values) - 2 * cut)
+
+    def median(self):
+        if not self.sorted:
+            return None
+        return median_of_sorted(self.sorted)
+
+    def mad(self):
+        """
+            Returns the median absolute deviation from the median. Going out from the
+            median in the sorted readings, the deviations get bigger in both directions,
+            so they are two sorted lists already and the middle one of them both can be
+            found with a binary search, without working out or sorting all the deviations.
+        """
+        values = self.sorted
+        count = len(values)
+        if not count:
+            return None
+        median = self.median()
+        split = bisect.bisect_left(values, median)
+        if count % 2:
+            return deviation_of_sorted(values, median, split, count // 2)
+        return (deviation_of_sorted(values, median, split, count // 2 - 1) +
+                deviation_of_sorted(values, median, split, count // 2)) / 2.0
+
+    def robust_mean(self):
+        """
+            Returns the mean of the readings that aren't outliers, and the number of
+            outliers. A reading is an outlier if it's more than outlier_limit scaled
+            MADs from the median. As the readings are sorted, the ones that are kept
+            are a single slice found with two binary searches.
+            When more than half the readings are the same the MAD is 0, which would make
+            every other reading an outlier, so the (scaled) mean absolute deviation from
+            the median is used instead.
+        """
+        if not self.sorted:
+            return None, 0
+        median = self.median()
+        spread = MAD_SCALE * self.mad()
+        if spread == 0:
+            spread = MEAN_AD_SCALE * math.fsum(abs(value - median) for value in self.sorted) / len(self.sorted)
+        limit = self.outlier_limit * spread
+        low = bisect.bisect_left(self.sorted, median - limit)
+        high = bisect.bisect_right(self.sorted, median + limit)
+        return math.fsum(self.sorted[low:high]) / (high - low), len(self.sorted) - (high - low)
+
+    def stats(self):
+        """
+            Returns a ChannelStats with all the statistics for the readings in the window
+        """
+        count = len(self.sorted)
+        if not count:
+            return ChannelStats(count=0, missing=self.missing, outliers=0)
+        mean = self.total / count
+        variance = max(0.0, self.total_squares / count - mean * mean)
+        robust_mean, outliers = self.robust_mean()
+        return ChannelStats(count=count, missing=self.missing, outliers=outliers,
+                            mean=mean, trimmed_mean=self.trimmed_mean(), median=self.median(),
+                            mad=self.mad(), robust_mean=robust_mean,
+                            minimum=self.sorted[0], maximum=self.sorted[-1],
+                            stddev=math.sqrt(variance))
+
+
+class WindowAggregator(object):
+    """
+        A ChannelAggregator for each of the channels
+    """
+    def __init__(self, channels=CHANNELS, window=DEFAULT_WINDOW, trim=DEFAULT_TRIM,
+                 outlier_limit=DEFAULT_OUTLIER_LIMIT):
+        self.channels = dict((channel, ChannelAggregator(window, trim, outlier_limit)) for channel in channels)
+
+    def add(self, channel, value):
+        self.channels[channel].add(value)
+
+    def add_values(self, channels, values):
+        """
+            Adds one reading for each of the channels named, values is a tuple in the
+            same order, or None if the whole reading failed
+        """
+        if values is None:
+            values = (None,) * len(channels)
+        for channel, value in zip(channels, values):
+            self.channels[channel].add(value)
+
+    def reset(self):
+        for aggregator in self.channels.values():
+            aggregator.reset()
+
+    def stats(self):
+        """
+            Returns a dictionary of ChannelStats, one for each channel
+        """
+        return dict((channel, aggregator.stats()) for channel, aggregator in self.channels.items())
+
+    def min_count(self):
+        """
+            Returns the smallest number of good readings in any channel
+        """
+        return min(len(aggregator) for aggregator in self.channels.values())
@@ -0,0 +1,119 @@
+# this is just test code, it is not part of the Sensor node
+# it checks the asyncio main loop (asyncnode.py) with simulated devices (drivers.py), a
+# device that hangs, and a pretend Honeywell sensor on a pseudo-terminal
+# (honeywell_emulator.py), with the timetable sped up 100 times. It checks the windows
+# come out on time, a hung device doesn't hold up the others, the CPU use while waiting
+# is low, and that stopping is quick.
+# needs Linux and pyserial. Run it from the rpi-sensor-node folder with: python3 asyncnode-test.py
+
+import time
+import asyncio
+import logging
+import threading
+import drivers
+import asyncnode
+from honeywell import Honeywell
+from honeywell_emulator import HoneywellEmulator
+
+SAMPLE_INTERVAL = 0.1 # 100 times faster than sensor_run.py
+WINDOW_SAMPLES = 20
+
+# the hung device is logged as timing out, which is done on purpose
+logging.getLogger("Async acquisition").disabled = True
+
+def check(name, ok):
+    print("{:60s} {}".format(name, "ok" if ok else "FAILED"))
+    if not ok:
+        raise SystemExit(1)
+
+class HungDevice(object):
+    """
+        A device whose reads sometimes take far longer than the read timeout
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reads = 0
+        self.overlapping = 0 # reads started while another was still going
+
+    def read(self):
+        if not self.lock.acquire(blocking=False):
+            self.overlapping += 1
+            return None
+        try:
+            self.reads += 1
+            if self.reads % 5 == 0:
+                time.sleep(SAMPLE_INTERVAL * 8)
+            return (1.0,)
+        finally:
+            self.lock.release()
+
+emulator = HoneywellEmulator(period=SAMPLE_INTERVAL / 2)
+emulator.start_process()
+sensor = Honeywell(port=emulator.port)
+sensor.start_measuring()
+
+dht = drivers.make_driver('DHT22', simulate=True, seed=1)
+bmp = drivers.make_driver('BMP180', simulate=True, seed=1)
+hung = HungDevice()
+
+scheduler = asyncnode.AsyncAcquisition(SAMPLE_INTERVAL, WINDOW_SAMPLES, read_timeout=SAMPLE_INTERVAL * 2)
+scheduler.add_device("DHT22", dht.read)
+scheduler.add_device("BMP180", bmp.read)
+scheduler.add_device("hung", hung.read)
+scheduler.add_serial_device("particulates", sensor)
+
+windows = []
+def handleWindow(window):
+    windows.append((time.monotonic(), window))
+
+# stop after 5 windows, timing how long stopping takes
+loop = scheduler.loop
+stopAsked = []
+def stopAfter():
+    stopAsked.append(time.monotonic())
+    main.cancel()
+main = loop.create_task(scheduler.process_windows(handleWindow))
+loop.call_later(SAMPLE_INTERVAL * WINDOW_SAMPLES * 5.5, stopAfter)
+asyncio.set_event_loop(loop)
+try:
+    loop.run_until_complete(main)
+except asyncio.CancelledError:
+    pass
+stopped = time.monotonic()
+sensor.stop_measuring()
+emulator.close()
+
+check("5 windows", len(windows) == 5)
+late = max(abs(t - (scheduler.start_time + (w.number + 1) * SAMPLE_INTERVAL * WINDOW_SAMPLES)) for t, w in windows)
+print("    (windows handed out at most {:.1f} ms late)".format(late * 1000))
+check("windows end on time", late < SAMPLE_INTERVAL / 2)
+for device in ("DHT22", "BMP180", "particulates"):
+    counts = [len(w.samples[device]) for t, w in windows]
+    check("{:s} read every sample interval".format(device), min(counts) >= WINDOW_SAMPLES - 1)
+particulates = [s.values for t, w in windows for s in w.samples["particulates"]]
+check("Honeywell packets read by the event loop", sum(v is not None for v in particulates) >= len(particulates) - 1)
+hungSamples = sum(len(w.samples["hung"]) for t, w in windows)
+hungMissed = sum(w.missed["hung"] for t, w in windows)
+print("    (hung device: {:d} reads, {:d} deadlines missed while a read was still going)".format(hungSamples, hungMissed))
+check("hung device's deadlines counted as missed", hungMissed > 0)
+check("hung device never read twice at once", hung.overlapping == 0)
+print("    (stopped {:.1f} ms after being asked)".format((stopped - stopAsked[0]) * 1000))
+check("stops quickly", stopped - stopAsked[0] < SAMPLE_INTERVAL)
+
+# the CPU use while there's nothing to do, at the real 10 second sample interval
+scheduler = asyncnode.AsyncAcquisition(10, WINDOW_SAMPLES)
+scheduler.add_device("DHT22", dht.read)
+scheduler.add_device("BMP180", bmp.read)
+loop = scheduler.loop
+asyncio.set_event_loop(loop)
+main = loop.create_task(scheduler.process_windows(handleWindow))
+loop.call_later(3, main.cancel)
+cpu = time.process_time()
+try:
+    loop.run_until_complete(main)
+except asyncio.CancelledError:
+    pass
+cpu = time.process_time() - cpu
+print("    ({:.1f} ms of CPU in 3 seconds waiting between readings)".format(cpu * 1000))
+check("low CPU use while waiting", cpu < 0.1)
+print("all asyncio tests passed")
@@ -0,0 +1,224 @@
+"""
+    Asyncio version of the sensor node's main loop, used by sensor_run.py --asyncio.
+    Instead of a thread per device (acquisition.py), one event loop runs everything
+    as tasks:
+        a task for each device reads it on the same fixed timetable as acquisition.py.
+        Reads that block (the DHT22 and BMP180 libraries, SDS011 queries) run in a
+        thread pool with a timeout, so the event loop itself never waits on them.
+        The Honeywell sends a packet every second by itself, so its serial port is
+        watched by the event loop instead and each packet is parsed as it arrives;
+        reading it uses the packets received since the last read.
+        a task collects the samples into windows and hands each window to a function
+        (run in the thread pool, as publishing saves to the SD card) to be published.
+    Stopping (SIGTERM or Ctrl-C) cancels all the tasks straight away, without waiting
+    for a sleep or a read to finish. A read still running in the thread pool is left to
+    finish by itself.
+    Only asyncio features from Python 3.5 are used, as that is what Raspbian Stretch has.
+"""
+
+import asyncio
+import concurrent.futures
+import logging
+import os
+import signal
+import time
+import acquisition
+import honeywell
+
+DEFAULT_LOGGING_LEVEL = logging.WARN
+
+DEFAULT_READ_TIMEOUT = 30 # Longest to wait for a device read, the DHT22 can retry for 30 seconds
+SERIAL_READ_SIZE = 4096
+
+
+class PacketReader(object):
+    """
+        Reads the packets a Honeywell sensor (honeywell.Honeywell) sends, from the
+        event loop. The serial port is opened non-blocking by pyserial, so whatever
+        has arrived is read as soon as the event loop sees it is there. Like
+        drivers.HoneywellDriver, a read uses every packet received since the last one.
+    """
+    def __init__(self, sensor, loop):
+        self.sensor = sensor
+        self.loop = loop
+        self.fd = sensor.serial.fileno()
+        self.pending = [] # the HoneywellReadings received since the last read
+        self.waiters = [] # futures waiting for the next packet
+
+    def start(self):
+        # the event loop reads the serial port instead of a background thread
+        self.sensor.stop_background()
+        self.sensor.parser.clear()
+        self.loop.add_reader(self.fd, self.data_received)
+
+    def stop(self):
+        self.loop.remove_reader(self.fd)
+
+    def data_received(self):
+        try:
+            data = os.read(self.fd, SERIAL_READ_SIZE)
+        except BlockingIOError:
+            return
+        self.sensor.parser.feed(data)
+        self.pending.extend(self.sensor.parser.readings())
+        if self.pending and self.waiters:
+            waiters, self.waiters = self.waiters, []
+            for waiter in waiters:
+                if not waiter.done():
+                    waiter.set_result(None)
+
+    async def read(self):
+        """
+            Returns the median (pm10, pm25) of the packets received since the last
+            read, waiting for the next packet if there haven't been any
+        """
+        if not self.pending:
+            waiter = asyncio.Future(loop=self.loop)
+            self.waiters.append(waiter)
+            await waiter
+        readings, self.pending = self.pending, []
+        stats = honeywell.BackgroundReader.stats(readings)
+        return stats["pm10"].median, stats["pm25"].median
+
+
+class AsyncAcquisition(acquisition.AcquisitionScheduler):
+    """
+        The acquisition scheduler run as asyncio tasks on one event loop. Samples
+        are collected into windows in exactly the same way as AcquisitionScheduler.
+        A device whose read is still running when the next one is due (because it
+        timed out and is still going in the thread pool) has that deadline counted as
+        missed, so a device is never read by two threads at once.
+    """
+    def __init__(self, sample_interval=10, window_samples=20, read_timeout=DEFAULT_READ_TIMEOUT,
+                 loop=None, log_level=DEFAULT_LOGGING_LEVEL):
+        acquisition.AcquisitionScheduler.__init__(self, sample_interval, window_samples, log_level)
+        self.logger = logging.getLogger("Async acquisition")
+        self.logger.setLevel(log_level)
+        self.read_timeout = read_timeout
+        self.loop = loop or asyncio.new_event_loop()
+        self.readers = [] # (device name, function returning an awaitable reading)
+        self.packet_readers = []
+        self.executor = None
+        self.tasks = []
+
+    def add_device(self, name, read_function):
+        """
+            Adds a device whose read_function blocks, it is run in the thread pool
+        """
+        self.devices.append(name)
+        self.readers.append((name, lambda: self.loop.run_in_executor(self.executor, read_function)))
+
+    def add_serial_device(self, name, sensor):
+        """
+            Adds a Honeywell sensor (honeywell.Honeywell, already measuring)
+            whose serial port is read by the event loop
+        """
+        packets = PacketReader(sensor, self.loop)
+        self.devices.append(name)
+        self.packet_readers.append(packets)
+        self.readers.append((name, packets.read))
+
+    async def read_device(self, name, read):
+        # the same timetable as acquisition.DeviceWorker.run()
+        number = 0
+        running = None # the read in progress
+        while True:
+            deadline = self.start_time + number * self.sample_interval
+            await asyncio.sleep(max(0.0, deadline - time.monotonic()))
+            if running is not None and not running.done():
+                self.add_missed(name, number, 1) # the last read still hasn't finished
+                number += 1
+                continue
+            started = time.monotonic()
+            running = asyncio.ensure_future(read(), loop=self.loop)
+            try:
+                # shield() so a timeout doesn't cancel the read itself, it may be running in a thread
+                values = await asyncio.wait_for(asyncio.shield(running), self.read_timeout)
+            except asyncio.TimeoutError:
+                self.logger.error("%s read timed out after %.0fs", name, self.read_timeout)
+                values = None
+            except asyncio.CancelledError:
+                running.cancel()
+                raise
+            except Exception as exp: # pylint: disable=broad-except
+                self.logger.error("%s read failed: %s", name, exp)
+                values = None
+            finished = time.monotonic()
+            self.add_sample(acquisition.DeviceSample(name, number, deadline, values, finished - started))
+            number += 1
+            deadline = self.start_time + number * self.sample_interval
+            if deadline < finished:
+                missed = int((finished - deadline) // self.sample_interval) + 1
+                self.add_missed(name, number, missed)
+                number += missed
+
+    def start(self):
+        """
+            Starts a task reading each device, the first window starts now
+        """
+        # one thread for each device that blocks, and one for dealing with the windows
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=len(self.readers) + 1)
+        for packets in self.packet_readers:
+            packets.start()
+        self.start_time = time.monotonic()
+        self.tasks = [self.loop.create_task(self.read_device(name, read)) for name, read in self.readers]
+
+    async def stop(self):
+        """
+            Cancels the device tasks and waits for them to finish cancelling
+        """
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+        for packets in self.packet_readers:
+            packets.stop()
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+            self.executor = None
+
+    async def next_window(self):
+        """
+            Waits until the end of the oldest open window and returns it
+        """
+        await asyncio.sleep(max(0.0, self.window_end() - time.monotonic()))
+        return self.advance()
+
+    async def process_windows(self, handle_window):
+        """
+            Reads the devices and calls handle_window(window) in the thread pool
+            for every window, until cancelled
+        """
+        self.start()
+        try:
+            while True:
+                window = await self.next_window()
+                handled = self.loop.run_in_executor(self.executor, handle_window, window)
+                try:
+                    await asyncio.shield(handled)
+                except asyncio.CancelledError:
+                    # let the window finish being published before stopping, so it
+                    # isn't added to a batch after the batch has been sent
+                    await handled
+                    raise
+        finally:
+            await self.stop()
+
+
+def run(scheduler, handle_window):
+    """
+        Runs an AsyncAcquisition until SIGTERM or SIGINT, or handle_window raises
+        an exception (which is passed on)
+    """
+    loop = scheduler.loop
+    asyncio.set_event_loop(loop)
+    main = loop.create_task(scheduler.process_windows(handle_window))
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signum, main.cancel)
+    try:
+        loop.run_until_complete(main)
+    except asyncio.CancelledError:
+        pass
+    finally:
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            loop.remove_signal_handler(signum)
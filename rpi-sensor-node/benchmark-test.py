@@ -0,0 +1,200 @@
+# this is just test code, it is not part of the Sensor node
+# it times how fast the Honeywell driver can pick the data packets out of the bytes
+# coming from the serial port, using a pretend serial port that plays back a recorded
+# byte stream, so it can be run on a laptop without the sensor plugged in.
+# run it from the rpi-sensor-node folder with: python3 benchmark-test.py [recording.bin]
+# if no recording is given a stream with some noise and corrupted packets is made up
+
+import sys
+import time
+import datetime
+import random
+import logging
+import honeywell
+
+##################################################
+# a pretend serial port and byte stream
+##################################################
+
+class FakeSerial(object):
+    """
+        Plays back a recorded byte stream, behaving like the parts
+        of the pyserial Serial class the Honeywell driver uses.
+        chunk is how many bytes arrive between reads
+    """
+    def __init__(self, data, chunk=64):
+        self.data = data
+        self.position = 0
+        self.arrived = 0
+        self.chunk = chunk
+        self.calls = 0 # every read is a system call on the real serial port
+
+    @property
+    def in_waiting(self):
+        # a few more bytes arrive every time the driver looks
+        self.arrived = min(len(self.data), self.arrived + self.chunk)
+        return self.arrived - self.position
+
+    def read(self, size=1):
+        self.calls += 1
+        data = self.data[self.position:self.position + size]
+        self.position += len(data)
+        self.arrived = max(self.arrived, self.position)
+        return data
+
+    def flush(self):
+        pass
+
+    def finished(self):
+        return self.position >= len(self.data)
+
+def makeFrame(pm25, pm10):
+    # a packet like the sensor sends in auto-send mode
+    frame = bytearray(honeywell.MSG_HEADER + b'\x00\x1c')
+    frame += bytes([0, 0, pm25 >> 8, pm25 & 0xff, pm10 >> 8, pm10 & 0xff])
+    frame += bytes(30 - len(frame))
+    checksum = sum(frame)
+    frame += bytes([checksum >> 8, checksum & 0xff])
+    return bytes(frame)
+
+def makeStream(frames=20000, corruptEvery=50, noiseEvery=20):
+    # returns a byte stream and the number of good packets in it
+    random.seed(1)
+    stream = bytearray(b'\x4d\x00\x42') # the end of a packet from before the port was opened
+    good = 0
+    for i in range(frames):
+        frame = bytearray(makeFrame(random.randint(0, 500), random.randint(0, 800)))
+        if i % corruptEvery == 0:
+            frame[random.randint(4, 29)] ^= 0xff # a flipped byte fails the checksum
+        else:
+            good += 1
+        stream += frame
+        if i % noiseEvery == 0:
+            stream += bytes(random.randint(0, 255) for n in range(random.randint(1, 10)))
+    return bytes(stream), good
+
+##################################################
+# the old way, one byte at a time
+##################################################
+
+def oldRead(serial):
+    # the packet search from the previous version of Honeywell.read(), which reads
+    # a byte at a time looking for the header then reads the other 30 bytes
+    while not serial.finished():
+        inp = serial.read()
+        if inp == honeywell.MSG_CHAR_1:
+            recv = inp
+            inp = serial.read()
+            if inp == honeywell.MSG_CHAR_2:
+                recv += inp
+                recv += serial.read(30)
+                if len(recv) == honeywell.MSG_LENGTH and honeywell.FrameParser.checksum_ok(recv):
+                    return recv
+    return None
+
+##################################################
+# the benchmarks
+##################################################
+
+def timeOld(stream):
+    serial = FakeSerial(stream)
+    found = 0
+    started = time.perf_counter()
+    while oldRead(serial) is not None:
+        found += 1
+    return found, time.perf_counter() - started, serial.calls
+
+def timeNew(stream, chunk):
+    serial = FakeSerial(stream, chunk)
+    parser = honeywell.FrameParser(logger=logging.getLogger("benchmark"))
+    found = 0
+    started = time.perf_counter()
+    while not serial.finished():
+        parser.feed(serial.read(parser.read_size(serial.in_waiting)))
+        for reading in parser.readings():
+            found += 1
+    return found, time.perf_counter() - started, serial.calls, parser
+
+def oldDecode(frame):
+    # what used to happen to each packet: the reading object made a text timestamp,
+    # then sensor_run.py turned it into text and split it up again
+    timestamp = datetime.datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
+    line = "%s,%s,%s" % (timestamp, round(frame[8] * 256 + frame[9], 1), round(frame[6] * 256 + frame[7], 1))
+    pm_ts_utc, pm10, pm25 = line.split(",")
+    return float(pm10), float(pm25)
+
+def newDecode(frame):
+    reading = honeywell.HoneywellReading.from_buffer(frame)
+    return reading.pm10, reading.pm25
+
+def timeDecode(decode, frames):
+    started = time.perf_counter()
+    for frame in frames:
+        decode(frame)
+    return len(frames) / (time.perf_counter() - started)
+
+# the checksum failures are expected, so don't print them all
+logging.getLogger("benchmark").setLevel(logging.CRITICAL)
+
+if len(sys.argv) > 1:
+    with open(sys.argv[1], 'rb') as f:
+        stream = f.read()
+    good = None
+else:
+    stream, good = makeStream()
+print("{:d} bytes in stream, {} good packets".format(len(stream), good if good is not None else "unknown"))
+
+# the time on a laptop doesn't include the system call each serial port read makes on the
+# Pi, so the number of reads per packet is shown as well
+found, seconds, calls = timeOld(stream)
+print("byte at a time:  {:6d} packets in {:.3f}s, {:9.0f} packets/s, {:5.1f} reads/packet".format(
+    found, seconds, found / seconds, calls / found))
+for chunk in (32, 256, 4096):
+    found, seconds, calls, parser = timeNew(stream, chunk)
+    print("buffered ({:4d}): {:6d} packets in {:.3f}s, {:9.0f} packets/s, {:5.1f} reads/packet ({:d} checksum failures, {:d} bytes skipped)".format(
+        chunk, found, seconds, found / seconds, calls / found, parser.checksum_failures, parser.bytes_skipped))
+
+# turning the packets into numbers
+parser = honeywell.FrameParser(logger=logging.getLogger("benchmark"))
+parser.feed(stream[:honeywell.MAX_BUFFER])
+frames = list(parser.frames()) * 200
+oldRate = timeDecode(oldDecode, frames)
+newRate = timeDecode(newDecode, frames)
+assert oldDecode(frames[0]) == newDecode(frames[0])
+print("decoding packets: text {:9.0f} packets/s, struct {:9.0f} packets/s".format(oldRate, newRate))
+
+##################################################
+# data message size and encoding speed
+##################################################
+# compares the JSON data messages with the packed binary ones (see packing.py)
+
+import publisher
+
+def makeRecords(count):
+    random.seed(1)
+    return [{"timestamp": "2019-07-01 10:{:02d}:{:02d}".format(i // 60 % 60, i % 60),
+             "temperature": random.uniform(5, 35), "humidity": random.uniform(20, 90),
+             "pm25": random.uniform(0, 60), "pm10": random.uniform(0, 90),
+             "bmp180_temperature": random.uniform(5, 35), "bmp180_airpressure": random.uniform(99000, 103000)}
+            for i in range(count)]
+
+def oldPayload(r):
+    # the message as sensor_run.py used to format it
+    return '{{"sensor":"{:s}","timestamp":"{:s}","temperature":{:f},"humidity":{:f},"pm25":{:f},"pm10":{:f},"bmp180_temperature":{:f},"bmp180_airpressure":{:f}}}'.format(
+        "1", r["timestamp"], r["temperature"], r["humidity"], r["pm25"], r["pm10"], r["bmp180_temperature"], r["bmp180_airpressure"])
+
+records = makeRecords(20000)
+print("data messages ({:d} windows):".format(len(records)))
+started = time.perf_counter()
+size = sum(len(oldPayload(r)) for r in records)
+print("  {:24s} {:5.0f} bytes per reading, {:9.0f} readings/s encoded".format(
+    "old JSON", size / len(records), len(records) / (time.perf_counter() - started)))
+for encoding in publisher.ENCODINGS:
+    for windows in (1, 20):
+        batcher = publisher.BatchPublisher(None, "1", encoding=encoding, batch_windows=windows)
+        started = time.perf_counter()
+        size = 0
+        for first in range(0, len(records), windows):
+            size += len(batcher.payload(records[first:first + windows]))
+        print("  {:24s} {:5.0f} bytes per reading, {:9.0f} readings/s encoded".format(
+            "{:s}, {:d} per message".format(encoding, windows), size / len(records), len(records) / (time.perf_counter() - started)))
@@ -0,0 +1,239 @@
+# this is just test code, it is not part of the Sensor node
+# it checks the deadband filter (deadband.py) and measures how many fewer messages a sensor
+# node sends with it, on a week of simulated readings (drivers.py) or on readings recorded by
+# a real node. The messages are then decoded and filled in by the dashboard's code
+# (dash/dynamoDecoder.py and dash/stepHold.py) to check every window's readings come back
+# to within the deadband, for both the JSON and the packed encodings.
+# run it from the rpi-sensor-node folder with: python3 deadband-test.py
+# or with recorded readings, e.g. the data table saved from the dashboard as a CSV file with a
+# timestamp column and a column for each measurement (with or without "data." in front):
+# python3 deadband-test.py --csv sensor1.csv
+# the dashboard part needs pandas and numpy (pip3 install -r ../dash/requirements.txt)
+
+import os
+import sys
+import csv
+import json
+import time
+import base64
+import argparse
+import datetime
+import aggregator
+import deadband
+import drivers
+import packing
+import publisher
+
+SAMPLE_INTERVAL = 10 # seconds between readings, as in sensor_run.py
+WINDOW_SAMPLES = 20 # readings in each window, as in sensor_run.py
+MIN_READINGS = 6 # as in sensor_run.py
+START_TIME = datetime.datetime(2019, 7, 1)
+# the dashboard shows the air pressure in hPa, it is sent in Pa
+HPA = 100.0
+
+def check(name, ok):
+    print("{:60s} {}".format(name, "ok" if ok else "FAILED"))
+    if not ok:
+        raise SystemExit(1)
+
+class Clock(object):
+    def __init__(self):
+        self.now = 0.0
+    def __call__(self):
+        return self.now
+
+def timestampAt(seconds):
+    return '{:%Y-%m-%d %H:%M:%S}'.format(START_TIME + datetime.timedelta(seconds=seconds))
+
+##################################################
+# the filter on its own
+##################################################
+
+clock = Clock()
+limits = deadband.DeadbandFilter(clock=clock, heartbeat=600)
+first = dict(zip(aggregator.CHANNELS, (50.0, 20.0, 20.0, 101325.0, 8.0, 5.0)), timestamp=timestampAt(0))
+sent = limits.filter(first)
+check("first window sends every reading", set(sent) == set(first) | {"hold"})
+clock.now = 200
+check("nothing sent when nothing has changed", limits.filter(dict(first, timestamp=timestampAt(200))) is None)
+clock.now = 400
+sent = limits.filter(dict(first, pm25=5.9, temperature=20.5, timestamp=timestampAt(400)))
+check("only the readings outside their deadband are sent", set(sent) == {"timestamp", "temperature", "hold"})
+clock.now = 600
+sent = limits.filter(dict(first, timestamp=timestampAt(600)))
+check("heartbeat sends every reading", set(sent) == set(first) | {"hold"})
+clock.now = 800
+# the PM2.5 deadband is 10% of the last value once that is more than 1
+limits.last["pm25"] = 100.0
+check("relative deadband", limits.filter(dict(first, pm25=109.0, timestamp=timestampAt(800))) is None
+      and "pm25" in limits.filter(dict(first, pm25=111.0, timestamp=timestampAt(1000))))
+
+def rejected(text):
+    try:
+        deadband.parse_limit(text)
+    except ValueError:
+        return True
+    return False
+
+check("--deadband-limit parsed", deadband.parse_limit("pm25=2,0.2") == ("pm25", (2.0, 0.2))
+      and deadband.parse_limit("humidity=3") == ("humidity", (3.0, 0.0)))
+check("bad --deadband-limit rejected", all(rejected(text) for text in ("pm1=1", "pm25", "pm25=1,2,3", "pm25=-1")))
+
+# the packed encoding keeps the hold time, and doesn't change for records without one
+held = packing.decode(packing.encode([{"timestamp": timestampAt(0), "pm25": 5.0, "hold": 3000}]))
+check("packed records keep the hold time", held[0]["hold"] == 3000 and held[0]["pm25"] == 5.0)
+plain = packing.encode([dict(first)])
+check("packed records without a hold time are still version 1",
+      plain[0] == packing.PACKED_VERSION and len(plain) == packing.HEADER.size + packing.RECORD.size)
+
+##################################################
+# the windows to send
+##################################################
+
+def simulatedWindows(days, seed):
+    # the trimmed means of each window from simulated devices, like fleet-test.py's VirtualNode,
+    # as a list of (seconds since the start, record)
+    clock = Clock()
+    devices = drivers.make_drivers('Honeywell', simulate=True, seed=seed,
+                                   clock=lambda: (START_TIME - datetime.datetime(1970, 1, 1)).total_seconds() + clock.now)
+    stats = aggregator.WindowAggregator(aggregator.CHANNELS, window=WINDOW_SAMPLES, trim=0.15)
+    windows = []
+    for sample in range(int(days * 86400 / SAMPLE_INTERVAL)):
+        clock.now = sample * SAMPLE_INTERVAL
+        for device in devices:
+            stats.add_values(device.channels, device.read())
+        if sample % WINDOW_SAMPLES == WINDOW_SAMPLES - 1:
+            windowStats = stats.stats()
+            enough = stats.min_count() > MIN_READINGS
+            stats.reset()
+            if enough:
+                record = dict((channel, windowStats[channel].trimmed_mean) for channel in aggregator.CHANNELS)
+                record["timestamp"] = timestampAt(clock.now)
+                windows.append((clock.now, record))
+    return windows
+
+def recordedWindows(path):
+    # the readings from a CSV file, oldest first. The dashboard's air pressure is in hPa,
+    # so it is turned back into Pa, as the node sends it
+    windows = []
+    with open(path) as csvFile:
+        for row in csv.DictReader(csvFile):
+            row = dict((name.replace("data.", "", 1), value) for name, value in row.items())
+            timestamp = row["timestamp"][:19]
+            record = {"timestamp": timestamp}
+            for channel in aggregator.CHANNELS:
+                if row.get(channel) not in (None, "", "nan", "NaN"):
+                    record[channel] = float(row[channel])
+            if "bmp180_airpressure" in record and record["bmp180_airpressure"] < 2000:
+                record["bmp180_airpressure"] *= HPA
+            windows.append((packing.timestamp_seconds(timestamp), record))
+    windows.sort(key=lambda window: window[0])
+    start = windows[0][0] if windows else 0
+    return [(seconds - start, record) for seconds, record in windows]
+
+##################################################
+# the messages sent with and without the filter
+##################################################
+
+class Broker(object):
+    """
+        Keeps the messages published, as DynamoDB items like the AWS IoT rules make
+    """
+    def __init__(self):
+        self.items = []
+        self.bytes = 0
+
+    def publishAsync(self, topic, payload, qos=1, ackCallback=None):
+        self.bytes += len(payload)
+        if topic.startswith("sensors/packed/"):
+            data = {"packed": {"S": base64.b64encode(payload).decode()}}
+            timestamp = packing.topic_key(topic)[1]
+        else:
+            message = json.loads(payload)
+            timestamp = message["timestamp"]
+            data = dict((name, {"N": repr(value)} if isinstance(value, (int, float)) else {"S": str(value)})
+                        for name, value in message.items())
+        self.items.append({"sensorID": {"S": "1"}, "timestamp": {"S": timestamp}, "data": {"M": data}})
+
+def publish(windows, encoding, filterWindows):
+    # returns the broker holding what was published, and the filter used (if any)
+    broker = Broker()
+    sender = publisher.BatchPublisher(broker, "1", encoding=encoding)
+    clock = Clock()
+    windowFilter = deadband.DeadbandFilter(clock=clock, max_window=SAMPLE_INTERVAL * WINDOW_SAMPLES) if filterWindows else None
+    for seconds, record in windows:
+        clock.now = seconds
+        if windowFilter is not None:
+            record = windowFilter.filter(record)
+            if record is None:
+                continue
+        sender.add(record)
+    sender.flush()
+    return broker, windowFilter
+
+def reconstruct(items):
+    # what the dashboard makes of the items: decoded, with the held readings filled in
+    # (the air pressure is left in Pa, to compare with what was sent)
+    dashDir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "dash")
+    if dashDir not in sys.path:
+        sys.path.insert(0, dashDir)
+    from dynamoDecoder import decodeItems, SENSOR_DATA_COLUMNS
+    from stepHold import fillHeld
+    sensorData = decodeItems(items, SENSOR_DATA_COLUMNS)
+    sensorData.sort_values(["timestamp", "sensorID"], axis=0, ascending=[False, True], inplace=True)
+    return fillHeld(sensorData)
+
+def worstError(windows, sensorData):
+    # the biggest difference, compared to the deadband, between each window's readings and
+    # the dashboard's step-held reading at that time, and the number of windows with a reading
+    # missing on the dashboard
+    import pandas as pd
+    rows = sensorData.sort_values("timestamp").set_index("timestamp")
+    worst = 0.0
+    missing = 0
+    for seconds, record in windows:
+        at = rows.index.searchsorted(pd.Timestamp(record["timestamp"]), side="right") - 1
+        for channel in aggregator.CHANNELS:
+            if channel not in record:
+                continue
+            value = rows["data." + channel].iloc[at] if at >= 0 else float("nan")
+            if value != value:
+                missing += 1
+                continue
+            absolute, fraction = deadband.DEFAULT_LIMITS[channel]
+            band = max(absolute, fraction * abs(value))
+            worst = max(worst, abs(value - record[channel]) / band)
+    return worst, missing
+
+argParser = argparse.ArgumentParser(description="Measures the messages saved by the deadband filter")
+argParser.add_argument("--csv", help="readings recorded by a sensor node, instead of simulated ones")
+argParser.add_argument("--days", type=float, default=7, help="simulated days")
+argParser.add_argument("--seed", type=int, default=1)
+args = argParser.parse_args()
+
+started = time.perf_counter()
+if args.csv:
+    windows = recordedWindows(args.csv)
+    print("{:d} recorded windows from {:s}".format(len(windows), args.csv))
+else:
+    windows = simulatedWindows(args.days, args.seed)
+    print("{:d} windows from {:.0f} simulated days".format(len(windows), args.days))
+for encoding in publisher.ENCODINGS:
+    everything, unused = publish(windows, encoding, False)
+    changed, windowFilter = publish(windows, encoding, True)
+    print("{:6s} every window: {:5d} messages {:8d} bytes".format(encoding, len(everything.items), everything.bytes))
+    print("{:6s} deadband:     {:5d} messages {:8d} bytes  ({:.0%} fewer messages, {:.0%} fewer bytes, {:.1f} readings each)".format(
+        encoding, len(changed.items), changed.bytes, 1 - len(changed.items) / len(everything.items),
+        1 - changed.bytes / everything.bytes, windowFilter.values / max(1, windowFilter.records)))
+    check("fewer {:s} messages".format(encoding), len(changed.items) < len(everything.items))
+    if encoding == "json":
+        # which readings the messages were sent for
+        counts = dict((channel, sum(channel in item["data"]["M"] for item in changed.items)) for channel in aggregator.CHANNELS)
+        print("    (times each reading was sent: {:s})".format(", ".join("{:s} {:d}".format(c, n) for c, n in counts.items())))
+    sensorData = reconstruct(changed.items)
+    worst, missing = worstError(windows, sensorData)
+    print("    (dashboard readings at most {:.2f} deadbands from every window's, {:d} missing)".format(worst, missing))
+    check("dashboard readings within the deadband ({:s})".format(encoding), worst <= 1.0 + 1e-3)
+    check("no readings missing on the dashboard ({:s})".format(encoding), missing == 0)
+print("    ({:.1f}s)".format(time.perf_counter() - started))
+print("all deadband tests passed")
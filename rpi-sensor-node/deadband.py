@@ -0,0 +1,110 @@
+"""
+    Deadband and heartbeat filter for the readings the sensor node publishes
+    (sensor_run.py --deadband).
+    Most of the time a window's readings are hardly any different from the last
+    ones sent, but each window still costs an MQTT message and a DynamoDB write.
+    DeadbandFilter only passes on a measurement when it has moved further than its
+    deadband from the value last sent for it. The deadband of each measurement is
+    the bigger of an absolute amount and a fraction of the last value sent, e.g.
+    PM2.5 has to change by 1 microgram per cubic metre or 10%, so a smoke event
+    isn't sent every time it wobbles by a microgram. If nothing has moved, nothing
+    is sent at all. So that the dashboard can tell "not changed" from "not working",
+    every measurement is sent again once heartbeat seconds have gone by, whether it
+    has changed or not.
+    Each record sent has a "hold" value: the longest (in seconds) any value may be
+    held for. A measurement left out of a record (or a window with no record at all)
+    means the last value sent is still right, for up to hold seconds after it was
+    sent. The dashboard fills the readings back in like this (see dash/stepHold.py).
+"""
+
+import logging
+import math
+import time
+
+DEFAULT_LOGGING_LEVEL = logging.WARN
+
+DEFAULT_HEARTBEAT = 1800 # Every measurement is sent at least this often (seconds), changed or not
+# the deadband of each measurement as (absolute amount, fraction of the last value sent),
+# in the units they are published in (the air pressure is in Pascals)
+DEFAULT_LIMITS = {"humidity": (1.0, 0.0),
+                  "temperature": (0.2, 0.0),
+                  "bmp180_temperature": (0.2, 0.0),
+                  "bmp180_airpressure": (30.0, 0.0),
+                  "pm10": (2.0, 0.1),
+                  "pm25": (1.0, 0.1)}
+
+
+def parse_limit(text):
+    """
+        Turns "channel=absolute" or "channel=absolute,fraction" (the
+        --deadband-limit option) into (channel, (absolute, fraction))
+    """
+    channel, _, limit = text.partition("=")
+    if channel not in DEFAULT_LIMITS or not limit:
+        raise ValueError("expected one of %s=absolute[,fraction]" % ", ".join(sorted(DEFAULT_LIMITS)))
+    parts = [float(part) for part in limit.split(",")]
+    if len(parts) > 2 or min(parts) < 0:
+        raise ValueError("expected a deadband of absolute[,fraction], not %s" % limit)
+    return channel, (parts[0], parts[1] if len(parts) > 1 else 0.0)
+
+
+class DeadbandFilter(object):
+    """
+        Decides which readings from each window are worth sending. limits
+        changes the deadband of some of the measurements (see DEFAULT_LIMITS).
+        max_window is the longest a window can be, in seconds: a measurement
+        due a heartbeat is sent at the end of the next window, so hold is
+        the heartbeat plus two windows (the second in case a window is skipped).
+    """
+    def __init__(self, limits=None, heartbeat=DEFAULT_HEARTBEAT, max_window=0,
+                 clock=time.monotonic, log_level=DEFAULT_LOGGING_LEVEL):
+        self.logger = logging.getLogger("Deadband")
+        self.logger.setLevel(log_level)
+        self.limits = dict(DEFAULT_LIMITS)
+        self.limits.update(limits or {})
+        self.heartbeat = heartbeat
+        self.hold = int(math.ceil(heartbeat + 2 * max_window))
+        self.clock = clock
+        self.last = {} # channel -> the last value sent
+        self.last_heartbeat = None # clock() when every measurement was last sent
+        self.windows = 0
+        self.records = 0 # records passed on to be published
+        self.values = 0 # measurements in those records
+
+    def moved(self, channel, value):
+        # True if the value is outside the deadband around the last value sent
+        last = self.last.get(channel)
+        if last is None:
+            return True
+        absolute, fraction = self.limits[channel]
+        return abs(value - last) > max(absolute, fraction * abs(last))
+
+    def filter(self, record):
+        """
+            Takes the record for one window (a dictionary with a "timestamp" and
+            a value for each measurement) and returns the record to publish,
+            with only the measurements that need sending and the "hold" time,
+            or None if there is nothing worth sending
+        """
+        self.windows += 1
+        now = self.clock()
+        heartbeat = self.last_heartbeat is None or now - self.last_heartbeat >= self.heartbeat
+        if heartbeat:
+            # everything is sent together so the next heartbeat is due at the same time for all
+            self.last_heartbeat = now
+        send = {"timestamp": record["timestamp"]}
+        for channel in self.limits:
+            value = record.get(channel)
+            if value is None or math.isnan(value):
+                continue
+            if heartbeat or self.moved(channel, value):
+                send[channel] = value
+                self.last[channel] = value
+        if len(send) == 1:
+            return None
+        send["hold"] = self.hold
+        self.records += 1
+        self.values += len(send) - 2
+        self.logger.debug("sending %s%s", ", ".join(sorted(set(send) - {"timestamp", "hold"})),
+                          " (heartbeat)" if heartbeat else "")
+        return send
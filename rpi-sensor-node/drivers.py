@@ -0,0 +1,356 @@
+"""
+    Drivers for the sensor devices on a sensor node.
+    Each driver has the same interface (see SensorDriver) so sensor_run.py doesn't need
+    to know whether it is talking to the real device or to a simulated one. The simulated
+    drivers make up realistic readings (daily temperature cycle, slowly drifting air
+    pressure, smoke events in the particulate readings) from a seeded random number
+    generator, including the glitches the real devices have: failed reads, spikes and
+    corrupted serial packets. They are used by fleet-test.py to run many virtual nodes
+    on one computer, and by sensor_run.py with --simulate.
+    The libraries for the real devices are only imported when a real driver is made,
+    so the simulated ones work on a computer without them.
+"""
+
+import math
+import random
+import time
+
+# the particulate sensor types that can be given on the sensor_run.py command line
+PARTICULATE_TYPES = ('Honeywell', 'SDS011')
+
+DEFAULT_SERIAL_PORT = "/dev/serial0" # Serial port the particulate sensor is on
+DHT22_PIN = 17 # GPIO pin the DHT22 is connected to
+DHT22_TRIES = 15 # Times a DHT22 read is tried before giving up, as Adafruit_DHT.read_retry()
+DHT22_RETRY_DELAY = 2 # Seconds between DHT22 tries
+
+
+class SensorDriver(object):
+    """
+        The interface every driver has. channels names the values read() returns,
+        in order. read() returns a tuple of numbers, or None if the read failed.
+    """
+    name = None
+    channels = ()
+
+    def start(self):
+        """
+            Gets the device ready to take readings (e.g. starts the fan)
+        """
+        pass
+
+    def read(self):
+        raise NotImplementedError
+
+    def stop(self):
+        pass
+
+    def counters(self):
+        """
+            Returns the retries and errors the driver has counted so far, as
+            name -> count (reported by telemetry.py)
+        """
+        return {}
+
+
+##################################################
+# drivers for the real devices
+##################################################
+
+class DHT22Driver(SensorDriver):
+    """
+        DHT22 temperature and humidity sensor
+    """
+    name = "DHT22"
+    channels = ("humidity", "temperature")
+
+    def __init__(self, pin=DHT22_PIN):
+        import Adafruit_DHT
+        self.dht = Adafruit_DHT
+        self.pin = pin
+        self.retries = 0 # tries after the first, over every read
+
+    def read(self):
+        # tries up to 15 times, 2 seconds apart, before giving up, like read_retry() does
+        # but counting the retries, as they are where a slow read's time goes
+        for attempt in range(DHT22_TRIES):
+            if attempt:
+                self.retries += 1
+                time.sleep(DHT22_RETRY_DELAY)
+            humidity, temperature = self.dht.read(self.dht.DHT22, self.pin)
+            if humidity is not None and temperature is not None:
+                return float(humidity), float(temperature)
+        return None
+
+    def counters(self):
+        return {"retries": self.retries}
+
+
+class BMP180Driver(SensorDriver):
+    """
+        BMP180 temperature and air pressure sensor
+    """
+    name = "BMP180"
+    channels = ("bmp180_temperature", "bmp180_airpressure")
+
+    def __init__(self):
+        import Adafruit_BMP.BMP085 as BMP085
+        # ultra-high res mode seems to work fine
+        self.bmp = BMP085.BMP085(mode=BMP085.BMP085_ULTRAHIGHRES)
+
+    def read(self):
+        temperature = self.bmp.read_temperature()
+        pressure = self.bmp.read_pressure()
+        if temperature is None or pressure is None:
+            return None
+        return float(temperature), float(pressure)
+
+
+class HoneywellDriver(SensorDriver):
+    """
+        Honeywell HPMA115S0 particulate sensor. Once started, every packet it sends
+        (about one a second) is read in the background, and read() returns the
+        median of the packets received since the last read, without waiting
+    """
+    name = "particulates"
+    channels = ("pm10", "pm25")
+
+    def __init__(self):
+        import honeywell
+        self.hw = honeywell.Honeywell()
+        self.reader = None
+
+    def start(self):
+        self.hw.start_measuring()
+        self.reader = self.hw.start_background()
+
+    def read(self):
+        readings = self.reader.drain()
+        if not readings:
+            return None
+        stats = self.reader.stats(readings)
+        return stats["pm10"].median, stats["pm25"].median
+
+    def stop(self):
+        self.hw.stop_background()
+        self.hw.stop_measuring()
+
+    def counters(self):
+        counters = {"checksum_failures": self.hw.parser.checksum_failures}
+        if self.reader is not None:
+            counters.update(serial_errors=self.reader.errors, dropped_packets=self.reader.dropped)
+        return counters
+
+
+class SDS011Driver(SensorDriver):
+    """
+        Nova SDS-011 particulate sensor
+    """
+    name = "particulates"
+    channels = ("pm10", "pm25")
+
+    def __init__(self, port=DEFAULT_SERIAL_PORT):
+        from sds011 import SDS011
+        self.sds = SDS011(port, use_query_mode=True)
+
+    def read(self):
+        pm10, pm25 = self.sds.query()
+        if pm10 is None or pm25 is None:
+            return None
+        return float(pm10), float(pm25)
+
+
+##################################################
+# simulated drivers
+##################################################
+# The made up weather is worked out from the time given by clock(), so when fleet-test.py
+# runs the clock faster than real time the readings still follow a daily cycle.
+
+class SimulatedDriver(SensorDriver):
+    """
+        Common parts of the simulated drivers. seed picks the random numbers, so the
+        same seed always gives the same readings. failure_rate is the chance of a read
+        failing and glitch_rate the chance of a wildly wrong reading.
+    """
+    def __init__(self, seed=None, clock=time.time, failure_rate=0.02, glitch_rate=0.01):
+        self.random = random.Random(seed)
+        self.clock = clock
+        self.failure_rate = failure_rate
+        self.glitch_rate = glitch_rate
+        self.reads = 0
+        self.failures = 0
+        self.glitches = 0
+        # every node is a bit different
+        self.offset = self.random.uniform(-2, 2)
+
+    def daily_cycle(self):
+        # -1 at 4am, +1 at 4pm
+        hours = (self.clock() / 3600.0) % 24
+        return math.sin((hours - 10) / 24.0 * 2 * math.pi)
+
+    def failed(self):
+        self.reads += 1
+        if self.random.random() < self.failure_rate:
+            self.failures += 1
+            return True
+        return False
+
+    def glitched(self):
+        if self.random.random() < self.glitch_rate:
+            self.glitches += 1
+            return True
+        return False
+
+
+class SimulatedDHT22(SimulatedDriver):
+    """
+        Temperature follows a daily cycle, and humidity goes the other way.
+        Like the real one it sometimes returns nothing, or a humidity spike.
+    """
+    name = "DHT22"
+    channels = ("humidity", "temperature")
+
+    def read(self):
+        if self.failed():
+            return None
+        cycle = self.daily_cycle()
+        temperature = 18 + self.offset + 7 * cycle + self.random.gauss(0, 0.2)
+        humidity = 60 - 20 * cycle + self.random.gauss(0, 1)
+        if self.glitched():
+            humidity = self.random.choice((0.0, 99.9, 3276.8))
+        return round(humidity, 1), round(temperature, 1)
+
+
+class SimulatedBMP180(SimulatedDriver):
+    """
+        Air pressure drifts slowly around 1013 hPa (returned in Pa like the real one)
+    """
+    name = "BMP180"
+    channels = ("bmp180_temperature", "bmp180_airpressure")
+
+    def __init__(self, seed=None, clock=time.time, failure_rate=0.001, glitch_rate=0.001):
+        SimulatedDriver.__init__(self, seed, clock, failure_rate, glitch_rate)
+        self.pressure = 101325 + self.random.uniform(-1500, 1500)
+
+    def read(self):
+        if self.failed():
+            return None
+        self.pressure += self.random.gauss(0, 3)
+        self.pressure += (101325 - self.pressure) * 0.001 # drift back towards normal
+        temperature = 19 + self.offset + 7 * self.daily_cycle() + self.random.gauss(0, 0.1)
+        pressure = self.pressure + self.random.gauss(0, 5)
+        if self.glitched():
+            pressure = 0.0
+        return round(temperature, 1), float(int(pressure))
+
+
+class SimulatedParticulates(SimulatedDriver):
+    """
+        Particulate readings: a low background level with now and again a smoke event
+        that pushes the readings up for a while and then dies away
+    """
+    name = "particulates"
+    channels = ("pm10", "pm25")
+
+    def __init__(self, seed=None, clock=time.time, failure_rate=0.01, glitch_rate=0.005, smoke_rate=0.001):
+        SimulatedDriver.__init__(self, seed, clock, failure_rate, glitch_rate)
+        self.smoke_rate = smoke_rate
+        self.smoke = 0.0
+
+    def levels(self):
+        # returns the pm10 and pm25 levels right now, in micrograms per cubic metre
+        if self.random.random() < self.smoke_rate:
+            self.smoke += self.random.uniform(50, 300)
+        self.smoke *= 0.98
+        pm25 = max(0, 5 + self.offset + self.smoke + self.random.gauss(0, 1.5))
+        pm10 = max(pm25, pm25 * 1.6 + self.random.gauss(0, 2))
+        if self.glitched():
+            pm25 = pm10 = self.random.choice((0, 999))
+        return int(pm10), int(pm25)
+
+
+class SimulatedHoneywell(SimulatedParticulates):
+    """
+        Makes up the serial packets a Honeywell HPMA115S0 sends, with some noise
+        bytes and corrupted packets, and reads them with the real packet parser,
+        so checksum failures and resyncs happen just like on the real device
+    """
+    def __init__(self, seed=None, clock=time.time, failure_rate=0.01, glitch_rate=0.005,
+                 smoke_rate=0.001, corrupt_rate=0.02):
+        SimulatedParticulates.__init__(self, seed, clock, failure_rate, glitch_rate, smoke_rate)
+        import honeywell
+        self.honeywell = honeywell
+        self.parser = honeywell.FrameParser()
+        self.parser.logger.disabled = True # the checksum failures are made on purpose
+        self.corrupt_rate = corrupt_rate
+
+    def frame(self, pm10, pm25):
+        frame = bytearray(self.honeywell.MSG_HEADER + b'\x00\x1c\x00\x00')
+        frame += bytes([pm25 >> 8, pm25 & 0xff, pm10 >> 8, pm10 & 0xff])
+        frame += bytes(self.honeywell.MSG_LENGTH - 2 - len(frame))
+        checksum = sum(frame)
+        frame += bytes([checksum >> 8, checksum & 0xff])
+        if self.random.random() < self.corrupt_rate:
+            frame[self.random.randint(4, 29)] ^= 0xff
+        return bytes(frame)
+
+    def read(self):
+        if self.failed():
+            return None # like the sensor not sending anything before the read timeout
+        # the sensor sends a packet every second, so a few arrive between reads
+        data = bytearray()
+        for i in range(3):
+            if self.random.random() < 0.05:
+                data += bytes(self.random.randint(0, 255) for n in range(self.random.randint(1, 5)))
+            data += self.frame(*self.levels())
+        self.parser.feed(bytes(data))
+        readings = list(self.parser.readings())
+        if not readings:
+            return None
+        # like the real driver, use every packet since the last read
+        stats = self.honeywell.BackgroundReader.stats(readings)
+        return stats["pm10"].median, stats["pm25"].median
+
+    def counters(self):
+        return {"checksum_failures": self.parser.checksum_failures}
+
+
+class SimulatedSDS011(SimulatedParticulates):
+    """
+        A Nova SDS-011, which returns None now and again when queried
+    """
+    def read(self):
+        if self.failed():
+            return None
+        pm10, pm25 = self.levels()
+        return float(pm10), float(pm25)
+
+
+##################################################
+# making the drivers for a node
+##################################################
+
+REAL_DRIVERS = {'DHT22': DHT22Driver, 'BMP180': BMP180Driver,
+                'Honeywell': HoneywellDriver, 'SDS011': SDS011Driver}
+SIMULATED_DRIVERS = {'DHT22': SimulatedDHT22, 'BMP180': SimulatedBMP180,
+                     'Honeywell': SimulatedHoneywell, 'SDS011': SimulatedSDS011}
+
+def make_driver(device, simulate=False, seed=None, clock=time.time):
+    """
+        Returns a driver for a device (DHT22, BMP180, Honeywell or SDS011), either
+        real or simulated. Making a real driver raises an exception if the device
+        can't be set up.
+    """
+    if device not in REAL_DRIVERS:
+        raise ValueError("unknown sensor device %s" % device)
+    if not simulate:
+        return REAL_DRIVERS[device]()
+    # give each device on a node its own random numbers, that are still the same every time
+    return SIMULATED_DRIVERS[device](None if seed is None else "%s-%s" % (seed, device), clock)
+
+def make_drivers(particulate_sensor_type, simulate=False, seed=None, clock=time.time):
+    """
+        Returns the DHT22, BMP180 and particulate sensor drivers for a node
+    """
+    if particulate_sensor_type not in PARTICULATE_TYPES:
+        raise ValueError("unknown particulate sensor type %s" % particulate_sensor_type)
+    return [make_driver(device, simulate, seed, clock) for device in ('DHT22', 'BMP180', particulate_sensor_type)]
@@ -0,0 +1,279 @@
+# this is just test code, it is not part of the Sensor node
+# it runs a fleet of virtual sensor nodes in one program, with simulated sensor devices
+# (see drivers.py) and a pretend MQTT broker and DynamoDB table, with the clock running
+# much faster than real time. It shows how the message rate, the DynamoDB writes and the
+# dashboard's work grow as the number of sensor nodes goes up, to find where things
+# start to fall over. For each fleet it checks every node's windows arrive, no DynamoDB
+# item is replaced by another with the same key, and seconds with more writes than DynamoDB
+# can take are reported.
+# run it from the rpi-sensor-node folder with: python3 fleet-test.py
+# the defaults are small so it runs quickly, to see where things fall over try bigger fleets,
+# e.g. python3 fleet-test.py --nodes 4,100,1000 --hours 6 --encoding packed --batch-windows 5
+# the dashboard part needs pandas and numpy (pip3 install -r ../dash/requirements.txt)
+
+import os
+import sys
+import json
+import time
+import base64
+import argparse
+import datetime
+import collections
+import drivers
+import aggregator
+import packing
+import publisher
+
+def check(name, ok):
+    print("{:60s} {}".format(name, "ok" if ok else "FAILED"))
+    if not ok:
+        raise SystemExit(1)
+
+SAMPLE_INTERVAL = 10 # seconds between readings, as in sensor_run.py
+WINDOW_SAMPLES = 20 # readings in each window, as in sensor_run.py
+MIN_READINGS = 6 # as in sensor_run.py
+START_TIME = datetime.datetime(2019, 7, 1)
+
+##################################################
+# the simulated clock
+##################################################
+
+class SimulatedClock(object):
+    """
+        Time that only moves when the harness moves it
+    """
+    def __init__(self, start=START_TIME):
+        self.start = start
+        self.elapsed = 0.0
+
+    def time(self):
+        # seconds since 1970, for the simulated drivers
+        return (self.start - datetime.datetime(1970, 1, 1)).total_seconds() + self.elapsed
+
+    def timestamp(self):
+        # the local time as text, like get_local_timestamp() in sensor_run.py
+        return '{:%Y-%m-%d %H:%M:%S}'.format(self.start + datetime.timedelta(seconds=self.elapsed))
+
+##################################################
+# a local stand-in for AWS IoT and DynamoDB
+##################################################
+
+def toDynamo(value):
+    # wrap a value the way DynamoDB does, e.g. 1.5 -> {"N": "1.5"}
+    if isinstance(value, dict):
+        return {'M': dict((k, toDynamo(v)) for k, v in value.items())}
+    if isinstance(value, list):
+        return {'L': [toDynamo(v) for v in value]}
+    if isinstance(value, (int, float)):
+        return {'N': repr(value)}
+    return {'S': str(value)}
+
+class LocalBroker(object):
+    """
+        Receives the messages from the virtual nodes, acknowledges them straight away
+        like the AWS IoT broker, and turns each one into a DynamoDB item like the
+        AWS IoT rules do. Like DynamoDB, an item with the same sensorID and timestamp
+        as one already there replaces it. DynamoDB can only take writeCapacity writes a
+        second (of up to 1KB each), anything more is throttled and has to wait.
+    """
+    def __init__(self, clock, writeCapacity):
+        self.clock = clock
+        self.writeCapacity = writeCapacity
+        self.table = collections.OrderedDict() # (sensorID, timestamp) -> item
+        self.overwritten = 0 # items replaced by a later one with the same key
+        self.messages = 0
+        self.bytes = 0
+        self.writeUnits = 0
+        self.itemBytes = 0 # the size of the table, which the dashboard scans
+        self.writesPerSecond = collections.Counter() # simulated second -> write units used
+        self.windows = collections.Counter() # sensorID -> windows received
+        self.nextMid = 1
+
+    def publishAsync(self, topic, payload, qos=1, ackCallback=None):
+        self.messages += 1
+        self.bytes += len(payload)
+        if topic.startswith('sensors/packed/'):
+            # SELECT encode(*, 'base64') AS packed FROM 'sensors/packed/+/+', keyed on the topic
+            sensorID, timestamp = packing.topic_key(topic)
+            data = {'packed': base64.b64encode(payload).decode()}
+            self.windows[sensorID] += len(packing.decode(payload))
+        else:
+            data = json.loads(payload)
+            sensorID = data['sensor']
+            timestamp = data['timestamp']
+            self.windows[sensorID] += len(data.get('batch', [data]))
+        item = {'sensorID': {'S': sensorID}, 'timestamp': {'S': timestamp}, 'data': toDynamo(data)}
+        key = (sensorID, timestamp)
+        if key in self.table:
+            self.overwritten += 1
+        self.table[key] = item
+        # each write uses one write unit per KB
+        size = len(json.dumps(item))
+        self.itemBytes += size
+        units = (size + 1023) // 1024
+        self.writeUnits += units
+        self.writesPerSecond[int(self.clock.elapsed)] += units
+        mid = self.nextMid
+        self.nextMid += 1
+        if ackCallback is not None:
+            ackCallback(mid)
+        return mid
+
+    @property
+    def items(self):
+        return list(self.table.values())
+
+    def throttled(self):
+        # the fraction of seconds with more writes than DynamoDB can take, and the
+        # most writes asked for in one second
+        busiest = max(self.writesPerSecond.values()) if self.writesPerSecond else 0
+        over = sum(1 for units in self.writesPerSecond.values() if units > self.writeCapacity)
+        return over / max(1, len(self.writesPerSecond)), busiest
+
+##################################################
+# virtual sensor nodes
+##################################################
+
+class VirtualNode(object):
+    """
+        Does what the main loop of sensor_run.py does, without the threads: reads
+        the simulated devices, works out each window's trimmed means and publishes them
+    """
+    def __init__(self, sensorID, clock, broker, particulateType, encoding, batchWindows):
+        self.sensorID = str(sensorID)
+        self.clock = clock
+        self.drivers = drivers.make_drivers(particulateType, simulate=True, seed=sensorID, clock=clock.time)
+        self.stats = aggregator.WindowAggregator(aggregator.CHANNELS, window=WINDOW_SAMPLES)
+        self.publisher = publisher.BatchPublisher(broker, self.sensorID, encoding=encoding, batch_windows=batchWindows)
+        self.skipped = 0
+        self.added = 0 # windows given to the publisher
+
+    def sample(self):
+        for driver in self.drivers:
+            self.stats.add_values(driver.channels, driver.read())
+
+    def endWindow(self):
+        stats = self.stats.stats()
+        enough = self.stats.min_count() > MIN_READINGS
+        self.stats.reset()
+        if not enough:
+            self.skipped += 1
+            return
+        record = dict((channel, stats[channel].trimmed_mean) for channel in aggregator.CHANNELS)
+        record['timestamp'] = self.clock.timestamp()
+        self.added += 1
+        self.publisher.add(record)
+
+    def sent(self):
+        # the windows the publisher has sent, the rest are still waiting in a batch
+        return self.added - len(self.publisher.pending)
+
+def runFleet(nodes, hours, particulateType, encoding, batchWindows, writeCapacity):
+    clock = SimulatedClock()
+    broker = LocalBroker(clock, writeCapacity)
+    fleet = [VirtualNode(n, clock, broker, particulateType, encoding, batchWindows) for n in range(1, nodes + 1)]
+    samples = int(hours * 3600 / SAMPLE_INTERVAL)
+    started = time.perf_counter()
+    for sample in range(samples):
+        for n, node in enumerate(fleet):
+            # each node's readings are offset a little within the sample interval
+            clock.elapsed = sample * SAMPLE_INTERVAL + (n * SAMPLE_INTERVAL) / float(nodes)
+            node.sample()
+            # and their windows end at different times, as they didn't all start at once
+            if (sample + n) % WINDOW_SAMPLES == WINDOW_SAMPLES - 1:
+                node.endWindow()
+    # the windows still waiting in a batch aren't sent, as every node sending at
+    # the same moment at the end would make the busiest second look worse than it is
+    elapsed = time.perf_counter() - started
+    return broker, fleet, elapsed
+
+##################################################
+# the dashboard's work for the data the fleet sent
+##################################################
+
+def dashboardWork(items):
+    # times the main things the dashboard does with the data on a refresh
+    dashDir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'dash')
+    if dashDir not in sys.path:
+        sys.path.insert(0, dashDir)
+    from dynamoDecoder import decodeItems, SENSOR_DATA_COLUMNS
+    from rollups import SensorRollups
+    from tablePaging import tablePage
+    from downsample import downsampleFrame
+    times = collections.OrderedDict()
+    started = time.perf_counter()
+    sensorData = decodeItems(items, SENSOR_DATA_COLUMNS)
+    sensorData.sort_values(["timestamp", "sensorID"], axis=0, ascending=[False, True], inplace=True)
+    times['decode'] = time.perf_counter() - started
+    started = time.perf_counter()
+    rollups = SensorRollups()
+    rollups.rebuild(sensorData)
+    times['rollups'] = time.perf_counter() - started
+    started = time.perf_counter()
+    sensorData.drop_duplicates('sensorID')
+    times['latest'] = time.perf_counter() - started
+    started = time.perf_counter()
+    tablePage(sensorData, 0, 50, [{'column_id': 'data.pm25', 'direction': 'desc'}], '')
+    times['table page'] = time.perf_counter() - started
+    # one line on the PM2.5 graph for every sensor, 1000 points each
+    started = time.perf_counter()
+    points = 0
+    for sensorID, rows in sensorData.groupby('sensorID'):
+        rows = rows.sort_values('timestamp').dropna(subset=['data.pm25'])
+        points += len(downsampleFrame(rows, 'timestamp', 'data.pm25', 1000))
+    times['graph'] = time.perf_counter() - started
+    return sensorData, times, points
+
+##################################################
+# run it for each fleet size
+##################################################
+
+argParser = argparse.ArgumentParser(description="Runs a fleet of virtual sensor nodes")
+argParser.add_argument("--nodes", default="4,50", help="comma separated fleet sizes to try")
+argParser.add_argument("--hours", type=float, default=1, help="simulated hours to run each fleet for")
+argParser.add_argument("--particulates", choices=drivers.PARTICULATE_TYPES, default='Honeywell')
+argParser.add_argument("--encoding", choices=publisher.ENCODINGS, default=publisher.DEFAULT_ENCODING)
+argParser.add_argument("--batch-windows", type=int, default=1)
+argParser.add_argument("--write-capacity", type=int, default=25, help="DynamoDB write units per second")
+argParser.add_argument("--no-dashboard", action="store_true", help="skip timing the dashboard")
+args = argParser.parse_args()
+
+print("{:.1f} simulated hours per fleet, {:s} encoding, {:d} windows per message, {:d} write units/s".format(
+    args.hours, args.encoding, args.batch_windows, args.write_capacity))
+for nodes in [int(n) for n in args.nodes.split(',')]:
+    broker, fleet, elapsed = runFleet(nodes, args.hours, args.particulates, args.encoding,
+                                      args.batch_windows, args.write_capacity)
+    simulatedSeconds = args.hours * 3600
+    throttled, busiest = broker.throttled()
+    print("{:5d} nodes: {:.1f}s to run ({:.0f}x real time), {:d} messages ({:.2f}/s), {:.0f} bytes/message".format(
+        nodes, elapsed, simulatedSeconds / elapsed, broker.messages, broker.messages / simulatedSeconds,
+        broker.bytes / max(1, broker.messages)))
+    failures = sum(d.failures for node in fleet for d in node.drivers)
+    reads = sum(d.reads for node in fleet for d in node.drivers)
+    checksums = sum(d.parser.checksum_failures for node in fleet for d in node.drivers if hasattr(d, 'parser'))
+    print("        {:d} reads, {:d} failed, {:d} checksum failures, {:d} windows skipped".format(
+        reads, failures, checksums, sum(node.skipped for node in fleet)))
+    print("        DynamoDB: {:d} write units, busiest second {:d} units, {:.0%} of seconds over capacity{:s}".format(
+        broker.writeUnits, busiest, throttled, "  <-- THROTTLED" if throttled > 0 else ""))
+    print("        {:d} items, {:d} overwritten by another message with the same key{:s}".format(
+        len(broker.table), broker.overwritten, "  <-- LOST" if broker.overwritten else ""))
+    # a scan reads 4KB for half a read unit
+    print("        a scan of the table reads {:.1f}MB, {:.0f} read units".format(
+        broker.itemBytes / 1e6, broker.itemBytes / 4096 / 2))
+    if not args.no_dashboard:
+        sensorData, times, points = dashboardWork(broker.items)
+        total = sum(times.values())
+        print("        dashboard: {:d} rows, {:s}, total {:.2f}s, {:d} graph points{:s}".format(
+            len(sensorData), ", ".join("{:s} {:.2f}s".format(name, t) for name, t in times.items()), total, points,
+            "  <-- SLOW" if total > 5 else ""))
+    check("{:d} nodes: every node's windows arrive".format(nodes),
+          all(node.sent() > 0 and broker.windows[node.sensorID] == node.sent() for node in fleet))
+    check("{:d} nodes: no items lost".format(nodes), broker.overwritten == 0)
+    check("{:d} nodes: throttling reported when over capacity".format(nodes),
+          (throttled > 0) == (busiest > args.write_capacity))
+
+# a fleet writing more than DynamoDB can take is reported as throttled, here batches of
+# 10 windows (2 write units each) with room for 1 write unit a second
+broker, fleet, elapsed = runFleet(4, 1, args.particulates, 'json', 10, 1)
+check("a fleet over capacity is throttled", broker.throttled()[0] > 0)
+print("all fleet tests passed")
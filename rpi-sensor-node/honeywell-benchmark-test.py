@@ -0,0 +1,223 @@
+# this is just test code, it is not part of the Sensor node
+# it runs the Honeywell driver (honeywell.py) against a pretend HPMA115S0 on a
+# pseudo-terminal (honeywell_emulator.py), so the commands, the acknowledgements and
+# reading packets can be tested on a laptop without the sensor. It checks that the driver
+# copes with noise, cut short packets and bad checksums, then measures how many packets
+# a second it can read, how long after a packet arrives the reading is returned, and how
+# much CPU time each packet takes.
+# needs Linux and pyserial. Run it from the rpi-sensor-node folder with:
+#     python3 honeywell-benchmark-test.py
+# to catch the driver getting slower, save the results before a change and compare after:
+#     python3 honeywell-benchmark-test.py --save before.json
+#     python3 honeywell-benchmark-test.py --baseline before.json
+
+import json
+import time
+import logging
+import argparse
+from honeywell import Honeywell, HoneywellException
+from honeywell_emulator import HoneywellEmulator
+
+# the driver logs every checksum failure, which the fault tests cause on purpose
+logging.getLogger("HPMA115S0 Interface").disabled = True
+
+argParser = argparse.ArgumentParser(description="Tests and benchmarks the Honeywell driver")
+argParser.add_argument("--seconds", type=float, default=3, help="how long to run each benchmark for")
+argParser.add_argument("--save", help="save the results to this file")
+argParser.add_argument("--baseline", help="fail if the results are much worse than the ones saved in this file")
+argParser.add_argument("--tolerance", type=float, default=0.25, help="how much worse than the baseline is allowed")
+args = argParser.parse_args()
+
+def check(name, ok):
+    print("{:60s} {}".format(name, "ok" if ok else "FAILED"))
+    if not ok:
+        raise SystemExit(1)
+
+def sequence(reading):
+    # the emulator puts a sequence number in the values
+    return reading.pm25 + (reading.pm10 << 16)
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+def openSensor(emulator):
+    sensor = Honeywell(port=emulator.port)
+    sensor.start_measuring()
+    return sensor
+
+##################################################
+# the commands and acknowledgements
+##################################################
+
+emulator = HoneywellEmulator(period=0.05)
+emulator.start()
+sensor = openSensor(emulator)
+check("start_measuring() acknowledged", emulator.measuring and emulator.auto_send)
+reading = sensor.read()
+check("packets read once measuring", reading is not None)
+sensor.stop_measuring()
+check("stop_measuring() acknowledged", not emulator.measuring and not emulator.auto_send)
+# with nothing being sent, read() gives up at the read timeout rather than the longer serial timeout
+started = time.monotonic()
+try:
+    sensor.read()
+    timedOut = False
+except HoneywellException:
+    timedOut = True
+waited = time.monotonic() - started
+check("read() with nothing sent gives up at the read timeout", timedOut and sensor.read_timeout <= waited < sensor.read_timeout + 0.2)
+check("and the serial timeout is put back", sensor.serial.timeout == sensor.serial_timeout)
+sensor.serial.close()
+emulator.close()
+
+emulator = HoneywellEmulator(period=0.05, nack_rate=1)
+emulator.start()
+try:
+    openSensor(emulator)
+    refused = False
+except HoneywellException:
+    refused = True
+check("refused command raises HoneywellException", refused)
+emulator.close()
+
+##################################################
+# noise, cut short packets and bad checksums
+##################################################
+
+emulator = HoneywellEmulator(baud=0, period=0.001, seed=1, noise_rate=0.1, partial_rate=0.05, corrupt_rate=0.05)
+emulator.start_process()
+sensor = openSensor(emulator)
+received = []
+while len(received) < 5000:
+    received.append(sequence(sensor.read(perform_flush=False)))
+sensor.stop_measuring()
+counts = emulator.counts()
+emulator.close()
+print("    ({:d} packets: {:d} cut short, {:d} bad checksums, {:d} noise bytes; driver found {:d} checksum failures)".format(
+    counts['frames'], counts['partial_frames'], counts['corrupt_frames'], counts['noise_bytes'],
+    sensor.parser.checksum_failures))
+check("every good packet read, in order", received == list(range(len(received))))
+check("no readings made up from bad packets", max(received) < counts['good_frames'])
+
+##################################################
+# benchmarks
+##################################################
+
+results = {}
+
+# as many packets as the driver can take, with read_available() as a background reader would use it
+emulator = HoneywellEmulator(baud=0, period=0)
+emulator.start_process()
+sensor = openSensor(emulator)
+frames = 0
+cpu = time.process_time()
+started = time.perf_counter()
+while time.perf_counter() - started < args.seconds:
+    frames += len(sensor.read_available())
+    time.sleep(0.001)
+elapsed = time.perf_counter() - started
+cpu = time.process_time() - cpu
+sensor.stop_measuring()
+emulator.close()
+results['frames_per_second'] = frames / elapsed
+results['cpu_us_per_frame'] = cpu / max(1, frames) * 1e6
+print("unlimited line, read_available(): {:.0f} packets/s, {:.1f} us CPU per packet".format(
+    results['frames_per_second'], results['cpu_us_per_frame']))
+
+# a 9600 baud line sending back to back (the most the real line can carry) with read()
+emulator = HoneywellEmulator(baud=9600, period=0)
+emulator.start_process()
+sensor = openSensor(emulator)
+latencies = []
+cpu = time.process_time()
+started = time.perf_counter()
+while time.perf_counter() - started < args.seconds:
+    reading = sensor.read(perform_flush=False)
+    latencies.append(reading.monotonic - emulator.sent_at(sequence(reading)))
+elapsed = time.perf_counter() - started
+cpu = time.process_time() - cpu
+sensor.stop_measuring()
+emulator.close()
+results['baud9600_frames_per_second'] = len(latencies) / elapsed
+results['baud9600_cpu_us_per_frame'] = cpu / max(1, len(latencies)) * 1e6
+print("9600 baud line, read(): {:.1f} packets/s, {:.1f} us CPU per packet".format(
+    results['baud9600_frames_per_second'], results['baud9600_cpu_us_per_frame']))
+
+# how long after a packet has been sent the reading is returned, at 10 packets a second
+emulator = HoneywellEmulator(baud=9600, period=0.1)
+emulator.start_process()
+sensor = openSensor(emulator)
+latencies = []
+started = time.perf_counter()
+while time.perf_counter() - started < max(args.seconds, 2):
+    reading = sensor.read(perform_flush=False)
+    latencies.append(reading.monotonic - emulator.sent_at(sequence(reading)))
+sensor.stop_measuring()
+emulator.close()
+latencies = latencies[1:] # the first one may have been waiting since before the timing started
+results['latency_ms_median'] = percentile(latencies, 0.5) * 1000
+results['latency_ms_p95'] = percentile(latencies, 0.95) * 1000
+results['latency_ms_max'] = max(latencies) * 1000
+print("read() latency at 10 packets/s: median {:.2f} ms, 95% {:.2f} ms, max {:.2f} ms".format(
+    results['latency_ms_median'], results['latency_ms_p95'], results['latency_ms_max']))
+
+# read() with the default perform_flush, which waits for a new packet, at the real rate of 1 a second
+emulator = HoneywellEmulator(baud=9600, period=1.0)
+emulator.start_process()
+sensor = openSensor(emulator)
+waits = []
+for n in range(3):
+    started = time.perf_counter()
+    sensor.read()
+    waits.append(time.perf_counter() - started)
+sensor.stop_measuring()
+emulator.close()
+results['flush_read_ms_mean'] = sum(waits) / len(waits) * 1000
+print("read() waiting for a new packet at 1 packet/s: {:.0f} ms on average".format(results['flush_read_ms_mean']))
+
+# reading every packet in the background, the way drivers.py uses the sensor
+emulator = HoneywellEmulator(baud=9600, period=0.05)
+emulator.start_process()
+sensor = openSensor(emulator)
+background = sensor.start_background()
+time.sleep(args.seconds)
+started = time.perf_counter()
+for n in range(10000):
+    sensor.read()
+results['background_read_us'] = (time.perf_counter() - started) / 10000 * 1e6
+windowStart = time.monotonic() - 1
+stats = background.window_stats(windowStart)
+sensor.stop_background()
+readings = background.drain()
+sensor.stop_measuring()
+counts = emulator.counts()
+emulator.close()
+received = [sequence(r) for r in readings]
+check("background reader queues every packet, in order", received == list(range(received[0], received[0] + len(received))))
+check("no packets dropped from the queue", background.dropped == 0 and received[0] == 0)
+check("drain() empties the queue", background.drain() == [])
+check("window_stats() uses the last second of packets", 15 <= stats['pm25'].count <= 21)
+print("background reader: {:d} of {:d} packets used, read() takes {:.1f} us".format(
+    len(received), counts['good_frames'], results['background_read_us']))
+
+##################################################
+# comparing with earlier results
+##################################################
+
+if args.save:
+    with open(args.save, 'w') as f:
+        json.dump(results, f, indent=1)
+if args.baseline:
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    # more packets a second is better, for everything else less is better
+    for name in ('frames_per_second', 'baud9600_frames_per_second'):
+        check("{:s} no worse than baseline {:.1f}".format(name, baseline[name]),
+              results[name] >= baseline[name] * (1 - args.tolerance))
+    for name in ('cpu_us_per_frame', 'baud9600_cpu_us_per_frame'):
+        check("{:s} no worse than baseline {:.2f}".format(name, baseline[name]),
+              results[name] <= baseline[name] * (1 + args.tolerance))
+    # the latency is well under a millisecond, so allow for the computer being busy
+    check("latency_ms_p95 no worse than baseline {:.2f}".format(baseline['latency_ms_p95']),
+          results['latency_ms_p95'] <= baseline['latency_ms_p95'] * (1 + args.tolerance) + 1)
@@ -5,41 +5,72 @@
     based on https://github.com/FEEprojects/plantower
 """
 
+import collections
 import logging
+import struct
+import threading
 import time
-from datetime import datetime, timedelta
+from datetime import datetime
 from serial import Serial, SerialException
+import aggregator
 
 DEFAULT_SERIAL_PORT = "/dev/serial0" # Serial port to use if no other specified
 DEFAULT_BAUD_RATE = 9600 # Serial baud rate to use if no other specified
 DEFAULT_SERIAL_TIMEOUT = 2 # Serial timeout to use if not specified
 DEFAULT_READ_TIMEOUT = 1 #How long to sit looking for the correct character sequence.
+ACK_WAIT = 0.1 # How long to wait for acknowledgements that aren't checked to arrive
 
 DEFAULT_LOGGING_LEVEL = logging.WARN
 
 MSG_CHAR_1 = b'\x42' # First character to be recieved in a valid packet
 MSG_CHAR_2 = b'\x4d' # Second character to be recieved in a valid packet
+MSG_HEADER = MSG_CHAR_1 + MSG_CHAR_2 # Every data packet starts with these two characters
+MSG_LENGTH = 32 # Length of a data packet including the header and checksum
+MAX_BUFFER = 4096 # Most bytes kept in the parser while waiting for a complete packet
+DEFAULT_QUEUE_LENGTH = 600 # Most readings kept by the background reader (10 minutes of packets)
+DEFAULT_MAX_AGE = 2 # Oldest the newest reading can be for read() to use it when reading in the background
+MSG_PM_OFFSET = 6 # The PM2.5 and PM10 values start this many bytes into a packet
+MSG_PM_VALUES = struct.Struct('>HH') # PM2.5 then PM10, each a 2 byte big-endian number
+MSG_CHECKSUM = struct.Struct('>H') # The last 2 bytes of a packet, big-endian
 CMD_POS_ACK_CHAR = b'\xa5' # Character x2 to be recieved in a positive acknowledgement
 CMD_NEG_ACK_CHAR = b'\x96' # Character x2 to be recieved in a negative acknowledgement
 
 
 class HoneywellReading(object):
     """
-        Describes a single reading from the Honeywell sensor
+        Describes a single reading from the Honeywell sensor.
+        timestamp is when it was read in seconds since the epoch (from time.time())
+        and monotonic is the same moment from time.monotonic(), for working out
+        intervals. pm25 and pm10 are whole numbers of micrograms per cubic metre.
     """
-    def __init__(self, line):
+    __slots__ = ('timestamp', 'monotonic', 'pm25', 'pm10')
+
+    def __init__(self, pm25, pm10, timestamp=None, monotonic=None):
+        self.timestamp = time.time() if timestamp is None else timestamp
+        self.monotonic = time.monotonic() if monotonic is None else monotonic
+        self.pm25 = pm25
+        self.pm10 = pm10
+
+    @classmethod
+    def from_buffer(cls, buffer, offset=0):
         """
-            Takes a line from the Honeywell serial port and converts it into
+            Takes a packet starting at offset in buffer (bytes, bytearray or
+            memoryview) from the Honeywell serial port and converts it into
             an object containing the data
         """
-        self.timestamp = datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
-        self.pm10 = round(line[8] * 256 + line[9], 1)
-        self.pm25 = round(line[6] * 256 + line[7], 1)
+        pm25, pm10 = MSG_PM_VALUES.unpack_from(buffer, offset + MSG_PM_OFFSET)
+        return cls(pm25, pm10)
+
+    def utc_timestamp(self):
+        """
+            Returns the timestamp as text in UTC time, e.g. 2019-07-01 10:00:00
+        """
+        return datetime.utcfromtimestamp(self.timestamp).strftime("%Y-%m-%d %H:%M:%S")
 
     def __str__(self):
         return (
             "%s,%s,%s" %
-            (self.timestamp, self.pm10, self.pm25))
+            (self.utc_timestamp(), self.pm10, self.pm25))
 
 class HoneywellException(Exception):
     """
@@ -47,6 +78,164 @@ class HoneywellException(Exception):
     """
     pass
 
+class FrameParser(object):
+    """
+        Finds the data packets in the bytes read from the serial port.
+        Bytes are added with feed() in whatever size chunks they arrive, and
+        next_frame() returns each complete packet that passes the checksum.
+        Anything that isn't part of a good packet (noise, half a packet from
+        before the port was opened, corrupted packets) is skipped.
+    """
+    def __init__(self, max_buffer=MAX_BUFFER, logger=None):
+        self.buffer = bytearray()
+        self.start = 0 # position of the first byte not looked at yet
+        self.max_buffer = max_buffer
+        self.logger = logger or logging.getLogger("HPMA115S0 Parser")
+        self.frames_found = 0
+        self.checksum_failures = 0
+        self.bytes_skipped = 0
+
+    def feed(self, data):
+        """
+            Adds bytes read from the serial port to the buffer
+        """
+        self.buffer += data
+        pending = len(self.buffer) - self.start
+        if pending > self.max_buffer:
+            # nobody is reading the packets, so throw the oldest bytes away
+            # rather than letting the buffer grow forever
+            self.bytes_skipped += pending - self.max_buffer
+            self.start = len(self.buffer) - self.max_buffer
+        if self.start > self.max_buffer:
+            # the buffer is used like a ring: once enough bytes at the front have been
+            # used up, drop them all in one go instead of after every packet
+            del self.buffer[:self.start]
+            self.start = 0
+
+    def pending(self):
+        """
+            Number of bytes in the buffer not yet turned into packets
+        """
+        return len(self.buffer) - self.start
+
+    def started(self):
+        """
+            True if the bytes in the buffer are the start of a packet (its header, or
+            the first character of it) whose rest hasn't arrived yet
+        """
+        return self.buffer[self.start:self.start + 1] == MSG_CHAR_1
+
+    def needed(self):
+        """
+            Number of bytes still needed to make a complete packet (at least 1)
+        """
+        return max(1, MSG_LENGTH - self.pending())
+
+    def read_size(self, waiting):
+        """
+            Number of bytes to read from the serial port when waiting bytes are
+            there: all of them if they fit in the buffer, and at least enough to
+            complete a packet
+        """
+        return max(self.needed(), min(waiting, self.max_buffer - self.pending()))
+
+    def clear(self):
+        """
+            Throws away everything in the buffer
+        """
+        self.bytes_skipped += self.pending()
+        self.buffer = bytearray()
+        self.start = 0
+
+    @staticmethod
+    def checksum(buffer, offset=0):
+        """
+            Returns the checksum worked out from a packet starting at offset in
+            buffer, and the checksum sent in its last 2 bytes. The sent one should
+            be the sum of all the other bytes. Nothing is copied: the sum is done
+            over a memoryview of the buffer.
+        """
+        with memoryview(buffer) as view:
+            calc = sum(view[offset:offset + MSG_LENGTH - 2])
+        sent, = MSG_CHECKSUM.unpack_from(buffer, offset + MSG_LENGTH - 2)
+        return calc, sent
+
+    @classmethod
+    def checksum_ok(cls, buffer, offset=0):
+        calc, sent = cls.checksum(buffer, offset)
+        return calc == sent
+
+    def next_offset(self):
+        """
+            Finds the next good packet in the buffer and returns where it starts,
+            or None if there isn't a complete one yet
+        """
+        buffer = self.buffer
+        while True:
+            found = buffer.find(MSG_HEADER, self.start)
+            if found < 0:
+                # no header, so everything can go apart from a last byte that
+                # might be the first half of a header
+                keep = 1 if buffer[-1:] == MSG_CHAR_1 else 0
+                self.bytes_skipped += max(0, len(buffer) - keep - self.start)
+                self.start = max(self.start, len(buffer) - keep)
+                return None
+            self.bytes_skipped += found - self.start
+            self.start = found
+            if found + MSG_LENGTH > len(buffer):
+                return None # the rest of the packet hasn't arrived yet
+            calc, sent = self.checksum(buffer, found)
+            if calc == sent:
+                self.start = found + MSG_LENGTH
+                self.frames_found += 1
+                return found
+            # a bad packet, or the header characters appeared in the middle of other data.
+            # Skip just the first header character and look again, so a real packet that
+            # starts inside the bad one is still found
+            self.logger.error("Checksum failure %d != %d", sent, calc)
+            self.checksum_failures += 1
+            self.bytes_skipped += 1
+            self.start = found + 1
+
+    def next_frame(self):
+        """
+            Returns the next good packet in the buffer as bytes, or None if there
+            isn't a complete one yet
+        """
+        found = self.next_offset()
+        if found is None:
+            return None
+        return bytes(self.buffer[found:found + MSG_LENGTH])
+
+    def next_reading(self):
+        """
+            Returns a HoneywellReading for the next good packet in the buffer, or
+            None if there isn't a complete one yet. The values are read straight
+            out of the buffer without copying the packet
+        """
+        found = self.next_offset()
+        if found is None:
+            return None
+        return HoneywellReading.from_buffer(self.buffer, found)
+
+    def frames(self):
+        """
+            Yields every good packet in the buffer
+        """
+        frame = self.next_frame()
+        while frame is not None:
+            yield frame
+            frame = self.next_frame()
+
+    def readings(self):
+        """
+            Yields a HoneywellReading for every good packet in the buffer
+        """
+        reading = self.next_reading()
+        while reading is not None:
+            yield reading
+            reading = self.next_reading()
+
 class Honeywell(object):
     """
         Actual interface to the HPMA115S0 sensor
@@ -71,6 +260,8 @@ class Honeywell(object):
         self.logger.info("Serial Timeout: %s", self.serial_timeout)
         self.read_timeout = read_timeout
         self.logger.info("Read Timeout: %s", self.read_timeout)
+        # how long the line takes to carry a whole packet (8 data bits plus a start and stop bit per byte)
+        self.packet_time = MSG_LENGTH * 10.0 / self.baud
         try:
             self.serial = Serial(
                 port=self.port, baudrate=self.baud,
@@ -79,7 +270,13 @@ class Honeywell(object):
         except SerialException as exp:
             self.logger.error(str(exp))
             raise HoneywellException(str(exp))
+        self.parser = FrameParser(logger=self.logger)
+        self.background = None # the BackgroundReader, when there is one
         self.stop_measuring(check_ack=False)
+        # the sensor still acknowledges those commands, so throw the acknowledgements
+        # away or they would be taken as the answer to start_measuring()
+        time.sleep(ACK_WAIT)
+        self.serial.reset_input_buffer()
 
     def start_measuring(self):
         """
@@ -96,6 +293,7 @@ class Honeywell(object):
         """
             Disables auto-send mode and stops the fan running in the sensor 
         """
+        self.serial.reset_input_buffer() # throw away packets nobody has read
         self.serial.write(b'\x68\x01\x20\x77') # Disable auto send
         self.serial.flush() # flush the buffer
         if check_ack:
@@ -113,62 +311,219 @@ class Honeywell(object):
 
     def _check_cmd_ack(self, errormsg):
         """
-            Checks acknowledgement for certain commands
-        """
-        ack_inp1 = self.serial.read() # read the next character
-        print(ack_inp1)
-        if ack_inp1 == CMD_POS_ACK_CHAR:
-            ack_inp2 = self.serial.read() # read the next character
-            print(ack_inp2)
-            if ack_inp2 == CMD_POS_ACK_CHAR:
-                self.logger.debug(errormsg)
-            else:
-                self.logger.error(errormsg)
-                raise HoneywellException(errormsg)
-        else:
-            self.logger.error(errormsg)
-            raise HoneywellException(errormsg)
-
-    def _verify(self, recv):
-        """
-            Uses the last 2 bytes of the data packet from the Honeywell sensor
-            to verify that the data recived is correct
-        """
-        calc = 0
-        ord_arr = []
-        for c in bytearray(recv[:-2]): #Add all the bytes together except the checksum bytes
-            calc += c
-            ord_arr.append(c)
-        self.logger.debug(str(ord_arr))
-        sent = (recv[-2] << 8) | recv[-1] # Combine the 2 bytes together
-        if sent != calc:
-            self.logger.error("Checksum failure %d != %d", sent, calc)
-            raise HoneywellException("Checksum failure")
+            Checks acknowledgement for certain commands. If auto-send is on the
+            sensor may still be part way through sending a data packet, so data
+            packets and anything else that isn't an acknowledgement are skipped
+            (for up to the read timeout)
+        """
+        deadline = time.monotonic() + self.read_timeout
+        try:
+            while time.monotonic() < deadline:
+                self._limit_timeout(deadline)
+                ack_inp1 = self.serial.read() # read the next character
+                self.logger.debug("Acknowledgement character 1: %s", ack_inp1)
+                if ack_inp1 in (CMD_POS_ACK_CHAR, CMD_NEG_ACK_CHAR):
+                    ack_inp2 = self.serial.read() # read the next character
+                    self.logger.debug("Acknowledgement character 2: %s", ack_inp2)
+                    if ack_inp1 == ack_inp2 == CMD_POS_ACK_CHAR:
+                        self.logger.debug(errormsg)
+                        return
+                    if ack_inp1 == ack_inp2 == CMD_NEG_ACK_CHAR:
+                        break
+                elif ack_inp1 == MSG_CHAR_1:
+                    if self.serial.read() == MSG_CHAR_2:
+                        self.serial.read(MSG_LENGTH - 2) # skip the rest of a data packet
+                elif not ack_inp1:
+                    break # nothing sent before the timeout
+        finally:
+            self._restore_timeout()
+        self.logger.error(errormsg)
+        raise HoneywellException(errormsg)
+
+    def _limit_timeout(self, deadline):
+        """
+            Makes the serial port give up waiting at the deadline (a time.monotonic()
+            time) if that comes before the serial timeout, so a read never runs over
+            the read timeout
+        """
+        timeout = min(self.serial_timeout, max(0.0, deadline - time.monotonic()))
+        if self.serial.timeout != timeout:
+            self.serial.timeout = timeout
+
+    def _restore_timeout(self):
+        if self.serial.timeout != self.serial_timeout:
+            self.serial.timeout = self.serial_timeout
+
+    def _fill(self, deadline):
+        """
+            Reads everything waiting on the serial port into the parser in one go,
+            or if nothing is waiting, waits (up to the serial timeout, but not past
+            the deadline) for enough bytes to complete a packet
+        """
+        in_waiting = self.serial.in_waiting
+        if not in_waiting:
+            self._limit_timeout(deadline)
+        self.parser.feed(self.serial.read(self.parser.read_size(in_waiting)))
 
     def read(self, perform_flush=True):
         """
             Reads a line from the serial port and return
             if perform_flush is set to true it will flush the serial buffer
             before performing the read, otherwise, it'll just read the first
-            item in the buffer
+            item in the buffer.
+            If the packets are being read in the background (start_background())
+            it returns the newest one straight away, without reading the serial port.
+            The header of a packet must arrive within the read timeout, and then the
+            rest of it is allowed one packet time more.
         """
-        recv = b''
-        start = datetime.utcnow() #Start timer
+        if self.background is not None:
+            reading = self.background.latest(DEFAULT_MAX_AGE)
+            if reading is None:
+                raise HoneywellException("No message received")
+            return reading
+        header_deadline = time.monotonic() + self.read_timeout #Start timer
+        packet_deadline = header_deadline + self.packet_time
         if perform_flush:
             self.serial.flush() #Flush any data in the buffer
-        while(
-                datetime.utcnow() <
-                (start + timedelta(seconds=self.read_timeout))):
-            inp = self.serial.read() # Read a character from the input
-            if inp == MSG_CHAR_1: # check it matches
-                recv += inp # if it does add it to recieve string
-                inp = self.serial.read() # read the next character
-                if inp == MSG_CHAR_2: # check it's what's expected
-                    recv += inp # att it to the recieve string
-                    recv += self.serial.read(30) # read the remaining 30 bytes
-                    self._verify(recv) # verify the checksum
-                    return HoneywellReading(recv) # convert to reading object
-            #If the character isn't what we are expecting loop until timeout
+            self.parser.clear() # and anything already read but not used
+        try:
+            while True:
+                reading = self.parser.next_reading() # convert to reading object
+                if reading is not None:
+                    return reading
+                deadline = packet_deadline if self.parser.started() else header_deadline
+                if time.monotonic() >= deadline:
+                    break
+                self._fill(deadline)
+                #If there isn't a good packet yet loop until timeout
+        finally:
+            self._restore_timeout()
         raise HoneywellException("No message received")
 
+    def start_background(self, max_readings=DEFAULT_QUEUE_LENGTH):
+        """
+            Starts reading every packet the sensor sends (once start_measuring()
+            has turned on auto-send) in a background thread, and returns the
+            BackgroundReader. Until stop_background() is called nothing else may
+            use the serial port.
+        """
+        if self.background is None:
+            self.background = BackgroundReader(self, max_readings)
+            self.background.start()
+        return self.background
+
+    def stop_background(self):
+        """
+            Stops the background reader (waits up to the serial timeout for it)
+        """
+        if self.background is not None:
+            self.background.stop()
+            self.background = None
+
+    def read_available(self):
+        """
+            Reads everything waiting on the serial port without waiting for
+            more, and returns a list with a reading for every good packet in it
+        """
+        readings = []
+        while True:
+            readings.extend(self.parser.readings())
+            waiting = self.serial.in_waiting
+            if not waiting:
+                return readings
+            self.parser.feed(self.serial.read(min(waiting, self.parser.read_size(waiting))))
+
+
+class BackgroundReader(threading.Thread):
+    """
+        Reads every packet the sensor sends in auto-send mode (about one a second)
+        into a queue of the newest max_readings readings, so none are thrown away
+        and nobody has to wait for the serial port to get a reading.
+        Made by Honeywell.start_background().
+    """
+    def __init__(self, sensor, max_readings=DEFAULT_QUEUE_LENGTH):
+        threading.Thread.__init__(self, name="HPMA115S0 reader")
+        self.daemon = True
+        self.sensor = sensor
+        self.logger = sensor.logger
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.queue = collections.deque(maxlen=max_readings)
+        self.newest = None
+        self.readings = 0 # readings received
+        self.dropped = 0 # readings dropped from the queue before anybody took them
+        self.errors = 0 # serial port errors
+
+    def run(self):
+        serial = self.sensor.serial
+        parser = self.sensor.parser
+        parser.clear() # anything left over from before is stale
+        while not self.stopping.is_set():
+            try:
+                # waits (up to the serial timeout) for at least the rest of a packet
+                data = serial.read(parser.read_size(serial.in_waiting))
+            except SerialException as exp:
+                self.logger.error("Background read failed: %s", exp)
+                self.errors += 1
+                self.stopping.wait(1)
+                continue
+            parser.feed(data)
+            readings = list(parser.readings())
+            if not readings:
+                continue
+            with self.lock:
+                self.dropped += max(0, len(self.queue) + len(readings) - self.queue.maxlen)
+                self.queue.extend(readings)
+                self.readings += len(readings)
+                self.newest = readings[-1]
 
+    def stop(self):
+        self.stopping.set()
+        self.join(self.sensor.serial_timeout + 1)
+
+    def latest(self, max_age=None):
+        """
+            Returns the newest reading, or None if there isn't one or it's more
+            than max_age seconds old. It stays in the queue.
+        """
+        with self.lock:
+            reading = self.newest
+        if reading is None or (max_age is not None and time.monotonic() - reading.monotonic > max_age):
+            return None
+        return reading
+
+    def drain(self):
+        """
+            Returns all the readings in the queue, oldest first, and empties it
+        """
+        with self.lock:
+            readings = list(self.queue)
+            self.queue.clear()
+        return readings
+
+    def window(self, start, end=None):
+        """
+            Returns the readings in the queue from between the monotonic times
+            start and end (now if not given), leaving them in the queue
+        """
+        with self.lock:
+            readings = list(self.queue)
+        return [r for r in readings if r.monotonic >= start and (end is None or r.monotonic < end)]
+
+    @staticmethod
+    def stats(readings):
+        """
+            Returns a dictionary of aggregator.ChannelStats for pm10 and pm25
+            worked out from a list of readings
+        """
+        window = aggregator.WindowAggregator(('pm10', 'pm25'), window=max(1, len(readings)))
+        for reading in readings:
+            window.add_values(('pm10', 'pm25'), (reading.pm10, reading.pm25))
+        return window.stats()
+
+    def window_stats(self, start, end=None):
+        """
+            Returns the statistics for pm10 and pm25 (see stats()) of the readings
+            from between the monotonic times start and end
+        """
+        return self.stats(self.window(start, end))
@@ -0,0 +1,232 @@
+"""
+    Emulates a Honeywell HPMA115S0 particulate sensor on a pseudo-terminal, so
+    honeywell.py can be tested and benchmarked on any Linux computer without the
+    real sensor. It isn't used by the sensor node itself.
+    The emulator answers the same commands as the real sensor (start/stop
+    measuring, enable/disable auto-send) with 0xA5 0xA5 (or 0x96 0x96 if told to
+    refuse them), and while measuring with auto-send on it sends 32 byte data
+    packets starting 0x42 0x4D, paced to the baud rate so the bytes arrive as
+    they would down a real serial line.
+    To make it easy to check nothing is lost or made up, the PM2.5 and PM10
+    values in each packet are a sequence number (PM2.5 the low 16 bits, PM10
+    the high 16 bits), and the time each good packet finished sending is kept
+    in send_times. Noise bytes, packets cut short and packets with a bad
+    checksum can be mixed in.
+    The emulator runs in its own process (start_process()) so it doesn't share
+    the CPU time or the GIL of the driver being measured, or in a thread (start()).
+"""
+
+import multiprocessing
+import os
+import random
+import select
+import threading
+import time
+import tty
+
+CMD_START_MEASURING = b'\x68\x01\x01\x96'
+CMD_STOP_MEASURING = b'\x68\x01\x02\x95'
+CMD_ENABLE_AUTO_SEND = b'\x68\x01\x40\x57'
+CMD_DISABLE_AUTO_SEND = b'\x68\x01\x20\x77'
+CMD_LENGTH = 4 # Every command the driver sends is 4 bytes, starting 0x68
+POS_ACK = b'\xa5\xa5'
+NEG_ACK = b'\x96\x96'
+MSG_LENGTH = 32
+
+SEND_TIMES = 65536 # Send times kept, by sequence number
+CHUNK_SECONDS = 0.002 # Bytes are written in chunks this long at the baud rate
+# counters kept in shared memory so they can be read while the emulator runs in another process
+COUNTERS = ('frames', 'good_frames', 'corrupt_frames', 'partial_frames', 'noise_bytes', 'commands', 'nacks')
+
+
+class HoneywellEmulator(object):
+    """
+        A pretend HPMA115S0. port is the name of the serial port for the driver
+        to open. baud sets how fast bytes are sent (0 sends them as fast as they
+        are read), period is the time between packets (the real sensor sends one
+        a second, 0 sends them back to back). noise_rate, partial_rate and
+        corrupt_rate are the chances of noise bytes before a packet, a packet being
+        cut short and a packet having a bad checksum, and nack_rate the chance of
+        refusing a command.
+    """
+    def __init__(self, baud=9600, period=1.0, seed=None, noise_rate=0.0, partial_rate=0.0,
+                 corrupt_rate=0.0, nack_rate=0.0):
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.master)
+        tty.setraw(self.slave)
+        self.port = os.ttyname(self.slave)
+        self.baud = baud
+        self.period = period
+        self.random = random.Random(seed)
+        self.noise_rate = noise_rate
+        self.partial_rate = partial_rate
+        self.corrupt_rate = corrupt_rate
+        self.nack_rate = nack_rate
+        self.measuring = False
+        self.auto_send = False
+        self.commands = bytearray()
+        self.sequence = 0
+        self.line_free = 0.0 # time.monotonic() when the last byte written has been "sent"
+        self.counters = multiprocessing.Array('l', len(COUNTERS), lock=False)
+        self.send_times = multiprocessing.Array('d', SEND_TIMES, lock=False)
+        self.thread = None
+        self.process = None
+        self.running = False
+
+    def count(self, name, amount=1):
+        self.counters[COUNTERS.index(name)] += amount
+
+    def counts(self):
+        """
+            Returns the counters as a dictionary
+        """
+        return dict(zip(COUNTERS, self.counters[:]))
+
+    def sent_at(self, sequence):
+        """
+            Returns time.monotonic() when the good packet with this sequence
+            number finished sending
+        """
+        return self.send_times[sequence % SEND_TIMES]
+
+    @staticmethod
+    def frame(pm25, pm10):
+        """
+            Returns a data packet with a good checksum
+        """
+        frame = bytearray(MSG_LENGTH)
+        frame[0:4] = b'\x42\x4d\x00\x1c'
+        frame[6:10] = bytes([pm25 >> 8, pm25 & 0xff, pm10 >> 8, pm10 & 0xff])
+        checksum = sum(frame[:MSG_LENGTH - 2])
+        frame[MSG_LENGTH - 2:] = bytes([checksum >> 8, checksum & 0xff])
+        return frame
+
+    def write(self, data):
+        """
+            Writes bytes to the port, no faster than the baud rate allows
+        """
+        if not self.baud:
+            self.write_all(data)
+            return
+        seconds_per_byte = 10.0 / self.baud # 8 data bits, a start bit and a stop bit
+        chunk = max(1, int(CHUNK_SECONDS / seconds_per_byte))
+        for start in range(0, len(data), chunk):
+            part = data[start:start + chunk]
+            now = time.monotonic()
+            if self.line_free > now:
+                time.sleep(self.line_free - now)
+            self.write_all(part)
+            self.line_free = max(now, self.line_free) + len(part) * seconds_per_byte
+
+    def write_all(self, data):
+        view = memoryview(data)
+        while view:
+            view = view[os.write(self.master, view):]
+
+    def send_frame(self):
+        """
+            Sends the next data packet, perhaps with a fault
+        """
+        self.count('frames')
+        if self.random.random() < self.noise_rate:
+            noise = bytes(self.random.randint(0, 255) for n in range(self.random.randint(1, 8)))
+            self.count('noise_bytes', len(noise))
+            self.write(noise)
+        frame = self.frame(self.sequence & 0xffff, (self.sequence >> 16) & 0xffff)
+        if self.random.random() < self.partial_rate:
+            self.count('partial_frames')
+            self.write(frame[:self.random.randint(2, MSG_LENGTH - 1)])
+            return
+        if self.random.random() < self.corrupt_rate:
+            self.count('corrupt_frames')
+            frame[self.random.randint(4, MSG_LENGTH - 3)] ^= 0xff
+            self.write(frame)
+            return
+        # the packet has arrived once its last byte has, so note the time just before
+        # sending that (setting it after could be too late, as the driver may already have it)
+        self.write(frame[:-1])
+        self.send_times[self.sequence % SEND_TIMES] = max(time.monotonic(), self.line_free)
+        self.write(frame[-1:])
+        self.count('good_frames')
+        self.sequence += 1
+
+    def handle_commands(self):
+        """
+            Answers every complete command received
+        """
+        while len(self.commands) >= CMD_LENGTH:
+            if self.commands[0] != 0x68:
+                del self.commands[0] # not the start of a command
+                continue
+            command = bytes(self.commands[:CMD_LENGTH])
+            del self.commands[:CMD_LENGTH]
+            self.count('commands')
+            known = (CMD_START_MEASURING, CMD_STOP_MEASURING, CMD_ENABLE_AUTO_SEND, CMD_DISABLE_AUTO_SEND)
+            if command not in known or self.random.random() < self.nack_rate:
+                self.count('nacks')
+                self.write(NEG_ACK)
+                continue
+            if command == CMD_START_MEASURING:
+                self.measuring = True
+            elif command == CMD_STOP_MEASURING:
+                self.measuring = False
+            elif command == CMD_ENABLE_AUTO_SEND:
+                self.auto_send = True
+            else:
+                self.auto_send = False
+            self.write(POS_ACK)
+
+    def run(self):
+        """
+            Answers commands and sends packets until stop() is called
+        """
+        next_frame = time.monotonic()
+        while self.running:
+            sending = self.measuring and self.auto_send
+            wait = max(0.0, next_frame - time.monotonic()) if sending else 0.1
+            readable, _, _ = select.select([self.master], [], [], wait)
+            if readable:
+                try:
+                    self.commands += os.read(self.master, 256)
+                except OSError:
+                    return # the port has been closed
+                self.handle_commands()
+                if self.measuring and self.auto_send and not sending:
+                    next_frame = time.monotonic() # just switched on
+                continue
+            if sending and time.monotonic() >= next_frame:
+                self.send_frame()
+                # keep to the period without drifting, unless sending has fallen behind
+                next_frame = max(next_frame + self.period, time.monotonic() - self.period)
+
+    def start(self):
+        """
+            Runs the emulator in a thread
+        """
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name="HPMA115S0 emulator", daemon=True)
+        self.thread.start()
+
+    def start_process(self):
+        """
+            Runs the emulator in its own process. The counters and send times
+            are shared, but other attributes seen from this process don't change.
+        """
+        self.running = True
+        self.process = multiprocessing.get_context('fork').Process(target=self.run, daemon=True)
+        self.process.start()
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.process is not None:
+            self.process.terminate()
+            self.process.join()
+            self.process = None
+
+    def close(self):
+        self.stop()
+        os.close(self.master)
+        os.close(self.slave)
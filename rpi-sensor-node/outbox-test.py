@@ -0,0 +1,222 @@
+# this is just test code, it is not part of the Sensor node
+# it checks that the outbox (outbox.py) doesn't lose messages when the connection to the
+# MQTT broker goes away, or when the program is restarted, using a pretend MQTT client
+# so it can be run on a laptop.
+# run it from the rpi-sensor-node folder with: python3 outbox-test.py
+
+import os
+import json
+import time
+import random
+import tempfile
+import logging
+import threading
+from outbox import Outbox
+import packing
+import publisher
+
+# the outbox logs a warning every time it drops a message or a publish fails,
+# which these tests do on purpose
+logging.getLogger("Outbox").disabled = True
+
+##################################################
+# a local stand-in for the MQTT broker
+##################################################
+
+class FakeMQTTClient(object):
+    """
+        Behaves like the publishAsync() of the AWS IoT MQTT client with the offline
+        queue turned off. Each message is acknowledged ackLatency seconds after it's
+        sent, unless the broker goes away first, in which case the acknowledgement is lost.
+    """
+    def __init__(self, ackLatency=0.01):
+        self.ackLatency = ackLatency
+        self.up = False
+        self.outbox = None
+        self.lock = threading.Lock()
+        self.delivered = [] # the payloads the broker received, in order
+        self.nextMid = 1
+        self.inFlight = 0
+        self.maxInFlight = 0
+        self.connection = 0 # goes up every time the broker comes back
+
+    def publishAsync(self, topic, payload, qos, ackCallback=None):
+        with self.lock:
+            if not self.up:
+                raise Exception("client is offline")
+            mid = self.nextMid
+            self.nextMid += 1
+            self.delivered.append(payload)
+            self.inFlight += 1
+            self.maxInFlight = max(self.maxInFlight, self.inFlight)
+            connection = self.connection
+        threading.Timer(self.ackLatency, self.ack, (mid, connection, ackCallback)).start()
+        return mid
+
+    def ack(self, mid, connection, ackCallback):
+        with self.lock:
+            self.inFlight -= 1
+            if not self.up or connection != self.connection:
+                return # the broker went away, so this acknowledgement never arrives
+        if ackCallback is not None:
+            ackCallback(mid)
+
+    def goUp(self):
+        with self.lock:
+            self.up = True
+            self.connection += 1
+        if self.outbox is not None:
+            self.outbox.set_online(True)
+
+    def goDown(self):
+        with self.lock:
+            self.up = False
+        if self.outbox is not None:
+            self.outbox.set_online(False)
+
+def makeOutbox(client, path, **settings):
+    settings.setdefault('send_rate', 1000)
+    outbox = Outbox(client, path, **settings)
+    client.outbox = outbox
+    outbox.start()
+    return outbox
+
+def payloads(first, count):
+    return ['{{"n":{:d}}}'.format(n) for n in range(first, first + count)]
+
+def check(name, ok):
+    print("{:60s} {}".format(name, "ok" if ok else "FAILED"))
+    if not ok:
+        raise SystemExit(1)
+
+##################################################
+# the tests
+##################################################
+
+directory = tempfile.mkdtemp()
+
+# messages saved while the broker is away are all sent, in order, when it comes back
+client = FakeMQTTClient()
+outbox = makeOutbox(client, os.path.join(directory, 'test1.db'))
+for p in payloads(0, 50):
+    outbox.publishAsync("sensors/data", p, 1)
+time.sleep(0.2)
+check("nothing sent while the broker is away", client.delivered == [])
+client.goUp()
+check("everything sent once it's back", outbox.wait_until_sent(timeout=10))
+check("sent in order", client.delivered == payloads(0, 50))
+check("never more than max_in_flight waiting for an acknowledgement", client.maxInFlight <= outbox.max_in_flight)
+outbox.close()
+
+# the broker keeps going away part way through sending, losing acknowledgements
+client = FakeMQTTClient(ackLatency=0.02)
+acked = []
+outbox = makeOutbox(client, os.path.join(directory, 'test2.db'), ack_timeout=1)
+client.goUp()
+random.seed(1)
+for p in payloads(0, 300):
+    outbox.publishAsync("sensors/data", p, 1, ackCallback=acked.append)
+    if random.random() < 0.05:
+        client.goDown()
+        time.sleep(random.uniform(0, 0.1))
+        client.goUp()
+check("everything sent after the broker going away", outbox.wait_until_sent(timeout=30))
+check("every message arrived at least once", set(payloads(0, 300)) <= set(client.delivered))
+check("ack callback called once for each message", len(acked) == 300)
+print("    ({:d} messages sent again after losing the connection)".format(len(client.delivered) - 300))
+outbox.close()
+
+# the program is restarted before the messages are sent
+client = FakeMQTTClient()
+path = os.path.join(directory, 'test3.db')
+outbox = makeOutbox(client, path)
+for p in payloads(0, 20):
+    outbox.publishAsync("sensors/data", p, 1)
+outbox.close()
+client = FakeMQTTClient()
+outbox = makeOutbox(client, path)
+check("messages still there after a restart", len(outbox) == 20)
+client.goUp()
+check("and sent when the broker is there", outbox.wait_until_sent(timeout=10) and client.delivered == payloads(0, 20))
+outbox.close()
+
+# the disk use is limited
+client = FakeMQTTClient()
+outbox = makeOutbox(client, os.path.join(directory, 'test4.db'), max_messages=100)
+for p in payloads(0, 150):
+    outbox.publishAsync("sensors/data", p, 1)
+check("only the newest max_messages messages kept", len(outbox) == 100 and outbox.dropped == 50)
+client.goUp()
+outbox.wait_until_sent(timeout=10)
+check("the oldest ones were dropped", client.delivered == payloads(50, 100))
+outbox.close()
+
+# acknowledged messages are cleared out of the database file
+client = FakeMQTTClient(ackLatency=0)
+path = os.path.join(directory, 'test5.db')
+outbox = makeOutbox(client, path)
+for p in payloads(0, 2000):
+    outbox.publishAsync("sensors/data", 'x' * 500 + p, 1)
+fullSize = os.path.getsize(path) + os.path.getsize(path + '-wal')
+client.goUp()
+outbox.wait_until_sent(timeout=60)
+with outbox.lock:
+    outbox.compact()
+emptySize = os.path.getsize(path) + os.path.getsize(path + '-wal')
+print("    (database and log {:d} bytes with 2000 messages waiting, {:d} bytes once sent)".format(fullSize, emptySize))
+check("database file shrinks once the messages are sent", emptySize < fullSize / 4)
+outbox.close()
+
+# a backlog of packed data messages, replayed several a second once the broker comes back
+# (going away now and again so some are sent twice), keeps every window once it's in DynamoDB.
+# The AWS IoT rule keys each packed item on the sensor and time in its topic (see packing.py)
+class DynamoClient(FakeMQTTClient):
+    def __init__(self, ackLatency=0.01):
+        FakeMQTTClient.__init__(self, ackLatency)
+        self.table = {} # (sensorID, timestamp) -> packed message, like the DynamoDB table
+
+    def publishAsync(self, topic, payload, qos, ackCallback=None):
+        mid = FakeMQTTClient.publishAsync(self, topic, payload, qos, ackCallback)
+        with self.lock:
+            self.table[packing.topic_key(topic)] = payload
+        return mid
+
+client = DynamoClient(ackLatency=0.02)
+outbox = makeOutbox(client, os.path.join(directory, 'test6.db'), ack_timeout=1)
+dataPublisher = publisher.BatchPublisher(outbox, "3", encoding="packed", batch_windows=2)
+timestamps = [packing.seconds_timestamp(1561939200 + n * 200) for n in range(400)]
+for timestamp in timestamps:
+    record = dict((field, 1.0) for field in packing.FIELDS)
+    record["timestamp"] = timestamp
+    dataPublisher.add(record)
+client.goUp()
+random.seed(2)
+while len(outbox):
+    time.sleep(0.05)
+    if random.random() < 0.1:
+        client.goDown()
+        client.goUp()
+stored = [record["timestamp"] for payload in client.table.values() for record in packing.decode(payload)]
+print("    ({:d} packed messages sent, {:d} of them again)".format(len(client.delivered), len(client.delivered) - 200))
+check("one packed item for each message", len(client.table) == 200)
+check("every window stored once after replaying the backlog", sorted(stored) == timestamps)
+outbox.close()
+
+# a batch that isn't full is still sent once its oldest window has waited batch_seconds,
+# without waiting for another window to be added
+client = FakeMQTTClient()
+client.goUp()
+dataPublisher = publisher.BatchPublisher(client, "3", batch_windows=10, batch_seconds=0.2)
+dataPublisher.add({"timestamp": "2019-07-01 00:00:00", "pm25": 1.0})
+dataPublisher.add({"timestamp": "2019-07-01 00:03:20", "pm25": 2.0})
+time.sleep(0.1)
+check("batch held until batch_seconds", len(client.delivered) == 0)
+time.sleep(0.4)
+check("then sent without another window being added", len(client.delivered) == 1
+      and len(json.loads(client.delivered[0])["batch"]) == 2)
+dataPublisher.add({"timestamp": "2019-07-01 00:06:40", "pm25": 3.0})
+dataPublisher.flush()
+time.sleep(0.4)
+check("the timer doesn't send a batch that was already sent", len(client.delivered) == 2)
+
+print("all outbox tests passed")
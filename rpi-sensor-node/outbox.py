@@ -0,0 +1,276 @@
+"""
+    Store-and-forward queue for the messages sent by the sensor node.
+    Every message is saved to an SQLite database on the SD card before it is sent, and
+    only deleted once AWS IoT has acknowledged it (QoS 1 puback). If the network is down,
+    or the program is restarted (it exits and is restarted by systemd on many errors),
+    the messages that weren't acknowledged are sent again once the MQTT client is online,
+    oldest first, a few at a time so the connection isn't flooded.
+    The AWS IoT client's own offline queue only holds 500 messages in memory, so this
+    replaces it. A message may be sent twice if an acknowledgement is lost, but as each
+    message is keyed on the sensor and timestamp in DynamoDB the second copy just
+    overwrites the first.
+"""
+
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+DEFAULT_LOGGING_LEVEL = logging.WARN
+
+# the database is kept next to this file unless another path is given
+DEFAULT_OUTBOX_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "outbox.db")
+DEFAULT_MAX_MESSAGES = 50000 # Most messages kept, the oldest are dropped after this (about a year of data)
+DEFAULT_MAX_IN_FLIGHT = 10 # Most messages sent but not yet acknowledged
+DEFAULT_SEND_RATE = 5 # Most messages sent per second when catching up
+DEFAULT_ACK_TIMEOUT = 120 # Seconds to wait for an acknowledgement before sending again
+COMPACT_EVERY = 100 # Tidy up the database file after this many acknowledgements
+WAL_SIZE_LIMIT = 1024 * 1024 # Largest the write-ahead log file is left at after a checkpoint
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    topic TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    created REAL NOT NULL
+)
+"""
+
+
+class Outbox(object):
+    """
+        The queue of messages waiting to be sent and acknowledged. It has the same
+        publishAsync() and publish() as the AWS IoT MQTT client so it can be used in
+        its place. A background thread sends the messages whenever the client is
+        online: set_online() must be called from the client's onOnline and onOffline
+        callbacks. latency_callback(round_trip, delivery) is called for every
+        acknowledged message with the seconds from it being sent to being acknowledged
+        (None if it was sent before the program started), and from it being saved.
+    """
+    def __init__(self, client, path=DEFAULT_OUTBOX_PATH, max_messages=DEFAULT_MAX_MESSAGES,
+                 max_in_flight=DEFAULT_MAX_IN_FLIGHT, send_rate=DEFAULT_SEND_RATE,
+                 ack_timeout=DEFAULT_ACK_TIMEOUT, latency_callback=None, log_level=DEFAULT_LOGGING_LEVEL):
+        self.logger = logging.getLogger("Outbox")
+        self.logger.setLevel(log_level)
+        self.client = client
+        self.path = path
+        self.max_messages = max_messages
+        self.max_in_flight = max_in_flight
+        self.send_rate = send_rate
+        self.ack_timeout = ack_timeout
+        self.latency_callback = latency_callback
+        self.lock = threading.Lock()
+        self.changed = threading.Condition(self.lock) # signalled when there's something to send
+        self.online = False
+        self.stopping = False
+        self.in_flight = {} # message id -> time.monotonic() when it was sent
+        self.ack_callbacks = {} # message id -> function to call when it's acknowledged
+        self.acked_since_compact = 0
+        self.dropped = 0
+        # the acknowledgement callbacks come from the MQTT client's thread, so the connection
+        # is shared between threads (always while holding self.lock)
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        # write-ahead logging: a message is safely on disk once its insert returns, and a
+        # crash part way through a write can't damage the messages already saved
+        # (auto_vacuum has to be set before anything else is written to a new database)
+        self.db.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=FULL")
+        self.db.execute("PRAGMA journal_size_limit=%d" % WAL_SIZE_LIMIT)
+        self.db.execute(SCHEMA)
+        self.thread = threading.Thread(target=self.run, name="outbox sender")
+        self.thread.daemon = True
+
+    def start(self):
+        """
+            Starts sending the messages in the background
+        """
+        self.thread.start()
+
+    def stop(self, timeout=None):
+        """
+            Stops the sending thread, any messages not yet acknowledged stay
+            on disk and are sent the next time the program runs
+        """
+        with self.lock:
+            self.stopping = True
+            self.changed.notify_all()
+        if self.thread.is_alive():
+            self.thread.join(timeout)
+
+    def close(self):
+        self.stop()
+        with self.lock:
+            self.db.close()
+
+    def set_online(self, online):
+        """
+            Tells the outbox whether the MQTT client is connected. When it comes back
+            online every message that was sent but not acknowledged is sent again.
+        """
+        with self.lock:
+            self.online = online
+            if online:
+                self.in_flight.clear()
+            self.changed.notify_all()
+
+    def put(self, topic, payload, ack_callback=None):
+        """
+            Saves a message to be sent, and returns its id
+        """
+        with self.lock:
+            cursor = self.db.execute("INSERT INTO messages (topic, payload, created) VALUES (?, ?, ?)",
+                                     (topic, payload, time.time()))
+            message_id = cursor.lastrowid
+            if ack_callback is not None:
+                self.ack_callbacks[message_id] = ack_callback
+            self.enforce_limit()
+            self.changed.notify_all()
+        return message_id
+
+    def publishAsync(self, topic, payload, qos=1, ackCallback=None):
+        """
+            Same as AWSIoTMQTTClient.publishAsync(), the message is saved and sent
+            in the background. ackCallback is called with the MQTT message id once
+            it is acknowledged.
+        """
+        return self.put(topic, payload, ackCallback)
+
+    def publish(self, topic, payload, qos=1, timeout=10):
+        """
+            Saves a message and waits up to timeout seconds for it to be acknowledged.
+            Returns True if it was, if not it stays on disk to be sent later.
+        """
+        message_id = self.put(topic, payload)
+        return self.wait_until_sent(message_id, timeout)
+
+    def wait_until_sent(self, message_id=None, timeout=10):
+        """
+            Waits until a message (or with no message_id, every message) has been
+            acknowledged, for up to timeout seconds. Returns True if it was.
+        """
+        deadline = time.monotonic() + timeout
+        with self.lock:
+            while self.waiting(message_id):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self.changed.wait(remaining)
+        return True
+
+    def waiting(self, message_id=None):
+        # true if the message (or any message) is still in the outbox, the lock must be held
+        if message_id is None:
+            return self.db.execute("SELECT 1 FROM messages LIMIT 1").fetchone() is not None
+        return self.db.execute("SELECT 1 FROM messages WHERE id = ?", (message_id,)).fetchone() is not None
+
+    def __len__(self):
+        with self.lock:
+            return self.db.execute("SELECT COUNT(*) FROM messages").fetchone()[0]
+
+    def stats(self):
+        """
+            Returns the messages waiting, how many of them are in flight and how many
+            have been dropped, as a dictionary
+        """
+        with self.lock:
+            return {"messages": self.db.execute("SELECT COUNT(*) FROM messages").fetchone()[0],
+                    "in_flight": len(self.in_flight), "dropped": self.dropped}
+
+    def enforce_limit(self):
+        # keep the database to at most max_messages messages by dropping the oldest,
+        # the lock must be held
+        count = self.db.execute("SELECT COUNT(*) FROM messages").fetchone()[0]
+        if count > self.max_messages:
+            excess = count - self.max_messages
+            self.db.execute("DELETE FROM messages WHERE id IN (SELECT id FROM messages ORDER BY id LIMIT ?)", (excess,))
+            self.dropped += excess
+            oldest = self.db.execute("SELECT MIN(id) FROM messages").fetchone()[0]
+            for message_id in [m for m in self.in_flight if oldest is None or m < oldest]:
+                del self.in_flight[message_id]
+                self.ack_callbacks.pop(message_id, None)
+            self.logger.warning("outbox full, dropped the %d oldest messages", excess)
+
+    def acknowledged(self, message_id, mid):
+        """
+            Called (from the MQTT client's thread) when a message has been acknowledged
+        """
+        latency = None
+        with self.lock:
+            sent = self.in_flight.pop(message_id, None)
+            if self.latency_callback is not None:
+                created = self.db.execute("SELECT created FROM messages WHERE id = ?", (message_id,)).fetchone()
+                if created is not None:
+                    latency = (None if sent is None else time.monotonic() - sent, time.time() - created[0])
+            self.db.execute("DELETE FROM messages WHERE id = ?", (message_id,))
+            callback = self.ack_callbacks.pop(message_id, None)
+            self.acked_since_compact += 1
+            if self.acked_since_compact >= COMPACT_EVERY:
+                self.compact()
+            self.changed.notify_all()
+        if latency is not None:
+            self.latency_callback(*latency)
+        if callback is not None:
+            callback(mid)
+
+    def compact(self):
+        # give the space used by acknowledged messages back to the SD card: free the unused
+        # pages, then copy the write-ahead log into the database and empty it. The lock must be held
+        self.acked_since_compact = 0
+        # (run as a script, as execute() only frees one page)
+        self.db.executescript("PRAGMA incremental_vacuum;")
+        self.db.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchall()
+
+    def next_to_send(self):
+        # returns the oldest messages that aren't already waiting for an acknowledgement,
+        # up to the number that can be in flight. The lock must be held
+        now = time.monotonic()
+        for message_id, sent in list(self.in_flight.items()):
+            if now - sent > self.ack_timeout:
+                # never acknowledged, so send it again
+                del self.in_flight[message_id]
+        room = self.max_in_flight - len(self.in_flight)
+        if room <= 0:
+            return []
+        rows = self.db.execute("SELECT id, topic, payload FROM messages ORDER BY id LIMIT ?",
+                               (room + len(self.in_flight),)).fetchall()
+        return [row for row in rows if row[0] not in self.in_flight][:room]
+
+    def run(self):
+        # the sending thread
+        while True:
+            with self.lock:
+                while not self.stopping and not (self.online and self.has_work()):
+                    # wake up now and again to resend anything not acknowledged in time
+                    self.changed.wait(self.ack_timeout)
+                if self.stopping:
+                    return
+                batch = self.next_to_send()
+                for message_id, topic, payload in batch:
+                    self.in_flight[message_id] = time.monotonic()
+            for message_id, topic, payload in batch:
+                try:
+                    self.client.publishAsync(topic, payload, 1,
+                                             ackCallback=lambda mid, message_id=message_id: self.acknowledged(message_id, mid))
+                except Exception as exp: # pylint: disable=broad-except
+                    # the client went offline, it will all be sent again when it's back
+                    self.logger.warning("publish failed: %s", exp)
+                    with self.lock:
+                        self.in_flight.pop(message_id, None)
+                        self.online = False
+                    break
+                # spread the messages out when catching up after being offline
+                time.sleep(1.0 / self.send_rate)
+            if not batch:
+                # everything is in flight, wait for acknowledgements
+                with self.lock:
+                    if not self.stopping:
+                        self.changed.wait(1.0)
+
+    def has_work(self):
+        # true if there are messages that can be sent now, the lock must be held
+        if len(self.in_flight) >= self.max_in_flight:
+            return False
+        count = self.db.execute("SELECT COUNT(*) FROM messages").fetchone()[0]
+        return count > len(self.in_flight)
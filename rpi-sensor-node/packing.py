@@ -0,0 +1,136 @@
+"""
+    Compact binary encoding for the data messages.
+    Instead of JSON with long key names, each window's readings are packed into a
+    fixed layout of 28 bytes (little-endian):
+        uint32   timestamp, local time as seconds since 1970-01-01 00:00:00
+        float32  temperature, humidity, pm25, pm10, bmp180_temperature, bmp180_airpressure
+    after a 3 byte header:
+        uint8    format version (PACKED_VERSION)
+        uint16   number of records that follow
+    Missing readings are NaN. Records from a node using the deadband filter (deadband.py)
+    also say how long the values they leave out are held for, so they use version 2 of
+    the layout, which has one more field on the end of each record (32 bytes):
+        uint32   hold, in seconds (0 if the record doesn't have one)
+    The dashboard decodes these layouts in dash/dynamoDecoder.py, so if they are changed
+    the version must go up and the decoder must be changed to match.
+
+    Packed messages are published to sensors/packed/<sensor id>/<seconds>, where seconds
+    is the timestamp of the newest record in the message (as in the header above). As
+    AWS IoT can't read fields out of a binary message, the rule that saves them to
+    DynamoDB takes both the sensor and the sort key from the topic, e.g.
+        SELECT encode(*, 'base64') AS packed FROM 'sensors/packed/+/+'
+    with a DynamoDB action using ${topic(3)} as the sensorID, and
+    ${parse_time("yyyy-MM-dd HH:mm:ss", topic(4) * 1000)} as the timestamp (in UTC, so
+    it comes out as the same local time the node counted the seconds from), and "data"
+    as the payload column. Keying the item on its newest record, like the JSON batches,
+    rather than on the time the message arrived means messages sent in the same second
+    (the outbox catching up after being offline) don't overwrite each other, and a
+    message sent again after a lost acknowledgement just overwrites its first copy.
+"""
+
+import datetime
+import struct
+
+PACKED_VERSION = 1
+HELD_VERSION = 2
+PACKED_TOPIC = "sensors/packed/{:s}/{:d}" # filled in with the sensor ID and the newest record's seconds
+FIELDS = ('temperature', 'humidity', 'pm25', 'pm10', 'bmp180_temperature', 'bmp180_airpressure')
+HEADER = struct.Struct('<BH')
+RECORD = struct.Struct('<I' + 'f' * len(FIELDS))
+HELD_RECORD = struct.Struct('<I' + 'f' * len(FIELDS) + 'I')
+RECORDS = {PACKED_VERSION: RECORD, HELD_VERSION: HELD_RECORD}
+MAX_RECORDS = 65535 # the most the uint16 count can hold
+
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
+EPOCH = datetime.datetime(1970, 1, 1)
+NAN = float('nan')
+
+
+class PackingException(Exception):
+    """
+        Exception to be thrown if a message can't be packed or unpacked
+    """
+    pass
+
+
+def timestamp_seconds(timestamp):
+    """
+        Turns a 'YYYY-MM-DD HH:MM:SS' local time into whole seconds since 1970
+        (ignoring time zones, so it turns back into the same text)
+    """
+    # slicing the text is several times faster than strptime()
+    delta = datetime.datetime(int(timestamp[0:4]), int(timestamp[5:7]), int(timestamp[8:10]),
+                              int(timestamp[11:13]), int(timestamp[14:16]), int(timestamp[17:19])) - EPOCH
+    return delta.days * 86400 + delta.seconds
+
+
+def seconds_timestamp(seconds):
+    """
+        Turns seconds since 1970 back into 'YYYY-MM-DD HH:MM:SS'
+    """
+    return (EPOCH + datetime.timedelta(seconds=seconds)).strftime(TIMESTAMP_FORMAT)
+
+
+def packed_topic(sensor_id, records):
+    """
+        Returns the topic to publish a packed message holding records to
+    """
+    return PACKED_TOPIC.format(sensor_id, timestamp_seconds(records[-1]["timestamp"]))
+
+
+def topic_key(topic):
+    """
+        Returns the (sensorID, timestamp) the AWS IoT rule keys a packed message's
+        DynamoDB item on, from its topic (used by the tests' pretend brokers)
+    """
+    parts = topic.split("/")
+    return parts[2], seconds_timestamp(int(parts[3]))
+
+
+def encode(records):
+    """
+        Packs a list of window records (dictionaries with a "timestamp" and a
+        value for each of the FIELDS, and perhaps a "hold") into bytes
+    """
+    if len(records) > MAX_RECORDS:
+        raise PackingException("too many records to pack: %d" % len(records))
+    # only use the longer layout when it's needed, so dashboards that only know
+    # version 1 can still read nodes that don't use the deadband filter
+    held = any("hold" in record for record in records)
+    version = HELD_VERSION if held else PACKED_VERSION
+    layout = RECORDS[version]
+    payload = bytearray(HEADER.size + layout.size * len(records))
+    HEADER.pack_into(payload, 0, version, len(records))
+    offset = HEADER.size
+    for record in records:
+        values = [record.get(field) for field in FIELDS]
+        values = [NAN if value is None else value for value in values]
+        if held:
+            values.append(int(record.get("hold") or 0))
+        layout.pack_into(payload, offset, timestamp_seconds(record["timestamp"]), *values)
+        offset += layout.size
+    return bytes(payload)
+
+
+def decode(payload):
+    """
+        Unpacks bytes made by encode() back into a list of records, the
+        timestamps come back as text. Used for checking, the dashboard has
+        its own (numpy) decoder.
+    """
+    if len(payload) < HEADER.size:
+        raise PackingException("message too short")
+    version, count = HEADER.unpack_from(payload, 0)
+    if version not in RECORDS:
+        raise PackingException("unknown packed message version %d" % version)
+    layout = RECORDS[version]
+    if len(payload) != HEADER.size + layout.size * count:
+        raise PackingException("message is %d bytes, expected %d" % (len(payload), HEADER.size + layout.size * count))
+    records = []
+    for values in layout.iter_unpack(payload[HEADER.size:]):
+        record = dict(zip(FIELDS, values[1:1 + len(FIELDS)]))
+        record["timestamp"] = seconds_timestamp(values[0])
+        if version == HELD_VERSION and values[-1]:
+            record["hold"] = values[-1]
+        records.append(record)
+    return records
@@ -0,0 +1,134 @@
+"""
+    Batches the data messages sent by the sensor node.
+    Every message sent to AWS IoT is charged for, and becomes one DynamoDB write, so
+    rather than sending each window's readings on their own, several windows can be
+    packed into one message like this:
+    {"sensor":"1","timestamp":"<time of the newest window>","batch":[{"timestamp":...,"temperature":...,...},...]}
+    The dashboard unpacks the batch back into one row per window (see dash/dynamoDecoder.py).
+    With a batch size of 1 the messages are sent exactly as before, one per window.
+    With the "packed" encoding the windows are sent in the compact binary layout from
+    packing.py instead of JSON, to sensors/packed/<sensor id>/<newest window's seconds>.
+"""
+
+import json
+import logging
+import threading
+import time
+import packing
+
+DEFAULT_LOGGING_LEVEL = logging.WARN
+
+DEFAULT_TOPIC = "sensors/data"
+DEFAULT_BATCH_WINDOWS = 1 # Windows packed into each message, 1 means no batching
+DEFAULT_BATCH_SECONDS = 0 # Longest to hold on to a window before sending, 0 means no limit
+MAX_BATCH_WINDOWS = 500 # DynamoDB items must be under 400KB, each window is about 200 bytes
+ENCODINGS = ("json", "packed")
+DEFAULT_ENCODING = "json"
+
+
+class BatchPublisher(object):
+    """
+        Collects the readings from each window and publishes them once
+        batch_windows windows have been collected, or once the oldest one has been
+        waiting batch_seconds seconds (a timer sends it then, even if no more
+        windows are added).
+        flush() must be called before the program exits so nothing is lost,
+        sensor_run.py does this when it is stopped.
+    """
+    def __init__(self, client, sensor_id, topic=DEFAULT_TOPIC,
+                 batch_windows=DEFAULT_BATCH_WINDOWS, batch_seconds=DEFAULT_BATCH_SECONDS,
+                 encoding=DEFAULT_ENCODING, ack_callback=None, log_level=DEFAULT_LOGGING_LEVEL):
+        self.logger = logging.getLogger("Publisher")
+        self.logger.setLevel(log_level)
+        self.client = client
+        self.sensor_id = sensor_id
+        if encoding not in ENCODINGS:
+            raise ValueError("unknown encoding %s" % encoding)
+        self.encoding = encoding
+        # packed messages go to their own topic, which has its own AWS IoT rule (see topic_for())
+        self.topic = topic
+        self.batch_windows = max(1, min(batch_windows, MAX_BATCH_WINDOWS))
+        self.batch_seconds = batch_seconds
+        self.ack_callback = ack_callback
+        self.lock = threading.Lock()
+        self.pending = [] # the windows not sent yet
+        self.oldest = None # time.monotonic() when the first pending window was added
+        self.timer = None # sends the pending windows once batch_seconds have passed
+
+    def payload(self, records):
+        """
+            Returns the message to send for a list of window records
+        """
+        if self.encoding == "packed":
+            return packing.encode(records)
+        # 6 decimal places is plenty, and keeps the message short
+        records = [dict((name, round(value, 6) if isinstance(value, float) else value)
+                        for name, value in record.items()) for record in records]
+        if len(records) == 1:
+            message = dict(records[0])
+            message["sensor"] = self.sensor_id
+        else:
+            message = {"sensor": self.sensor_id, "timestamp": records[-1]["timestamp"], "batch": records}
+        return json.dumps(message, separators=(',', ':'))
+
+    def topic_for(self, records):
+        """
+            Returns the topic to publish a message holding records to. Packed messages
+            carry the time of their newest window in the topic, as their DynamoDB key
+        """
+        if self.encoding == "packed":
+            return packing.packed_topic(self.sensor_id, records)
+        return self.topic
+
+    def add(self, record):
+        """
+            Adds the readings for one window. record is a dictionary with a
+            "timestamp" and a value for each measurement. The batch is sent if
+            it's now full or has been waiting long enough.
+        """
+        with self.lock:
+            if not self.pending:
+                self.oldest = time.monotonic()
+                if self.batch_seconds > 0:
+                    self.timer = threading.Timer(self.batch_seconds, self.flush_waiting)
+                    self.timer.daemon = True
+                    self.timer.start()
+            self.pending.append(record)
+            full = len(self.pending) >= self.batch_windows
+            waited = self.batch_seconds > 0 and time.monotonic() - self.oldest >= self.batch_seconds
+        if full or waited:
+            self.flush()
+
+    def flush_waiting(self):
+        """
+            Sends the pending windows if the oldest has been waiting batch_seconds.
+            The timer runs this, and it does nothing if the windows it was started
+            for have already been sent.
+        """
+        with self.lock:
+            waited = self.oldest is not None and time.monotonic() - self.oldest >= self.batch_seconds
+        if waited:
+            self.flush()
+
+    def flush(self, wait=False):
+        """
+            Sends everything collected so far. With wait set the message is sent
+            with publish(), which waits for it to be acknowledged (or time out),
+            otherwise publishAsync() is used.
+        """
+        with self.lock:
+            records = self.pending
+            self.pending = []
+            self.oldest = None
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+        if not records:
+            return
+        payload = self.payload(records)
+        topic = self.topic_for(records)
+        self.logger.info("publishing %d windows (%d bytes)", len(records), len(payload))
+        if wait:
+            self.client.publish(topic, payload, 1)
+        else:
+            self.client.publishAsync(topic, payload, 1, ackCallback=self.ack_callback)
@@ -12,31 +12,119 @@ the README file for the project description.
 # set-up section
 ##################################################
 
+# note when the program started, to log how long it takes to get to the first reading
+import time
+PROGRAM_START = time.monotonic()
+
 # import python libraries
 # AWS MQTT protocol client for python
 import AWSIoTPythonSDK.MQTTLib as AWSIoTPyMQTT
 from AWSIoTPythonSDK.MQTTLib import AWSIoTMQTTClient
-# Adafruit libraries for the DHT22 temp and humidity sensor
-# and the BMP085/BMP180 temp and air pressure sensor
-import Adafruit_DHT
-import Adafruit_BMP.BMP085 as BMP085
+# drivers for the DHT22 temp and humidity sensor, the BMP085/BMP180 temp and
+# air pressure sensor and the particulate sensors (real or simulated)
+import drivers
+# reads each sensor device in its own thread on a fixed timetable
+import acquisition
+# works out the trimmed mean and other statistics of the readings in each window
+import aggregator
+# packs the readings from several windows into each data message
+import publisher
+# keeps every message on the SD card until AWS IoT acknowledges it
+import outbox as store
+# runs the main loop on an asyncio event loop instead of a thread for each device
+import asyncnode
+# changes the length of the windows to suit how much the particulate readings are changing
+import adaptive
+# only sends the readings that have changed since they were last sent
+import deadband
+# sets up the sensor devices all at once, and times how long starting up takes
+import startup
+# counts how long the reads, windows and acknowledgements take, for the metrics messages
+# and the Prometheus web page
+import telemetry
 # various utility libraries
-import time
+import argparse
+import signal
+import threading
 import datetime
+import json
 import sys
 
 # collect parameters passed from the command line
-# parameters in order starting at 0 are:
-# script filename
+# parameters in order are:
 # sensor_id
 # AWS IoT host_name
 # AWS root_ca filename
 # AWS IoT private_key filename
 # AWS IoT cert_file
 # dust sensor type
+# followed by any of these optional settings:
+# --batch-windows N  pack N windows of readings into each data message (default 1, no batching)
+# --batch-seconds T  send the data message once the oldest window in it is T seconds old,
+#                    even if it isn't full (default 0, no time limit)
+# --outbox PATH      the database file messages are kept in until they are acknowledged
+#                    (default outbox.db next to this program)
+# --encoding E       json (the default) or packed, a compact binary layout that is about
+#                    a sixth of the size (see packing.py)
+# --simulate         use simulated sensor devices instead of the real ones (see drivers.py),
+#                    to try the program out on a computer without the sensors attached
+# --seed S           makes the simulated devices give the same readings every time
+# --asyncio          run the main loop on one asyncio event loop (see asyncnode.py) instead
+#                    of a thread for each device
+# --adaptive         make the windows shorter (down to --min-window samples) and send the
+#                    readings straight away when the particulate readings are high or changing
+#                    fast, and longer (up to --max-window samples) when they are calm, see
+#                    adaptive.py. --pm25-threshold, --pm10-threshold, --change,
+#                    --hysteresis and --quiet-windows fine tune when it changes
+# --deadband         only send a reading when it has changed by more than its deadband since
+#                    it was last sent, and every reading at least every --heartbeat seconds
+#                    (default 1800) anyway, see deadband.py. Each --deadband-limit
+#                    CHANNEL=ABSOLUTE[,FRACTION] changes the deadband of one measurement,
+#                    e.g. --deadband-limit pm25=2,0.1
+# --connect-timeout T  longest to wait for the MQTT client to come online before starting to
+#                    take readings (default 15 seconds), they are kept in the outbox until it is
+# --device-timeout T longest to wait for the sensor devices to be set up (default 60 seconds)
+# --metrics-interval T  send the node's telemetry (how long each device read takes, retries,
+#                    window processing time, outbox queue and acknowledgement times, see
+#                    telemetry.py) to the sensors/metrics topic every T seconds (default 300, 0 never)
+# --metrics-port P   serve the same numbers for Prometheus at http://<node>:P/metrics
+#                    (default 9101, 0 to turn it off), --metrics-address picks the address
+#                    it listens on (default 127.0.0.1, so only the node itself can read it,
+#                    use 0.0.0.0 for a Prometheus server elsewhere on the network)
+parser = argparse.ArgumentParser(description="Reads the sensors and sends the readings to AWS IoT")
+parser.add_argument("sensor_id")
+parser.add_argument("host_name")
+parser.add_argument("root_ca")
+parser.add_argument("private_key")
+parser.add_argument("cert_file")
+parser.add_argument("particulate_sensor_type")
+parser.add_argument("--batch-windows", type=int, default=publisher.DEFAULT_BATCH_WINDOWS)
+parser.add_argument("--batch-seconds", type=float, default=publisher.DEFAULT_BATCH_SECONDS)
+parser.add_argument("--outbox", default=store.DEFAULT_OUTBOX_PATH)
+parser.add_argument("--encoding", choices=publisher.ENCODINGS, default=publisher.DEFAULT_ENCODING)
+parser.add_argument("--simulate", action="store_true")
+parser.add_argument("--seed")
+parser.add_argument("--asyncio", action="store_true")
+parser.add_argument("--adaptive", action="store_true")
+parser.add_argument("--min-window", type=int, default=adaptive.DEFAULT_MIN_SAMPLES)
+parser.add_argument("--max-window", type=int, default=adaptive.DEFAULT_MAX_SAMPLES)
+parser.add_argument("--pm25-threshold", type=float, default=adaptive.DEFAULT_PM25_THRESHOLD)
+parser.add_argument("--pm10-threshold", type=float, default=adaptive.DEFAULT_PM10_THRESHOLD)
+parser.add_argument("--change", type=float, default=adaptive.DEFAULT_CHANGE)
+parser.add_argument("--hysteresis", type=float, default=adaptive.DEFAULT_HYSTERESIS)
+parser.add_argument("--quiet-windows", type=int, default=adaptive.DEFAULT_QUIET_WINDOWS)
+parser.add_argument("--deadband", action="store_true")
+parser.add_argument("--heartbeat", type=float, default=deadband.DEFAULT_HEARTBEAT)
+parser.add_argument("--deadband-limit", type=deadband.parse_limit, action="append", default=[])
+parser.add_argument("--connect-timeout", type=float, default=15)
+parser.add_argument("--device-timeout", type=float, default=startup.DEFAULT_DEVICE_TIMEOUT)
+parser.add_argument("--metrics-interval", type=float, default=telemetry.DEFAULT_METRICS_INTERVAL)
+parser.add_argument("--metrics-port", type=int, default=telemetry.DEFAULT_METRICS_PORT)
+parser.add_argument("--metrics-address", default=telemetry.DEFAULT_METRICS_ADDRESS)
+args = parser.parse_args()
 
 # sensor ID to identify this sensor node
-sensor_id = sys.argv[1]
+sensor_id = args.sensor_id
 # we need to assign a unique client ID based on the sensor ID
 # for use with the MQTT client (RPiZeroW is the type of 
 # Raspberry Pi computer the node is running on
@@ -44,25 +132,25 @@ MQTT_CLIENT = "Sensor{:s}RPiZeroW".format(sensor_id)
 
 # The unique hostname that AWS IoT generated for this device.
 # should look like: a19nuo7ml0j5az-ats.iot.ap-southeast-2.amazonaws.com
-HOST_NAME = sys.argv[2]
+HOST_NAME = args.host_name
 
 # The relative path to the correct root CA file for AWS IoT,
 # should look like: /home/pi/root-CA.crt
-ROOT_CA = sys.argv[3]
+ROOT_CA = args.root_ca
 
 # The relative path to the private key file that
 # AWS IoT generated for this device,
 # should look like: /home/pi/Sensor1.private.key (but with correct sensor ID)
-PRIVATE_KEY = sys.argv[4]
+PRIVATE_KEY = args.private_key
 
 # The relative path to the certificate file that
 # AWS IoT generated for this device,
 # should look like: /home/pi/Sensor1.cert.pem
-CERT_FILE = sys.argv[5]
+CERT_FILE = args.cert_file
 
 # The type of particulate sensor used. Valid values are
 # Honeywell or SDS011 (case-sensitive)
-particulate_sensor_type = sys.argv[6]
+particulate_sensor_type = args.particulate_sensor_type
 
 # A programmatic client handler name prefix required by the AWS IoT MQTT client 
 MQTT_HANDLER = "Sensor{:s}RPi".format(sensor_id)
@@ -76,18 +164,33 @@ def get_local_timestamp():
   local_ts = '{:%Y-%m-%d %H:%M:%S}'.format(datetime.datetime.now())
   return(local_ts)
 
-def trimmedMean(valuesList, numberToTrim=3):
-  # calculate a trimmed mean of value in a list, see the main loop section below
-  # for why this is needed and what it does
-  # first sort the list passed to this function, but it may contain Nones and a mixture of
-  # integers and floats, which cause the sort() function to fail. So instead use this trick
-  # to sort lists containing integers, floats and Nones from
-  # https://stackoverflow.com/questions/18411560/python-sort-list-with-none-at-the-end
-  sortedLst = sorted(valuesList, key=lambda x: float('inf') if x is None else float(x))
-  # trim it by slicing off number_to_trim elements from each end
-  trimmedLst = sortedLst[numberToTrim:-numberToTrim]
-  # now get the average and return it
-  return(sum(trimmedLst) / len(trimmedLst))
+def publishInfo(info):
+  # send a message to the sensors/info topic (through the outbox), returns the outbox's id for it
+  # (json.dumps() as the info may be an error message with quotes in it)
+  payload = json.dumps({"sensor": sensor_id, "timestamp": get_local_timestamp(), "info": info}, separators=(',', ':'))
+  return(outbox.publishAsync("sensors/info", payload, 1))
+
+# when the program is about to exit because of a problem, how long to wait for the info
+# messages saying why to be acknowledged by AWS IoT
+BAILING_ACK_TIMEOUT = 30
+
+def waitForAcks(messageIds, timeout=BAILING_ACK_TIMEOUT):
+  # wait until the messages have been acknowledged, or until timeout seconds have gone by.
+  # Any that aren't acknowledged stay in the outbox and are sent when the program starts again
+  deadline = time.monotonic() + timeout
+  for messageId in messageIds:
+    outbox.wait_until_sent(messageId, max(0, deadline - time.monotonic()))
+
+# the node's telemetry: read latencies, retries, window processing time, outbox queue and
+# acknowledgement times (see telemetry.py)
+nodeTelemetry = telemetry.Telemetry(PROGRAM_START)
+
+# keeps how long each part of starting up takes, and logs the time until the first reading
+def firstSampleTaken(timer):
+  print("Startup: {:s}".format(timer.report()), flush=True)
+  nodeTelemetry.set("startup_first_sample_seconds", timer.first_sample_seconds)
+  publishInfo("startup: {:s}".format(timer.report()))
+startupTimer = startup.StartupTimer(PROGRAM_START, on_first_sample=firstSampleTaken)
 
 ##################################################
 # AWS IoT MQTT client set-up and connection
@@ -106,36 +209,51 @@ myClient.configureConnectDisconnectTimeout(60)
 myClient.configureMQTTOperationTimeout(60)
 # recommended setings for automatic reconnect
 myClient.configureAutoReconnectBackoffTime(1, 128, 20)
-# number of messages to keep in the queue to be sent if MQTT client is offline
-myClient.configureOfflinePublishQueueing(500, AWSIoTPyMQTT.DROP_OLDEST)
-# how fast to draing the queue of stored messages when MQTT clinet reconnects
-myClient.configureDrainingFrequency(1)
+# the client's own queue for messages sent while it is offline only holds 500 messages
+# in memory, so it is turned off and every message goes through the outbox instead, which
+# keeps them on the SD card until they are acknowledged (see outbox.py)
+myClient.configureOfflinePublishQueueing(0)
+# the outbox reports how long each message took to be acknowledged, from being sent and from
+# being saved (which includes any time spent waiting while the node was offline)
+def messageAcknowledged(roundTrip, delivery):
+  if roundTrip is not None:
+    nodeTelemetry.observe("publish_ack_seconds", roundTrip)
+  nodeTelemetry.observe("publish_delivery_seconds", delivery)
+outbox = store.Outbox(myClient, args.outbox, latency_callback=messageAcknowledged)
+# set when the MQTT client is online, so starting up can wait for it
+mqttOnline = threading.Event()
 # define a function to be called when the MQTT client goes online
+# (these callbacks are called from the MQTT client's own thread, so they mustn't wait around)
 def myOnOnlineCallback():
   # print a message to the console
   print("MQTT client connected and online")
+  # start sending the messages saved in the outbox
+  outbox.set_online(True)
+  mqttOnline.set()
   # also send a MQTT message to the sensors/info topic
   # The payload of the message is formatted as JSON with values for
   # the sensor ID, the current date and time, and an information message as text
-  myClient.publishAsync("sensors/info", '{{"sensor":"{:s}","timestamp":"{:s}","info":"MQTT client online"}}'.format(sensor_id,get_local_timestamp()),1)
-  time.sleep(10)
+  publishInfo("MQTT client online")
 # Register the function defined above to be called when the MQTT  goes online
 myClient.onOnline = myOnOnlineCallback
 def myOnOfflineCallback():
   # print a message to the console
   print("MQTT client disconnected and offline")
+  # keep the messages in the outbox until the client is back online
+  mqttOnline.clear()
+  outbox.set_online(False)
   # also send a MQTT message to the sensors/info topic
-  myClient.publishAsync("sensors/info", '{{"sensor":"{:s}","timestamp":"{:s}","info":"MQTT client offline"}}'.format(sensor_id,get_local_timestamp()),1)
-  time.sleep(10)
+  publishInfo("MQTT client offline")
 # Register the function defined above to be called when the MQTT  goes online
 myClient.onOffline = myOnOfflineCallback
 # tell the client to connect with AWS
 # use 2400 seconds for the keep-alive which is much longer than the
 # time between data sends, so the connection doesn't drop between
 # each data send (publish)
+# The connection is made in the background while the sensor devices are set up
 myClient.connectAsync(keepAliveIntervalSecond=2400)
-# seems to need a few seconds before the connection is ready to use
-time.sleep(10)
+outbox.start()
+startupTimer.mark("loading")
 
 # define a message publish acknowledgement callback function,
 # called automatically when an acknowledgement of successful message
@@ -144,211 +262,290 @@ def myPubackCallback(mid):
   print("Message ID {:d} sent and acknowledged".format(mid))
 
 ##################################################
-# set up particulate sensor device
+# set up the sensor devices
 ##################################################
 
-# import the right library for the particulate sensor type for this node
-if particulate_sensor_type == 'Honeywell':
-  # the Honeywell driver already has serial port values set as required
-  import honeywell
-  # create an instance of the Honeywell driver class, this can sometimes fail
-  # so log the failures
-  try:
-    hw = honeywell.Honeywell()
-    print("Honeywell sensor initialised")
-    # also send info message saying it is initialised
-    myClient.publishAsync("sensors/info", '{{"sensor":"{:s}","timestamp":"{:s}","info":"initialised Honeywell sensor"}}'.format(sensor_id,get_local_timestamp()), 1)
-    time.sleep(10)
-  except:
-    print("Honeywell sensor failed to initialise - bailing!")
-    # also send info message saying it failed
-    myClient.publishAsync("sensors/info", '{{"sensor":"{:s}","timestamp":"{:s}","info":"Honeywell sensor failed to initialise"}}'.format(sensor_id,get_local_timestamp()), 1)
-    time.sleep(30)
-    # exit the program so it is automatically restarted to try again
-    sys.exit(1)
-  # the Honeywell sensor also has to be told to start taking measurements
-  try:
-    hw.start_measuring()
-    print("Honeywell sensor started measuring")
-    myClient.publishAsync("sensors/info", '{{"sensor":"{:s}","timestamp":"{:s}","info":"Honeywell sensor started measuring"}}'.format(sensor_id,get_local_timestamp()), 1)
-    time.sleep(10)
-  except:
-    print("Honeywell sensor failed to start measuring - bailing!")
-    myClient.publishAsync("sensors/info", '{{"sensor":"{:s}","timestamp":"{:s}","info":"Honeywell sensor failed to start measuring"}}'.format(sensor_id,get_local_timestamp()), 1)
-    time.sleep(30)
-    # bail!
-    sys.exit(1)
-elif particulate_sensor_type == 'SDS011':
-  from sds011 import SDS011
-  # the SDS-011 driver needs various serial port values to be set as constants
-  DEFAULT_SERIAL_PORT = "/dev/serial0" # Serial port to use if no other specified
-  DEFAULT_BAUD_RATE = 9600 # Serial baud rate to use if no other specified
-  DEFAULT_SERIAL_TIMEOUT = 2 # Serial timeout to use if not specified
-  DEFAULT_READ_TIMEOUT = 1 # How long to sit looking for the correct character sequence.
-  # set up Nova SDS-011 sensor
-  # send an info message saying it is being initialised
-  myClient.publishAsync("sensors/info", '{{"sensor":"{:s}","timestamp":"{:s}","info":"initialising Nova SDS-011 sensor"}}'.format(sensor_id,get_local_timestamp()), 1)
-  time.sleep(10)
-  # create an instance of the SDS011 driver class, this can also fail, if so, bail out of program  so it restarts
-  try:
-    sds = SDS011(DEFAULT_SERIAL_PORT, use_query_mode=True)
-    print("Nova SDS-011 sensor initialised")
-    myClient.publishAsync("sensors/info", '{{"sensor":"{:s}","timestamp":"{:s}","info":"initialised Nova SDS-011 sensor"}}'.format(sensor_id,get_local_timestamp()), 1)
-    time.sleep(10)
-  except:
-    print("Nova SDS-011 sensor failed to initialise - bailing out!")
-    myClient.publishAsync("sensors/info", '{{"sensor":"{:s}","timestamp":"{:s}","info":"failed to initialise Nova SDS-011 sensor"}}'.format(sensor_id,get_local_timestamp()), 1)
-    time.sleep(30)
-    sys.exit(1)
-else:
+# the names of the devices used in the info messages
+DEVICE_NAMES = {'Honeywell': 'Honeywell sensor', 'SDS011': 'Nova SDS-011 sensor',
+                'BMP180': 'BMP180 sensor', 'DHT22': 'DHT22 sensor'}
+
+# check the particulate sensor type given on the command line. Valid values are
+# Honeywell or SDS011 (case-sensitive)
+if particulate_sensor_type not in drivers.PARTICULATE_TYPES:
   # if it gets to here, then an invalid particle sensor type was specified on the
   # command line, so might as well just exit, but sleep for 10 minutes first because
   # this program will automatically be restarted and the same error will happen until
   # it is fixed. A 10 minute wait stops too many error info messages being sent.
   print("invalid particulate sensor type specified on command line, shutting down in 10 minutes")
-  myClient.publishAsync("sensors/info", '{{"sensor":"{:s}","timestamp":"{:s}","info":"invalid particulate sensor type specified on command line, shutting down in 10 minutes"}}'.format(sensor_id,get_local_timestamp()), 1)
+  waitForAcks([publishInfo("invalid particulate sensor type specified on command line, shutting down in 10 minutes")])
   time.sleep(600)
   sys.exit(1)
 
-##################################################
-# set up BMP180 temp and air pressure sensor
-##################################################
-
-myClient.publishAsync("sensors/info", '{{"sensor":"{:s}","timestamp":"{:s}","info":"initialising BMP180 sensor"}}'.format(sensor_id,get_local_timestamp()), 1)
-time.sleep(10)
-try:
-  # ultra-high res mode seems to work fine
-  bmp = BMP085.BMP085(mode=BMP085.BMP085_ULTRAHIGHRES)
-  print("BMP180 sensor initialised")
-  myClient.publishAsync("sensors/info", '{{"sensor":"{:s}","timestamp":"{:s}","info":"initialised BMP180 sensor"}}'.format(sensor_id,get_local_timestamp()), 1)
-  time.sleep(10)
-except:
-  print("BMP180 sensor failed to initialise, exiting program")
-  myClient.publishAsync("sensors/info", '{{"sensor":"{:s}","timestamp":"{:s}","info":"BMP180 sensor failed to initialise, exiting program"}}'.format(sensor_id,get_local_timestamp()), 1)
-  time.sleep(30)
+def setUpDevice(device):
+  # make the driver for one device, real or simulated (see drivers.py). This raises an
+  # exception if the device can't be set up.
+  driver = drivers.make_driver(device, args.simulate, args.seed)
+  # the Honeywell sensor also has to be told to start taking measurements. start() returns
+  # as soon as the sensor acknowledges the command (or raises an exception if it doesn't
+  # within the read timeout, see _check_cmd_ack() in honeywell.py). It then sends a
+  # reading every second, which the driver reads in the background so none are wasted.
+  # The other devices don't need starting.
+  driver.start()
+  return(driver)
+
+# set up the particulate sensor, the BMP180 temp and air pressure sensor and the DHT22 temp
+# and humidity sensor (which doesn't really need setting up) all at the same time, each in its
+# own thread, and wait until they are all ready, or any that isn't after --device-timeout
+# seconds counts as failed
+print("Setting up sensor devices")
+publishInfo("initialising sensors")
+devices = startup.init_devices([(device, lambda device=device: setUpDevice(device))
+                                for device in (particulate_sensor_type, 'BMP180', 'DHT22')],
+                               args.device_timeout)
+startupTimer.mark("devices")
+failures = []
+for device, (driver, error) in devices.items():
+  if error is None:
+    print("{:s} initialised".format(DEVICE_NAMES[device]))
+    publishInfo("initialised {:s}".format(DEVICE_NAMES[device]))
+  else:
+    print("{:s} failed to initialise ({}) - bailing!".format(DEVICE_NAMES[device], error))
+    failures.append(publishInfo("{:s} failed to initialise: {}".format(DEVICE_NAMES[device], error)))
+if failures:
+  # exit the program so it is automatically restarted to try again, once the info
+  # messages saying why have been acknowledged (or not, after a while)
+  waitForAcks(failures)
   sys.exit(1)
+particulateDriver = devices[particulate_sensor_type][0]
+bmpDriver = devices['BMP180'][0]
+dhtDriver = devices['DHT22'][0]
+
+# the readings are kept in the outbox until the MQTT client is online, so there's no need to wait
+# for it, but give it a little while (--connect-timeout seconds) so the messages go straight out
+if mqttOnline.wait(args.connect_timeout):
+  startupTimer.mark("connecting")
+else:
+  print("MQTT client not online yet, the readings will be sent once it is")
+  startupTimer.mark("waiting for connection")
 
-# note: the DHT22 temp and humidity sensor doesn't require any set up
+##################################################
+# functions to read each sensor device
+##################################################
+# Each of these takes one reading from a device and returns the values as a tuple,
+# or None if the reading failed. They are called by the acquisition scheduler (see
+# acquisition.py) which reads each device in its own thread on a fixed timetable, so
+# a slow or failed read on one device doesn't hold up the others.
+
+def readDHT22():
+  # get humidity and temp from the DHT22 device
+  values = dhtDriver.read()
+  # sometimes the DHT22 glitches and returns None as the readings, even after the driver
+  # has tried several times, so send a message to the sensors/info MQTT topic stream.
+  # There's no need to wait and try again here, the next reading is due in SAMPLE_INTERVAL
+  # seconds anyway
+  if values is None:
+    publishInfo("DHT22 reading failed")
+  return(values)
+
+def readBMP180():
+  # read the BMP180 sensor, check values although it doesn't seem to return None values
+  values = bmpDriver.read()
+  if values is None:
+    publishInfo("BMP180 reading failed")
+  return(values)
+
+def readParticulates():
+  # read the particulate sensor device (Nova SDS-011 or Honeywell), the driver
+  # returns (pm10, pm25) or None
+  return(particulateDriver.read())
 
 ##################################################
 # main loop forever
 ##################################################
 print("Starting main loop")
-myClient.publishAsync("sensors/info", '{{"sensor":"{:s}","timestamp":"{:s}","info":"starting main loop"}}'.format(sensor_id,get_local_timestamp()), 1)
-time.sleep(10)
-
-# initialise a main loop counter just for information
-mainLoopCounter = -1
-
-while True:
-
-  # increment and display main loop counter
-  mainLoopCounter += 1
-  print("Main loop number {:d}".format(mainLoopCounter))
-
-  # the idea is to take 20 readings at 10 second intervals from each sensor type and store the results
-  # for each sensor type in a list, and then sort that list of values and discard the lowest three and highest
-  # three readings, then calculate the average of the remaining readings. This is called a trimmed mean.
-  # The trimmedMean() function defined above does this. This should get rid of most erroneous
-  # measurements caused by sensor glitches will be discarded, and the data will be a lot cleaner
-  # without spikes of obviously incorrect readings. This data cleaning could be done after the
-  # data have been collected into the central database, but might as well do it at the
-  # point of data collection on each sensor device.
-
-  # first set up lists to hold the readings for each sensor device type on attached
-  humidityReadings = list() # from the DHT22 sensor device
-  temperatureReadings = list() # from the DHT22 device
-  temperatureBmp180Readings = list() # from the BMP180 device
-  airpressureReadings = list() # from the BMP180 device
-  pm10Readings = list() # air particulates from either SDS-011 or Honeywell devices
-  pm25Readings = list() # air particulates from either SDS-011 or Honeywell devices
-
-  # now loop for 20 times to take readings from each device and append the reading to the
-  # lists set up above
-  # print loop counter on console for information
-  # end='' stops a new line being added by print()
-  print("Inner loop number: ", end='', flush=True)
-  for t in range(20):
-
-    print("{:d} ".format(t), end='', flush=True)
-
-    # first get humidity and temp from the DHT22 device
-    humidity, temperature = Adafruit_DHT.read_retry(Adafruit_DHT.DHT22, 17)
-    # sometimes the DHT22 glitches and returns None as the readings, so check for that and
-    # try again a few times, and send a message to the sensors/info MQTT topic stream
-    if humidity is None or temperature is None:
-      for rereadTry in range(1,6):
-        # log a message to the sensors/info MQTT topic
-        myClient.publishAsync("sensors/info", '{{"sensor":{:s},"timestamp":"{:s}","info":"DHT22 reading failed, try number {:d}"}}'.format(sensor_id, get_local_timestamp(),rereadTry), 1)
-        # re-try after a few seconds
-        time.sleep(10)
-        humidity, temperature = Adafruit_DHT.read_retry(Adafruit_DHT.DHT22, 17)
-        if humidity is not None and temperature is not None:
-          # break out of this retry loop
-          break
-    # if still a reading error, then the value will be None, but it should be eliminated by
-    # the trimmed means procedure
-    # add the readings to the lists
-    humidityReadings.append(float(humidity))
-    temperatureReadings.append(float(temperature))
-
-    # now read the BMP180 sensor. Check values and re-read if it returns None values
-    # although it doesn't seem to
-    bmp180_temperature = bmp.read_temperature()
-    bmp180_airpressure = bmp.read_pressure()
-    if bmp180_temperature is None or bmp180_airpressure is None:
-      for rereadTry in range(1,6):
-        # log a message to the sensors/info MQTT topic
-        myClient.publishAsync("sensors/info", '{{"sensor":{:s},"timestamp":"{:s}","info":"BMP180 reading failed, try number {:d}"}}'.format(sensor_id, get_local_timestamp(),rereadTry), 1)
-        # re-try after a few seconds
-        time.sleep(10)
-        bmp180_temperature = bmp.read_temperature()
-        bmp180_airpressure = bmp.read_pressure()
-        if bmp180_temperature is not None and bmp180_airpressure is not None:
-          # break out of this retry loop
-          break
-    # if still a reading error, then the value will be None, but it should be eliminated by
-    # the trimmed means procedure
-    # add the readings to the lists
-    airpressureReadings.append(float(bmp180_airpressure))
-    temperatureBmp180Readings.append(float(bmp180_temperature))
-
-    # finally read the particulate sensor device, using the correct driver for that device 
-    if particulate_sensor_type == 'SDS011':
-      # read the Nova SDS-011 sensor
-      pm10, pm25 = sds.query()
-    elif particulate_sensor_type == 'Honeywell':
-      # read the Honeywell sensor, note that it also returns a timestamp but in UTC (Greenwich) time which we don't use
-      pm_ts_utc, pm10, pm25 = str(hw.read()).split(",")
-    else:
-      # The particulate device type parameter on the command line must not be correct, so log it
-      myClient.publishAsync("sensors/info", '{{"sensor":{:s},"timestamp":"{:s}","info":"particulate device type parameter incorrect!"}}'.format(sensor_id, get_local_timestamp()), 1)
-      # sleep for 10 minutes since this error will keep happening until it is fixed
-      time.sleep(600)
-    # add the readings to the lists
-    pm10Readings.append(float(pm10))
-    pm25Readings.append(float(pm25))
-
-    # now sleep for 10 seconds before repeating inner loop
-    time.sleep(10)
-
-  # go to a new line in the console output
-  print(" ", flush=True)
-
-  # at this point there should be 20 readings in lists for each of the measurement types
-  # so get the trimmed mean of each of these lists
-  meanHumidity = trimmedMean(humidityReadings)
-  meanTemperature = trimmedMean(temperatureReadings)
-  meanBmp180Temperature = trimmedMean(temperatureBmp180Readings)
-  meanAirpressure = trimmedMean(airpressureReadings)
-  meanPM10 = trimmedMean(pm10Readings)
-  meanPM25 = trimmedMean(pm25Readings)
+publishInfo("starting main loop")
+
+# the idea is to take 20 readings at 10 second intervals from each sensor type, and then sort
+# the values for each measurement and discard the lowest three and highest three readings, then
+# calculate the average of the remaining readings. This is called a trimmed mean.
+# This should get rid of most erroneous measurements caused by sensor glitches, and the data will
+# be a lot cleaner without spikes of obviously incorrect readings. This data cleaning could be
+# done after the data have been collected into the central database, but might as well do it at
+# the point of data collection on each sensor device.
+# The WindowAggregator (see aggregator.py) does this. It also works out the median, min, max,
+# standard deviation and a mean that leaves out outliers (readings a long way from the median),
+# which are printed as a check. Failed readings are counted but otherwise left out.
+
+# The readings are taken by the acquisition scheduler. Every device is read once every
+# SAMPLE_INTERVAL seconds in its own thread, and the readings are collected into windows of
+# exactly SAMPLE_INTERVAL * WINDOW_SAMPLES seconds (3 minutes 20 seconds). The windows are
+# timed from time.monotonic() so they don't drift, however long the reads take.
+SAMPLE_INTERVAL = 10
+WINDOW_SAMPLES = 20
+# the fraction of readings dropped from each end for the trimmed mean, 0.15 is 3 of 20
+TRIM_FRACTION = 0.15
+# a window with this many or fewer good readings for any measurement is skipped (for
+# windows of a different length, the same fraction of the window is used)
+MIN_READINGS = 6
+# the measurements each device returns, in the order its read function returns them
+DEVICE_CHANNELS = [("DHT22", ("humidity", "temperature")),
+                   ("BMP180", ("bmp180_temperature", "bmp180_airpressure")),
+                   ("particulates", ("pm10", "pm25"))]
+
+# with --adaptive the window length changes, so the statistics have to hold the longest window
+adaptiveWindow = None
+if args.adaptive:
+  adaptiveWindow = adaptive.AdaptiveWindow(WINDOW_SAMPLES, min_samples=args.min_window,
+                                           max_samples=args.max_window, pm25_threshold=args.pm25_threshold,
+                                           pm10_threshold=args.pm10_threshold, change=args.change,
+                                           hysteresis=args.hysteresis, quiet_windows=args.quiet_windows)
+# with --deadband only the readings that have changed are sent. The dashboard holds each
+# reading until the next one for up to the heartbeat plus a couple of the longest windows
+deadbandFilter = None
+if args.deadband:
+  longestWindow = SAMPLE_INTERVAL * (max(WINDOW_SAMPLES, args.max_window) if args.adaptive else WINDOW_SAMPLES)
+  deadbandFilter = deadband.DeadbandFilter(dict(args.deadband_limit), heartbeat=args.heartbeat,
+                                           max_window=longestWindow)
+windowStats = aggregator.WindowAggregator(aggregator.CHANNELS, window=max(WINDOW_SAMPLES, args.max_window),
+                                          trim=TRIM_FRACTION)
+dataPublisher = publisher.BatchPublisher(outbox, sensor_id, "sensors/data",
+                                         batch_windows=args.batch_windows, batch_seconds=args.batch_seconds,
+                                         encoding=args.encoding,
+                                         ack_callback=myPubackCallback)
+
+# how long dealing with each window takes is kept in the telemetry
+@nodeTelemetry.timed("window_processing_seconds")
+def processWindow(window):
+  # work out the statistics for one window of readings and add them to the next data message
+
+  # count the reads, their latencies and failures for the telemetry
+  nodeTelemetry.add_window(window)
+  # display the window number
+  print("Main loop number {:d}".format(window.number))
+  # show how long the reads from each device took
+  print(window.latency_report(), flush=True)
+
+  # add the readings from each device to the statistics for its measurements
+  windowStats.reset()
+  for device, channels in DEVICE_CHANNELS:
+    for sample in window.samples[device]:
+      windowStats.add_values(channels, sample.values)
+  stats = windowStats.stats()
+  for channel in aggregator.CHANNELS:
+    print(channel, stats[channel])
+
+  # with --adaptive, work out how long the next window should be from how much the
+  # particulate readings changed
+  windowSamples = int(round((window.end - window.start) / SAMPLE_INTERVAL))
+  if adaptiveWindow is not None:
+    nextSamples = adaptiveWindow.update(stats)
+    if nextSamples != scheduler.next_window_samples:
+      print("Next window {:d} samples: {:s}".format(nextSamples, adaptiveWindow.reason))
+      publishInfo("window changed to {:d} seconds: {:s}".format(nextSamples * SAMPLE_INTERVAL, adaptiveWindow.reason))
+      scheduler.set_window_samples(nextSamples)
+
+  # failed readings are left out, so if a device failed most of the time there won't be
+  # enough readings left to take a trimmed mean, so skip this window and log it
+  if windowStats.min_count() <= MIN_READINGS * windowSamples // WINDOW_SAMPLES:
+    print("Not enough readings in this window, skipping it")
+    nodeTelemetry.inc("windows_skipped_total")
+    publishInfo("not enough readings in window {:d}: {:s}".format(window.number, window.latency_report()))
+    return
+
+  # use the trimmed mean of each measurement
+  meanHumidity = stats["humidity"].trimmed_mean
+  meanTemperature = stats["temperature"].trimmed_mean
+  meanBmp180Temperature = stats["bmp180_temperature"].trimmed_mean
+  meanAirpressure = stats["bmp180_airpressure"].trimmed_mean
+  meanPM10 = stats["pm10"].trimmed_mean
+  meanPM25 = stats["pm25"].trimmed_mean
   # print out the clean data as a check
   print(get_local_timestamp(), meanHumidity, meanTemperature, meanPM25, meanPM10, meanBmp180Temperature, meanAirpressure)
-  # assemble all these values into a JSON data payload string
-  payload = '{{"sensor":"{:s}","timestamp":"{:s}","temperature":{:f},"humidity":{:f},"pm25":{:f},"pm10":{:f},"bmp180_temperature":{:f},"bmp180_airpressure":{:f}}}'.format(sensor_id, get_local_timestamp(),meanTemperature, meanHumidity,meanPM25,meanPM10,meanBmp180Temperature,meanAirpressure)
-  # send the data message, ask for an acknowledgement and call the acknowledge function to display this
-  myClient.publishAsync("sensors/data", payload, 1, ackCallback=myPubackCallback)
+  record = {"timestamp": get_local_timestamp(), "temperature": meanTemperature, "humidity": meanHumidity,
+            "pm25": meanPM25, "pm10": meanPM10, "bmp180_temperature": meanBmp180Temperature,
+            "bmp180_airpressure": meanAirpressure}
+  # with --deadband, leave out the readings that haven't changed enough to be worth sending
+  if deadbandFilter is not None:
+    record = deadbandFilter.filter(record)
+    if record is None:
+      print("Readings haven't changed enough to send ({:d} of {:d} windows sent)".format(deadbandFilter.records, deadbandFilter.windows))
+      return
+  # add these values to the next data message, which is sent (asking for an acknowledgement
+  # and calling the acknowledge function to display this) once it has enough windows in it
+  dataPublisher.add(record)
+  # while something is going on, send the readings straight away rather than waiting for a full batch
+  if adaptiveWindow is not None and adaptiveWindow.active:
+    dataPublisher.flush()
+
+# the numbers that are looked up when the telemetry is read, rather than counted as they happen
+def collectTelemetry(metrics):
+  queue = outbox.stats()
+  metrics.set("outbox_messages", queue["messages"])
+  metrics.set("outbox_in_flight", queue["in_flight"])
+  metrics.set("outbox_dropped_total", queue["dropped"])
+  # the retries and errors counted by each driver, e.g. the DHT22's retries and the
+  # Honeywell's checksum failures
+  for device, driver in (("DHT22", dhtDriver), ("BMP180", bmpDriver), ("particulates", particulateDriver)):
+    for event, count in driver.counters().items():
+      metrics.set("device_events_total", count, device=device, event=event)
+nodeTelemetry.add_collector(collectTelemetry)
+
+# send the telemetry to the sensors/metrics topic every --metrics-interval seconds, through
+# the outbox like every other message
+metricsPublisher = None
+if args.metrics_interval > 0:
+  metricsPublisher = telemetry.MetricsPublisher(nodeTelemetry, outbox, sensor_id, interval=args.metrics_interval,
+                                                timestamp=get_local_timestamp)
+  metricsPublisher.start()
+# and serve it for Prometheus on --metrics-port. Not being able to (e.g. the port is in use)
+# isn't worth stopping the node for, so it just carries on without it
+metricsServer = None
+if args.metrics_port > 0:
+  try:
+    metricsServer = telemetry.serve(nodeTelemetry, args.metrics_port, args.metrics_address)
+  except OSError as exp:
+    print("Can't serve metrics on port {:d}: {}".format(args.metrics_port, exp))
+    publishInfo("can't serve metrics on port {:d}: {}".format(args.metrics_port, exp))
+
+# systemd stops the program with SIGTERM, turn it into a normal exit so the
+# readings that haven't been sent yet are sent first (see the end of the main loop)
+def stopRunning(signum, frame):
+  sys.exit(0)
+signal.signal(signal.SIGTERM, stopRunning)
 
-  # sleep for a few seconds before starting all over again
-  time.sleep(10)
+try:
+  if args.asyncio:
+    # one event loop reads all the devices. The Honeywell's serial port is read by the
+    # event loop itself, the other devices' reads block so they are run in a thread pool
+    scheduler = asyncnode.AsyncAcquisition(SAMPLE_INTERVAL, WINDOW_SAMPLES)
+    scheduler.add_device("DHT22", startupTimer.first_sample(readDHT22))
+    scheduler.add_device("BMP180", startupTimer.first_sample(readBMP180))
+    if isinstance(particulateDriver, drivers.HoneywellDriver):
+      scheduler.add_serial_device("particulates", particulateDriver.hw)
+    else:
+      scheduler.add_device("particulates", startupTimer.first_sample(readParticulates))
+    # runs until SIGTERM or Ctrl-C
+    asyncnode.run(scheduler, processWindow)
+  else:
+    scheduler = acquisition.AcquisitionScheduler(SAMPLE_INTERVAL, WINDOW_SAMPLES)
+    # the first good reading from any device is timed (see startup.py)
+    scheduler.add_device("DHT22", startupTimer.first_sample(readDHT22))
+    scheduler.add_device("BMP180", startupTimer.first_sample(readBMP180))
+    scheduler.add_device("particulates", startupTimer.first_sample(readParticulates))
+    scheduler.start()
+    while True:
+      # wait for the next window of readings and deal with it
+      processWindow(scheduler.next_window())
+finally:
+  # whatever stopped the program, save any readings still waiting in a batch to the outbox,
+  # and give them a few seconds to be acknowledged. Anything not acknowledged stays in the
+  # outbox and is sent the next time the program starts.
+  print("Stopping, sending unsent readings")
+  if not args.asyncio:
+    scheduler.stop()
+  if metricsPublisher is not None:
+    metricsPublisher.stop()
+  if metricsServer is not None:
+    metricsServer.shutdown()
+  dataPublisher.flush(wait=True)
+  outbox.stop()
@@ -0,0 +1,100 @@
+# this is just test code, it is not part of the Sensor node
+# it checks the startup helpers (startup.py): the devices are set up at the same time, a
+# device that fails or hangs doesn't hold up the others for longer than the timeout, and the
+# first reading is timed. It also times setting up a pretend Honeywell sensor on a
+# pseudo-terminal (honeywell_emulator.py), which is ready as soon as it acknowledges the
+# start measuring command, and one that refuses it.
+# needs Linux and pyserial. Run it from the rpi-sensor-node folder with: python3 startup-test.py
+
+import time
+import threading
+import drivers
+import startup
+from honeywell import Honeywell, HoneywellException
+from honeywell_emulator import HoneywellEmulator
+
+def check(name, ok):
+    print("{:60s} {}".format(name, "ok" if ok else "FAILED"))
+    if not ok:
+        raise SystemExit(1)
+
+def slowDevice(seconds, result):
+    def init():
+        time.sleep(seconds)
+        return result
+    return init
+
+def brokenDevice():
+    raise IOError("no such device")
+
+# three devices taking 0.3 seconds each are ready in 0.3 seconds, not 0.9
+started = time.monotonic()
+results = startup.init_devices([("a", slowDevice(0.3, "A")), ("b", slowDevice(0.3, "B")), ("c", slowDevice(0.3, "C"))])
+took = time.monotonic() - started
+print("    (3 devices set up in {:.2f}s)".format(took))
+check("devices set up at the same time", took < 0.5)
+check("every device's driver returned, in order", list(results.items()) == [("a", ("A", None)), ("b", ("B", None)), ("c", ("C", None))])
+
+# a broken device and a hung one
+started = time.monotonic()
+results = startup.init_devices([("ok", slowDevice(0.1, "ok")), ("broken", brokenDevice), ("hung", slowDevice(30, "late"))], timeout=0.5)
+took = time.monotonic() - started
+check("working device still set up", results["ok"] == ("ok", None))
+check("broken device's exception returned", isinstance(results["broken"][1], IOError))
+check("hung device times out", isinstance(results["hung"][1], startup.DeviceTimeout))
+check("hung device only holds things up for the timeout", took < 0.7)
+
+# the first good reading is timed, once, from whichever device gives it
+clock = [0.0]
+reports = []
+timer = startup.StartupTimer(started=0.0, on_first_sample=lambda t: reports.append(t.report()), clock=lambda: clock[0])
+clock[0] = 1.0
+timer.mark("loading")
+clock[0] = 3.0
+timer.mark("devices")
+failing = timer.first_sample(lambda: None)
+working = timer.first_sample(lambda: (1.0, 2.0))
+clock[0] = 4.0
+failing()
+check("a failed reading isn't the first reading", timer.first_sample_seconds is None)
+clock[0] = 5.0
+values = [working() for n in range(3)]
+threads = [threading.Thread(target=working) for n in range(10)]
+for thread in threads:
+    thread.start()
+for thread in threads:
+    thread.join()
+check("the readings are passed on", values == [(1.0, 2.0)] * 3)
+check("time to the first reading", timer.first_sample_seconds == 5.0)
+check("reported once", reports == ["first reading 5.0s after starting (loading 1.0s, devices 2.0s)"])
+
+# setting up a Honeywell sensor waits for its acknowledgements, not a fixed time
+emulator = HoneywellEmulator(period=0.1)
+emulator.start()
+started = time.monotonic()
+sensor = Honeywell(port=emulator.port)
+sensor.start_measuring()
+took = time.monotonic() - started
+print("    (Honeywell ready {:.2f}s after opening its port)".format(took))
+check("Honeywell ready once it acknowledges", took < 1.0)
+sensor.stop_measuring()
+sensor.serial.close()
+emulator.close()
+
+# one that refuses the commands fails straight away rather than being waited on
+emulator = HoneywellEmulator(period=0.1, nack_rate=1.0)
+emulator.start()
+def startRefusing():
+    sensor = Honeywell(port=emulator.port)
+    try:
+        sensor.start_measuring()
+    finally:
+        sensor.serial.close()
+started = time.monotonic()
+results = startup.init_devices([("Honeywell", startRefusing), ("BMP180", lambda: drivers.make_driver('BMP180', simulate=True))])
+took = time.monotonic() - started
+emulator.close()
+check("refused start measuring is a failure", isinstance(results["Honeywell"][1], HoneywellException))
+check("the other devices are still set up", isinstance(results["BMP180"][0], drivers.SimulatedBMP180))
+check("and it doesn't wait for the device timeout", took < 5)
+print("all startup tests passed")
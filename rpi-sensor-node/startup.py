@@ -0,0 +1,126 @@
+"""
+    Helpers for starting the sensor node quickly (used by sensor_run.py).
+    The node used to wait a fixed 10 seconds after connecting, after every info
+    message and after setting up each device, so a restart lost more than a minute
+    of readings. Instead it now waits for things to actually be ready:
+        init_devices() sets up all the sensor devices at the same time, each in
+        its own thread, and waits until every one has finished (or failed, or
+        taken too long)
+        StartupTimer keeps how long each part of starting up took, and the time
+        from the program starting until the first reading was taken
+"""
+
+import collections
+import logging
+import threading
+import time
+
+DEFAULT_LOGGING_LEVEL = logging.WARN
+
+DEFAULT_DEVICE_TIMEOUT = 60 # Longest to wait for a device to be set up (seconds)
+
+
+class DeviceTimeout(Exception):
+    """
+        Put in place of the error for a device that took too long to set up
+    """
+    pass
+
+
+def init_devices(inits, timeout=DEFAULT_DEVICE_TIMEOUT):
+    """
+        Runs each of the (name, function) pairs in inits in its own thread, and
+        returns an ordered dictionary of name -> (what the function returned,
+        the exception it raised or None). A function still running after
+        timeout seconds gets a DeviceTimeout, and is left to finish by itself
+        (the threads are daemon threads, so they don't stop the program exiting).
+    """
+    results = collections.OrderedDict((name, (None, None)) for name, init in inits)
+    finished = set()
+    lock = threading.Lock()
+
+    def run(name, init):
+        try:
+            result = (init(), None)
+        except Exception as exp: # pylint: disable=broad-except
+            result = (None, exp)
+        with lock:
+            results[name] = result
+            finished.add(name)
+
+    threads = [threading.Thread(target=run, args=(name, init), name="init " + name, daemon=True)
+               for name, init in inits]
+    for thread in threads:
+        thread.start()
+    deadline = time.monotonic() + timeout
+    for thread in threads:
+        thread.join(max(0.0, deadline - time.monotonic()))
+    with lock:
+        for name, init in inits:
+            if name not in finished:
+                results[name] = (None, DeviceTimeout("not ready after %.0f seconds" % timeout))
+        return collections.OrderedDict(results)
+
+
+class StartupTimer(object):
+    """
+        Times starting up. started is time.monotonic() when the program started.
+        mark(stage) notes that a stage has finished, and first_sample(read)
+        wraps a device's read function so the first good reading from any
+        device is timed. on_first_sample(timer) is called (from the thread that
+        took the reading) once that has happened.
+    """
+    def __init__(self, started=None, on_first_sample=None, clock=time.monotonic,
+                 log_level=DEFAULT_LOGGING_LEVEL):
+        self.logger = logging.getLogger("Startup")
+        self.logger.setLevel(log_level)
+        self.clock = clock
+        self.started = clock() if started is None else started
+        self.stages = collections.OrderedDict() # stage -> seconds it took
+        self.last_mark = self.started
+        self.first_sample_seconds = None
+        self.on_first_sample = on_first_sample
+        self.lock = threading.Lock()
+
+    def mark(self, stage):
+        """
+            Notes that a stage of starting up has finished, and returns how long it took
+        """
+        now = self.clock()
+        seconds = now - self.last_mark
+        self.stages[stage] = seconds
+        self.last_mark = now
+        self.logger.info("%s took %.2fs", stage, seconds)
+        return seconds
+
+    def sampled(self):
+        """
+            Notes that a reading has been taken, only the first one counts
+        """
+        with self.lock:
+            if self.first_sample_seconds is not None:
+                return
+            self.first_sample_seconds = self.clock() - self.started
+        self.logger.info(self.report())
+        if self.on_first_sample is not None:
+            self.on_first_sample(self)
+
+    def first_sample(self, read_function):
+        """
+            Returns read_function wrapped to time the first good reading
+        """
+        def read():
+            values = read_function()
+            if values is not None and self.first_sample_seconds is None:
+                self.sampled()
+            return values
+        return read
+
+    def report(self):
+        """
+            Returns the time to the first reading and each stage as text
+        """
+        stages = ", ".join("%s %.1fs" % (stage, seconds) for stage, seconds in self.stages.items())
+        if self.first_sample_seconds is None:
+            return "no reading yet (%s)" % stages
+        return "first reading %.1fs after starting (%s)" % (self.first_sample_seconds, stages)
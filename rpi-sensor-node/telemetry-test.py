@@ -0,0 +1,203 @@
+# this is just test code, it is not part of the Sensor node
+# it checks the node's telemetry (telemetry.py): the read latencies, failures and missed
+# deadlines are counted from each window, the histograms and the Prometheus text are right,
+# the web page can be read, the metrics messages are published, and the outbox reports how
+# long each acknowledgement took. It also measures how long recording a window and reading
+# the telemetry take, as the node does both on a Raspberry Pi Zero.
+# run it from the rpi-sensor-node folder with: python3 telemetry-test.py
+
+import os
+import re
+import json
+import time
+import tempfile
+import threading
+import urllib.request
+import acquisition
+import drivers
+import telemetry
+from outbox import Outbox
+
+def check(name, ok):
+    print("{:60s} {}".format(name, "ok" if ok else "FAILED"))
+    if not ok:
+        raise SystemExit(1)
+
+def makeWindow(number, reads, missed=0, devices=("DHT22", "particulates")):
+    # a window with the same (values, latency) reads from each device
+    window = acquisition.AcquisitionWindow(number, number * 200.0, (number + 1) * 200.0, devices)
+    for device in window.samples:
+        for n, (values, latency) in enumerate(reads):
+            window.samples[device].append(acquisition.DeviceSample(device, n, n * 10.0, values, latency))
+        window.missed[device] = missed
+    return window
+
+##################################################
+# histograms
+##################################################
+
+histogram = telemetry.Histogram((0.1, 1.0, 10.0))
+for value in (0.05, 0.1, 0.5, 2.0, 20.0):
+    histogram.observe(value)
+check("values counted into buckets by upper bound", histogram.counts == [2, 1, 1, 1])
+check("cumulative buckets", [total for bound, total in histogram.cumulative()] == [2, 3, 4, 5])
+check("sum and count", abs(histogram.sum - 22.65) < 1e-9 and histogram.count == 5)
+check("quantiles are bucket upper bounds", histogram.quantile(0.5) == 1.0 and histogram.quantile(0.4) == 0.1)
+check("quantile above the last bucket unknown", histogram.quantile(0.99) is None)
+
+##################################################
+# recording the windows
+##################################################
+
+clock = [100.0]
+metrics = telemetry.Telemetry(started=40.0, clock=lambda: clock[0])
+metrics.add_window(makeWindow(0, [((50.0, 20.0), 0.004), (None, 2.1), ((51.0, 20.1), 0.3)], missed=1))
+metrics.add_window(makeWindow(1, [((50.0, 20.0), 0.004)]))
+metrics.inc("windows_skipped_total")
+metrics.observe("publish_ack_seconds", 0.2)
+metrics.observe("publish_delivery_seconds", 7200.0)
+values = metrics.collect()
+dht = (("device", "DHT22"),)
+check("reads counted", values["device_reads_total"][dht] == 4)
+check("failed reads counted", values["device_read_failures_total"][dht] == 1)
+check("missed deadlines counted", values["device_missed_samples_total"][dht] == 1)
+check("read latencies in the histogram", values["device_read_seconds"][dht].count == 4
+      and abs(values["device_read_seconds"][dht].sum - 2.408) < 1e-9)
+check("windows counted", values["windows_total"][()] == 2 and values["windows_skipped_total"][()] == 1)
+check("window length", values["window_seconds"][()] == 200.0)
+check("uptime from when the program started", values["uptime_seconds"][()] == 60.0)
+check("delivery times have their own buckets", values["publish_delivery_seconds"][()].quantile(0.5) == 14400.0)
+
+def rejected(function):
+    try:
+        function()
+    except ValueError:
+        return True
+    return False
+check("a counter can't be used as a histogram", rejected(lambda: metrics.observe("windows_total", 1.0))
+      and rejected(lambda: metrics.inc("device_read_seconds")))
+
+# the collectors are run before the numbers are read, and one going wrong doesn't stop the others
+metrics.logger.disabled = True
+dht22 = drivers.make_driver('DHT22', simulate=True, seed=1)
+honeywell = drivers.make_driver('Honeywell', simulate=True, seed=1)
+for n in range(200):
+    honeywell.read()
+def collectDrivers(metrics):
+    for device, driver in (("DHT22", dht22), ("particulates", honeywell)):
+        for event, count in driver.counters().items():
+            metrics.set("device_events_total", count, device=device, event=event)
+metrics.add_collector(lambda metrics: 1 / 0)
+metrics.add_collector(collectDrivers)
+values = metrics.collect()
+check("driver counters collected", values["device_events_total"][(("device", "particulates"), ("event", "checksum_failures"))]
+      == honeywell.parser.checksum_failures > 0)
+
+##################################################
+# the Prometheus text and the metrics messages
+##################################################
+
+text = metrics.prometheus_text()
+sample = re.compile(r'^[a-z_]+(\{[a-z_]+="[^"]*"(,[a-z_]+="[^"]*")*\})? [-+0-9.eInf]+$')
+lines = [line for line in text.splitlines() if not line.startswith("#")]
+check("every line is a Prometheus sample", all(sample.match(line) for line in lines))
+check("every metric has its type", all(("# TYPE " + telemetry.PREFIX + name + " ") in text
+                                       for name, values in metrics.collect().items() if values))
+check("histogram buckets", 'sdd_device_read_seconds_bucket{device="DHT22",le="1.0"} 3' in text
+      and 'sdd_device_read_seconds_bucket{device="DHT22",le="+Inf"} 4' in text
+      and 'sdd_device_read_seconds_count{device="DHT22"} 4' in text)
+check("label values escaped", telemetry.format_labels((("event", 'say "hi"\\'),)) == '{event="say \\"hi\\"\\\\"}')
+
+summary = json.loads(json.dumps(metrics.summary()))
+check("summary keyed on the label values", summary["device_reads_total"] == {"DHT22": 4, "particulates": 4})
+check("summary of a histogram", summary["device_read_seconds"]["DHT22"]["count"] == 4
+      and summary["device_read_seconds"]["DHT22"]["p50"] == 0.005
+      and summary["device_read_seconds"]["DHT22"]["p95"] == 2.5)
+check("metrics without labels are just their value", summary["windows_total"] == 2)
+
+class Client(object):
+    def __init__(self):
+        self.messages = []
+        self.published = threading.Event()
+    def publishAsync(self, topic, payload, qos=1, ackCallback=None):
+        self.messages.append((topic, json.loads(payload)))
+        self.published.set()
+
+client = Client()
+metricsPublisher = telemetry.MetricsPublisher(metrics, client, "7", interval=0.05, timestamp=lambda: "2026-10-18 10:00:00")
+metricsPublisher.start()
+check("metrics message published", client.published.wait(2))
+metricsPublisher.stop()
+metricsPublisher.join(2)
+topic, message = client.messages[0]
+check("to the metrics topic, with the sensor and time", topic == "sensors/metrics" and message["sensor"] == "7"
+      and message["timestamp"] == "2026-10-18 10:00:00" and message["metrics"]["windows_total"] == 2)
+
+##################################################
+# the web page
+##################################################
+
+server = telemetry.serve(metrics, port=0, address="127.0.0.1")
+url = "http://127.0.0.1:{:d}".format(server.server_address[1])
+response = urllib.request.urlopen(url + "/metrics", timeout=5)
+check("web page served", response.status == 200
+      and response.headers["Content-Type"].startswith("text/plain; version=0.0.4"))
+check("with the Prometheus text", response.read().decode("utf-8") == metrics.prometheus_text())
+try:
+    urllib.request.urlopen(url + "/other", timeout=5)
+    notFound = False
+except urllib.error.HTTPError as error:
+    notFound = error.code == 404
+check("anything else not found", notFound)
+server.shutdown()
+
+##################################################
+# acknowledgement times from the outbox
+##################################################
+
+class AckingClient(object):
+    # acknowledges each message after 0.05 seconds
+    def publishAsync(self, topic, payload, qos, ackCallback=None):
+        threading.Timer(0.05, ackCallback, (1,)).start()
+        return 1
+
+latencies = []
+with tempfile.TemporaryDirectory() as folder:
+    path = os.path.join(folder, "outbox.db")
+    outbox = Outbox(AckingClient(), path, send_rate=1000, latency_callback=lambda roundTrip, delivery: latencies.append((roundTrip, delivery)))
+    # saved while offline, so they wait before they are sent
+    ids = [outbox.publishAsync("sensors/data", "{}") for n in range(3)]
+    time.sleep(0.2)
+    check("queue depth", outbox.stats() == {"messages": 3, "in_flight": 0, "dropped": 0})
+    outbox.start()
+    outbox.set_online(True)
+    check("messages acknowledged", all(outbox.wait_until_sent(messageId, 5) for messageId in ids))
+    outbox.close()
+check("a latency for each message", len(latencies) == 3)
+check("round trip from being sent", all(0.04 < roundTrip < 1 for roundTrip, delivery in latencies))
+check("delivery from being saved, including the time offline", all(delivery > 0.2 for roundTrip, delivery in latencies))
+
+##################################################
+# how long it takes
+##################################################
+
+window = makeWindow(0, [((50.0, 20.0), 0.01)] * 20, devices=("DHT22", "BMP180", "particulates"))
+repeats = 2000
+started = time.perf_counter()
+for n in range(repeats):
+    metrics.add_window(window)
+perWindow = (time.perf_counter() - started) / repeats
+started = time.perf_counter()
+for n in range(repeats * 10):
+    metrics.observe("publish_ack_seconds", 0.2)
+perObservation = (time.perf_counter() - started) / (repeats * 10)
+started = time.perf_counter()
+for n in range(100):
+    metrics.prometheus_text()
+perScrape = (time.perf_counter() - started) / 100
+print("    ({:.1f}us to record a window of 60 reads, {:.2f}us per value, {:.2f}ms per scrape)".format(
+    perWindow * 1e6, perObservation * 1e6, perScrape * 1e3))
+# a Raspberry Pi Zero is about 20 times slower, and a window is 200 seconds long
+check("recording a window takes a tiny part of it", perWindow * 20 < 0.01)
+check("reading the telemetry is quick", perScrape * 20 < 0.5)
+print("all telemetry tests passed")
@@ -0,0 +1,373 @@
+"""
+    Telemetry for the sensor node: how long things take and how often they go wrong.
+    Telemetry keeps counters, gauges and histograms, each with labels (e.g. the device),
+    in memory. Recording one costs a dictionary lookup and a few additions, so it can
+    be done for every reading. The node records:
+        how long each device read took, how many reads failed and how many sample
+        deadlines were missed (from each window's samples, see acquisition.py), and the
+        retries and errors the drivers count themselves (see drivers.py)
+        how long each window took to deal with, and how long the windows are
+        how many messages are waiting in the outbox, and how long AWS IoT took to
+        acknowledge each message (see outbox.py)
+        how long the node took to take its first reading (see startup.py)
+    The numbers can be read in two ways:
+        MetricsPublisher publishes a summary as JSON to the sensors/metrics topic every
+        so often
+        serve() runs a small web server with the numbers in the Prometheus text format
+        at http://<node>:<port>/metrics, for Prometheus (or curl) to read
+"""
+
+import bisect
+import collections
+import http.server
+import json
+import logging
+import socketserver
+import threading
+import time
+
+DEFAULT_LOGGING_LEVEL = logging.WARN
+
+PREFIX = "sdd_" # Put in front of every metric name in the Prometheus text
+DEFAULT_METRICS_TOPIC = "sensors/metrics"
+DEFAULT_METRICS_INTERVAL = 300 # Seconds between metrics messages
+DEFAULT_METRICS_PORT = 9101 # Port the Prometheus text is served on
+DEFAULT_METRICS_ADDRESS = "127.0.0.1" # Only served to the node itself unless another address is given
+# histogram buckets in seconds, from a few milliseconds (a BMP180 read) up to a
+# minute (a DHT22 read that keeps retrying, or a slow acknowledgement)
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+# messages saved while the node is offline wait in the outbox for minutes to days
+DELIVERY_BUCKETS = (1.0, 5.0, 15.0, 60.0, 300.0, 900.0, 3600.0, 14400.0, 86400.0)
+QUANTILES = (0.5, 0.95, 0.99) # Estimated from the histograms for the metrics messages
+
+# every metric the node records, as name -> (type, help text)
+METRICS = collections.OrderedDict([
+    ("device_read_seconds", ("histogram", "How long each device read took")),
+    ("device_reads_total", ("counter", "Device reads")),
+    ("device_read_failures_total", ("counter", "Device reads that returned nothing")),
+    ("device_missed_samples_total", ("counter", "Sample deadlines skipped because the last read was still going")),
+    ("device_events_total", ("counter", "Retries and errors counted by the device drivers")),
+    ("windows_total", ("counter", "Windows of readings dealt with")),
+    ("windows_skipped_total", ("counter", "Windows skipped for not having enough readings")),
+    ("window_seconds", ("gauge", "Length of the last window")),
+    ("window_processing_seconds", ("histogram", "How long dealing with each window took")),
+    ("outbox_messages", ("gauge", "Messages in the outbox waiting to be sent or acknowledged")),
+    ("outbox_in_flight", ("gauge", "Messages sent but not acknowledged yet")),
+    ("outbox_dropped_total", ("counter", "Messages dropped because the outbox was full")),
+    ("publish_ack_seconds", ("histogram", "Time from sending a message to AWS IoT acknowledging it")),
+    ("publish_delivery_seconds", ("histogram", "Time from saving a message in the outbox to it being acknowledged")),
+    ("startup_first_sample_seconds", ("gauge", "Time from the program starting to the first good reading")),
+    ("uptime_seconds", ("gauge", "Time since the program started")),
+])
+# the histograms that don't use the default buckets
+BUCKETS = {"publish_delivery_seconds": DELIVERY_BUCKETS}
+
+
+class Histogram(object):
+    """
+        Counts the values observed into buckets by upper bound, like a
+        Prometheus histogram, and keeps their sum
+    """
+    __slots__ = ('bounds', 'counts', 'sum', 'count')
+
+    def __init__(self, bounds=DEFAULT_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1) # the last one is for values above every bound
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        """
+            Returns (upper bound, values up to it) for each bucket, the last bound is infinity
+        """
+        total = 0
+        buckets = []
+        for bound, count in zip(self.bounds + (float('inf'),), self.counts):
+            total += count
+            buckets.append((bound, total))
+        return buckets
+
+    def quantile(self, fraction):
+        """
+            Returns the upper bound of the bucket the given fraction of the values fall in,
+            or None if nothing has been observed (or it is above the last bound)
+        """
+        if not self.count:
+            return None
+        wanted = fraction * self.count
+        for bound, total in self.cumulative():
+            if total >= wanted:
+                return None if bound == float('inf') else bound
+        return None
+
+
+def label_key(labels):
+    # the labels as a tuple that can be a dictionary key, in name order
+    return tuple(sorted(labels.items()))
+
+
+def escape(value):
+    # escapes a label value for the Prometheus text format
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(key, extra=()):
+    labels = list(key) + list(extra)
+    if not labels:
+        return ""
+    return "{" + ",".join('%s="%s"' % (name, escape(value)) for name, value in labels) + "}"
+
+
+def format_value(value):
+    if isinstance(value, float):
+        if value == float('inf'):
+            return "+Inf"
+        return repr(value)
+    return str(value)
+
+
+class Telemetry(object):
+    """
+        The node's counters, gauges and histograms (see METRICS). Everything is
+        safe to call from any thread. collectors are functions called with the
+        Telemetry just before the numbers are read, to update gauges (like the
+        number of messages in the outbox) that are cheaper to look at then than
+        to keep up to date all the time. started is time.monotonic() when the
+        program started, for the uptime.
+    """
+    def __init__(self, started=None, buckets=DEFAULT_BUCKETS, clock=time.monotonic,
+                 log_level=DEFAULT_LOGGING_LEVEL):
+        self.logger = logging.getLogger("Telemetry")
+        self.logger.setLevel(log_level)
+        self.buckets = buckets
+        self.clock = clock
+        self.started = clock() if started is None else started
+        self.lock = threading.Lock()
+        self.values = dict((name, {}) for name in METRICS) # name -> label key -> value or Histogram
+        self.collectors = []
+
+    def check(self, name, *kinds):
+        # raises ValueError if the metric isn't one of the kinds given
+        if METRICS[name][0] not in kinds:
+            raise ValueError("%s is a %s, not a %s" % (name, METRICS[name][0], " or ".join(kinds)))
+
+    def inc(self, name, amount=1, **labels):
+        """
+            Adds to a counter
+        """
+        self.check(name, "counter")
+        key = label_key(labels)
+        with self.lock:
+            values = self.values[name]
+            values[key] = values.get(key, 0) + amount
+
+    def set(self, name, value, **labels):
+        """
+            Sets a gauge, or a counter that is counted somewhere else
+        """
+        self.check(name, "gauge", "counter")
+        key = label_key(labels)
+        with self.lock:
+            self.values[name][key] = value
+
+    def observe(self, name, value, **labels):
+        """
+            Adds a value to a histogram
+        """
+        self.check(name, "histogram")
+        key = label_key(labels)
+        with self.lock:
+            histogram = self.values[name].get(key)
+            if histogram is None:
+                histogram = self.values[name][key] = Histogram(BUCKETS.get(name, self.buckets))
+            histogram.observe(value)
+
+    def timed(self, name, **labels):
+        """
+            Decorator that observes how long each call of a function takes in a histogram
+        """
+        def decorate(function):
+            def timed_function(*args, **kwargs):
+                started = self.clock()
+                try:
+                    return function(*args, **kwargs)
+                finally:
+                    self.observe(name, self.clock() - started, **labels)
+            return timed_function
+        return decorate
+
+    def add_window(self, window):
+        """
+            Records the reads in a window of readings (acquisition.AcquisitionWindow)
+        """
+        with self.lock:
+            for device, samples in window.samples.items():
+                key = label_key({"device": device})
+                histogram = self.values["device_read_seconds"].get(key)
+                if histogram is None:
+                    histogram = self.values["device_read_seconds"][key] = Histogram(self.buckets)
+                failures = 0
+                for sample in samples:
+                    histogram.observe(sample.latency)
+                    if sample.values is None:
+                        failures += 1
+                for name, amount in (("device_reads_total", len(samples)),
+                                     ("device_read_failures_total", failures),
+                                     ("device_missed_samples_total", window.missed.get(device, 0))):
+                    self.values[name][key] = self.values[name].get(key, 0) + amount
+            self.values["windows_total"][()] = self.values["windows_total"].get((), 0) + 1
+            self.values["window_seconds"][()] = window.end - window.start
+
+    def add_collector(self, collector):
+        self.collectors.append(collector)
+
+    def collect(self):
+        """
+            Runs the collectors, and returns a copy of every metric as
+            name -> label key -> value, with the histograms copied too
+        """
+        self.set("uptime_seconds", self.clock() - self.started)
+        for collector in self.collectors:
+            try:
+                collector(self)
+            except Exception as exp: # pylint: disable=broad-except
+                self.logger.error("metrics collector failed: %s", exp)
+        with self.lock:
+            copied = {}
+            for name, values in self.values.items():
+                copied[name] = {}
+                for key, value in values.items():
+                    if isinstance(value, Histogram):
+                        histogram = Histogram(value.bounds)
+                        histogram.counts = list(value.counts)
+                        histogram.sum = value.sum
+                        histogram.count = value.count
+                        value = histogram
+                    copied[name][key] = value
+            return copied
+
+    def prometheus_text(self):
+        """
+            Returns every metric in the Prometheus text exposition format (version 0.0.4)
+        """
+        lines = []
+        for name, values in self.collect().items():
+            if not values:
+                continue
+            kind, help_text = METRICS[name]
+            full_name = PREFIX + name
+            lines.append("# HELP %s %s" % (full_name, help_text))
+            lines.append("# TYPE %s %s" % (full_name, kind))
+            for key in sorted(values):
+                value = values[key]
+                if kind != "histogram":
+                    lines.append("%s%s %s" % (full_name, format_labels(key), format_value(value)))
+                    continue
+                for bound, total in value.cumulative():
+                    lines.append("%s_bucket%s %d" % (full_name, format_labels(key, [("le", format_value(bound))]), total))
+                lines.append("%s_sum%s %s" % (full_name, format_labels(key), format_value(value.sum)))
+                lines.append("%s_count%s %d" % (full_name, format_labels(key), value.count))
+        return "\n".join(lines) + "\n"
+
+    def summary(self):
+        """
+            Returns every metric as a dictionary for the JSON metrics messages. Metrics with
+            labels become a dictionary keyed on the label values (e.g. "DHT22"), and each
+            histogram becomes its count, mean and estimated quantiles (the upper bound of the
+            bucket they fall in)
+        """
+        summary = collections.OrderedDict()
+        for name, values in self.collect().items():
+            if not values:
+                continue
+            entries = collections.OrderedDict()
+            for key in sorted(values):
+                value = values[key]
+                if isinstance(value, Histogram):
+                    value_summary = collections.OrderedDict([("count", value.count)])
+                    if value.count:
+                        value_summary["mean"] = round(value.sum / value.count, 6)
+                        for fraction in QUANTILES:
+                            value_summary["p%d" % round(fraction * 100)] = value.quantile(fraction)
+                    value = value_summary
+                elif isinstance(value, float):
+                    value = round(value, 6)
+                entries[",".join(str(label) for label_name, label in key)] = value
+            # metrics without labels are just the one value
+            summary[name] = entries[""] if list(entries) == [""] else entries
+        return summary
+
+
+class MetricsPublisher(threading.Thread):
+    """
+        Publishes the telemetry summary as JSON to topic every interval seconds,
+        through client (the outbox, so they wait on the SD card if the node is offline)
+    """
+    def __init__(self, telemetry, client, sensor_id, topic=DEFAULT_METRICS_TOPIC,
+                 interval=DEFAULT_METRICS_INTERVAL, timestamp=None):
+        threading.Thread.__init__(self, name="metrics publisher", daemon=True)
+        self.telemetry = telemetry
+        self.client = client
+        self.sensor_id = sensor_id
+        self.topic = topic
+        self.interval = interval
+        self.timestamp = timestamp or (lambda: time.strftime("%Y-%m-%d %H:%M:%S"))
+        self.stopping = threading.Event()
+
+    def message(self):
+        return json.dumps({"sensor": self.sensor_id, "timestamp": self.timestamp(),
+                           "metrics": self.telemetry.summary()}, separators=(',', ':'))
+
+    def run(self):
+        while not self.stopping.wait(self.interval):
+            try:
+                self.client.publishAsync(self.topic, self.message(), 1)
+            except Exception as exp: # pylint: disable=broad-except
+                self.telemetry.logger.error("publishing metrics failed: %s", exp)
+
+    def stop(self):
+        self.stopping.set()
+
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    """
+        Answers GET /metrics with the Prometheus text
+    """
+    telemetry = None # set on the class made by serve()
+
+    def do_GET(self): # pylint: disable=invalid-name
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = self.telemetry.prometheus_text().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args): # pylint: disable=redefined-builtin
+        pass # don't fill the node's log with every scrape
+
+
+class MetricsServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def serve(telemetry, port=DEFAULT_METRICS_PORT, address=DEFAULT_METRICS_ADDRESS):
+    """
+        Serves the Prometheus text at http://address:port/metrics from a background
+        thread, and returns the server (call shutdown() on it to stop it). Use the
+        address "" to listen on all the node's network interfaces.
+    """
+    handler = type("NodeMetricsHandler", (MetricsHandler,), {"telemetry": telemetry})
+    server = MetricsServer((address, port), handler)
+    thread = threading.Thread(target=server.serve_forever, name="metrics server", daemon=True)
+    thread.start()
+    return server